@@ -7,260 +7,235 @@ import random
 #import gym
 import sys
 import os
+import time
 # sys.path.append("C:\\Program Files\\Lumerical\\v202\\api\\python\\")   # Default windows lumapi path
 # sys.path.append(os.path.dirname(__file__))   # Current directory
 # os.add_dll_directory('C:\\Program Files\\Lumerical\\v202\\api\\python\\')
 # import lumapi as lp
-from scipy.signal import find_peaks, peak_widths
-from scipy.interpolate import interp1d
+from solver_session import SessionManager, lp
+from backends import get_backend
+from pcsel_geometry import pcsel_spec, compile_script, hole_lattice
+from farfield import grid_for, index_table, index_to_coord
+from instrumentation import timed
+
+# properties of the FDTD solver object that trade accuracy for run time (see fidelity.py)
+SOLVER_PROPERTIES = ("mesh accuracy", "simulation time")
+
+# mesh points per wavelength (in the material) of the FDTD auto non-uniform mesh, by mesh accuracy 1..8
+MESH_POINTS_PER_WAVELENGTH = {acc: 6 + 4*(acc-1) for acc in range(1, 9)}
+
+# penalty metrics for designs that cannot be simulated: no confined mode, zero Q / power / area, a 90 degree beam
+INFEASIBLE_RESULT = (0., 655., 0., 0., 90.)
+
+
+class FailedResult(tuple):
+    """ metrics tuple standing in for a simulation that failed (a timeout or a crash, see watchdog.py);
+        it scores like any result, but must not be cached or learned from as if it had been simulated
+    """
+
+
+def check_outcome(errors, warnings):
+    """FdtdEnv.feasibility_counts key of a checkdesign result"""
+    return "infeasible" if errors else ("flagged" if warnings else "feasible")
+
 
 class FdtdRlNanobeam():
 
-    def __init__(self):
+    def __init__(self, sessions=None, backend=None):
 
-        self.circles = 9
+        self.layer = 1   # holes per side of the centre hole
+        self.circles = (2*self.layer+1)**2
         self.rectangles = 4
+        self.farfield_slices = 36   # azimuthal cuts used for the divergence angle
+        self.timer = None   # optional instrumentation.StepTimer for setup/run/analysis wall times
         self.leng = 0.52
         self.a = 400E-9
+        # unperturbed layer stack, the design changes are applied on top of these
+        self.len = 2000E-9
+        self.t = 450E-9
+        self.t_1 = 100E-9
+        self.t_3 = 315E-9
+        self.n_1 = 3.2035
+        self.n_3 = 3.415
+        self.n_4 = 3.2035
+
+        # overrides of SOLVER_PROPERTIES for this object, e.g. {"mesh accuracy": 1} for a coarse run;
+        # the project values are read when a session is set up, so sessions shared between
+        # differently configured objects are switched back and forth correctly
+        self.solver_settings = {}
+        self.solver_defaults = {}
+
+        # feasibility limits (see checkdesign); infeasible designs never reach the solver and get
+        # infeasible_result instead
+        self.wavelength = 1310E-9
+        self.min_thickness = 10E-9   # thinnest layer worth simulating
+        self.min_wall = 20E-9        # semiconductor left between neighbouring holes
+        self.min_layer_cells = 1     # mesh cells across the thinnest layer, below that the design is only flagged
+        self.infeasible_result = INFEASIBLE_RESULT
+
+        # optional non-FDTD simulation backend, a name registered in backends.py or a Backend object
+        self.backend = get_backend(backend) if backend is not None else None
+
+        # warm solver sessions shared by all calls on this object; opened lazily on first use
+        self.sessions = sessions
+        if self.sessions is None and self.backend is None and lp is not None:
+            self.sessions = SessionManager(self.setupsession)
+
+    def geometryspec(self):
+        """ declarative description of the unperturbed PCSEL (see pcsel_geometry.py)
+        """
+        return pcsel_spec(len=self.len, t=self.t, t_1=self.t_1, t_3=self.t_3, n_1=self.n_1, n_3=self.n_3,
+                          n_4=self.n_4, leng=self.leng, a=self.a, layer=self.layer)
 
     def addgeometry(self, l3):
-        """ This function constructs the PCSEL geometry by running a setup script in FDTD
+        """ This function constructs the PCSEL geometry by running a setup script in FDTD;
+            the whole structure is compiled into one script and sent with a single eval
         """
-        l3.switchtolayout()
-        l3.unselectall()
-        l3.addstructuregroup()
-        l3.set("name", "pcsel")
-        l3.set('x', 0)
-        l3.set('y', 0)
-        l3.set('z', 0)
-        l3.adduserprop("t", 2, 450E-9)
-        l3.adduserprop("len", 2, 2000E-9)
-        l3.adduserprop("t_2", 2, 0)
-        l3.adduserprop("t_3", 2, 315E-9)
-        l3.adduserprop("t_4", 2, 5000E-9)
-        l3.adduserprop("n_1", 0, 3.2035)
-        l3.adduserprop("n_2", 0, 3.4038)
-        l3.adduserprop("n_3", 0, 3.415)
-        l3.adduserprop("n_4", 0, 3.2035)
-        l3.adduserprop("index", 0, 1)
-        l3.adduserprop("material_air", 5, "etch")
-        l3.adduserprop("material", 5, "<Object defined dielectric>")
-        l3.adduserprop("layer", 0, 1)
-        l3.adduserprop("leng", 0, 0.52)
-        l3.adduserprop("leng2", 0, 0.406)
-        l3.adduserprop("a", 2, 400E-9)
-        l3.adduserprop("t_1", 2, 100E-9)
-        l3.set("construction group", 0)
-
-        t = 450E-9
-        len = 2000E-9
-        t_2 = 0
-        t_3 = 315E-9
-        t_4 = 5000E-9
-        n_1 = 3.2035
-        n_2 = 3.4038 #GaAs (from https://refractiveindex.info)
-        n_3 = 3.415   #active layer
-        n_4 = 3.2035
-        material_air = "etch"
-        material = "<Object defined dielectric>"
-        layer = 1
-        leng = 0.52
-        leng2 = 0.406 #for triangular holes
-        a = 400E-9
-        t_1 = 100E-9
-        index = 1
-
-
-        l3.addrect()
-        l3.addtogroup("::model::pcsel")
-        l3.set("x",0)
-        l3.set("y",0)
-        l3.set("z",t_1/2+t+t_2+t_3/2)
-        l3.set("x span", len)
-        l3.set("y span", len)
-        l3.set("z span", t_1)
-        l3.set("material", material)
-        l3.set("index", n_2)
-
-
-        l3.addrect()
-        l3.addtogroup("::model::pcsel")
-        l3.set("x",0)
-        l3.set("y",0)
-        l3.set("z", t/2+t_2+t_3/2)
-        l3.set("x span", len)
-        l3.set("y span", len)
-        l3.set("z span", t)
-        l3.set("material", material)
-        l3.set("index", n_1)
-        l3.set("alpha", 0.7)
-
-
-        l3.addrect()
-        l3.addtogroup("::model::pcsel")
-        l3.set("x",0)
-        l3.set("y",0)
-        l3.set("z", 0)
-        l3.set("x span", len)
-        l3.set("y span", len)
-        l3.set("z span", t_3)
-        l3.set("material", material)
-        l3.set("index", n_3)
-        l3.set("alpha", 0.5)
-
-        l3.addrect()
-        l3.addtogroup("::model::pcsel")
-        l3.set("x",0)
-        l3.set("y",0)
-        l3.set("z",-t_3/2-t_4/2)
-        l3.set("x span", len)
-        l3.set("y span", len)
-        l3.set("z span", t_4)
-        l3.set("material", material)
-        l3.set("index", n_4)
-        l3.set("alpha", 0.3)
-
-  # ---------------------if circular holes---------------------------
-        for i in range(-layer, layer+1):   
-            for j in range(-layer, layer+1):
-                x_c=j*a
-                y_c=i*a
-                
-                l3.addcircle()
-                l3.addtogroup("::model::pcsel")
-                l3.set('radius', leng*a/2)
-                l3.set('x',x_c)
-                l3.set('y',y_c)
-                l3.set("z", t_1/2+t/2+t_2+t_3/2)
-                l3.set("z span", t_1+t)
-                l3.set("material", material_air)
-                #l3.set("index", index)
-            
-
-  # ---------------------if triangular holes---------------------------
-        # for i in range(-layer, layer+1):   
-        #     for j in range(-layer, layer+1):
-        #         x_c=j*a
-        #         y_c=i*a
-
-        #         V=[[x_c-leng2*a/2, y_c+leng2*a/2],
-        #             [x_c+leng2*a/2, y_c+leng2*a/2],
-        #             [x_c+leng2*a/2, y_c-leng2*a/2]]
-        #         l3.addpoly()
-        #         l3.addtogroup("::model::pcsel")
-        #         l3.set("vertices", V)
-        #         l3.set("z", t/2+t_2+t_3/2)
-        #         l3.set("z span", t)
-        #         l3.set("material", material_air)
-
-        l3.selectall()
-        #l3.set("z", 0)
-        # if l3.get("material") == "<Object defined dielectric>":
-            # l3.set("index", index)
-        l3.runsetup()
+        l3.eval(compile_script(self.geometryspec()))
 
     def index_to_xdata(self, xdata, indices):
         "interpolate the values from signal.peak_widths to xdata"
-        #ind = np.arange(len(xdata))
-        ind = np.arange(200)
-        f = interp1d(ind,xdata)
-        return f(indices)
+        return index_to_coord(index_table(xdata), indices)
+
+    def setupsession(self, l3):
+        """ runs once per freshly opened session: loads the project and builds the geometry
+        """
+        #l3.load("C:/Users/Administrator/OneDrive - CUHK-Shenzhen/Desktop/Renjie/nanobeam/short_InP/Nanobeam-Short-InP_Q83637.fsp")  # for QW case
+        l3.load("PCSEL-1310-GaAs100.fsp")    # for PCSEL
+        for prop in SOLVER_PROPERTIES:
+            self.solver_defaults.setdefault(prop, l3.getnamed("::model::FDTD", prop))
+        self.addgeometry(l3)
+
+    def designparams(self, dlen, dt, dt1, dt3, dn1, dn3, dleng, da):
+        """ absolute values of every object property touched by a design change,
+            keyed by (object name, property, object index) as used by setnamed
+        """
+        rect = "::model::pcsel::rectangle"
+        params = {
+            (rect, "z span", 1): float(self.t_1 + dt1),
+            (rect, "index", 2): float(self.n_1 + dn1),
+            (rect, "z span", 2): float(self.t + dt),
+            (rect, "index", 3): float(self.n_3 + dn3),
+            (rect, "z span", 3): float(self.t_3 + dt3),
+            (rect, "index", 4): float(self.n_4 + dn1),
+        }
+        # rectangular layers
+        for i in range(1, self.rectangles+1):
+            params[(rect, "x span", i)] = float(self.len + dlen)
+            params[(rect, "y span", i)] = float(self.len + dlen)
+        #circles
+        for i in range(1, self.circles+1):
+            params[("::model::pcsel::circle", "radius", i)] = float(hole_lattice(self.a, self.leng, dleng, da)[1])
+        # solver settings go along with the design, so a session always runs at this object's fidelity
+        for prop in SOLVER_PROPERTIES:
+            value = self.solver_settings.get(prop, self.solver_defaults.get(prop))
+            if value is not None:
+                params[("::model::FDTD", prop, 1)] = value
+        return params
+
+    def analyze(self, l3):
+        """ extracts (Q, resonance wavelength, power, mode area, divergence angle) after a run
+        """
+        #Qraw1 = l3.getresult("::model::Q::Qanalysis 3", "Q")
+        #Qmax1 = max(Qraw1['Q'])
+
+        Qraw5 = l3.getresult("::model::Q::Qanalysis 5", "Q")
+        Qmax5 = max(Qraw5['Q'])
+
+        #lam = l3.getresult("::model::Q::Qanalysis", "spectrum.lambda")
+        lam = l3.getresult("::model::Q::Qanalysis 5", "Q.peak_lam")
+        res_wavelength = np.mean(lam['peak_lam'])   #resonance wavelength in nm
+
+        powerArray = l3.getresult("::model::Top", "power")
+        power = max(np.real(powerArray))
+        dipole_power = 3.98265e-14      #dipole source power
+        power = power[0]/dipole_power  #output power/injecting power
+
+        areaArray = l3.getresult("::model::mode_area", "A")
+        area  = max(areaArray)[0]  #in terms of m^2
+
+        E2 = l3.getresult("::model::ffp", "farfield.E2")   #get farfield data
+        E = np.squeeze(E2['E2'])
+        # FWHM divergence of every azimuthal cut through the far field, see farfield.py
+        div_angles = grid_for(E2['ux'], E2['uy'], self.farfield_slices).divergence(E)
+        div_angle = np.nanmax(div_angles) #divergence angle in deg, widest cut
+
+        return Qmax5, res_wavelength, power, area, div_angle
+
+    def checkdesign(self, dlen, dt, dt1, dt3, dn1, dn3, dleng, da):
+        """ analytic feasibility check of a design change, no solver involved.
+            returns (errors, warnings): errors make the geometry degenerate (the design is rejected),
+            warnings only flag a mesh too coarse for the thinnest layer
+        """
+        errors, warnings = [], []
+        thicknesses = {"t": self.t + dt, "t_1": self.t_1 + dt1, "t_3": self.t_3 + dt3}
+        for name, thickness in thicknesses.items():
+            if thickness < self.min_thickness:
+                errors.append("thickness {} = {:.3g} m below {:.3g} m".format(name, thickness, self.min_thickness))
+
+        pitch, radius = hole_lattice(self.a, self.leng, dleng, da)
+        width = self.len + dlen
+        if radius <= 0:
+            errors.append("hole radius {:.3g} m is not positive".format(radius))
+        elif pitch - 2*radius < self.min_wall:
+            errors.append("hole diameter {:.3g} m leaves less than {:.3g} m to the pitch {:.3g} m".format(
+                2*radius, self.min_wall, pitch))
+        if 2*self.layer*pitch + 2*radius > width:
+            errors.append("hole lattice is wider than the {:.3g} m slab".format(width))
+        for name, n in (("n_1", self.n_1 + dn1), ("n_3", self.n_3 + dn3)):
+            if n < 1:
+                errors.append("index {} = {:.4f} below 1".format(name, n))
+
+        accuracy = self.solver_settings.get("mesh accuracy", self.solver_defaults.get("mesh accuracy", 2))
+        n_max = max(3.4038, self.n_1 + dn1, self.n_3 + dn3)
+        step = self.wavelength / (n_max * MESH_POINTS_PER_WAVELENGTH.get(int(accuracy), 10))
+        thinnest = min(thicknesses, key=thicknesses.get)
+        if thicknesses[thinnest] < self.min_layer_cells * step:
+            warnings.append("layer {} spans {:.2f} mesh cells".format(thinnest, thicknesses[thinnest] / step))
+        return errors, warnings
 
     def adjustdesignparams(self, dlen, dt, dt1, dt3, dn1, dn3, dleng, da):
         """ This function makes is convenient to reconstruct the simulation;
-                while changing the design parameters, a brand new FDTD session will start
-                and close within this function. Symmetry of the geometry is taken into account.
+                the design changes are pushed into a warm FDTD session (see solver_session.py),
+                which keeps the geometry between calls and only updates the properties that changed.
+                Symmetry of the geometry is taken into account.
         """
         #netDLen, netDT, netDT1, netDT3, netDN1, netDN3, netDLeng, netDA
-        
-        # print("starting new FDTD session... ")
-
-        # with lp.FDTD() as l3:
-        #     #l3.load("C:/Users/Administrator/OneDrive - CUHK-Shenzhen/Desktop/Renjie/nanobeam/short_InP/Nanobeam-Short-InP_Q83637.fsp")  # for QW case
-        #     l3.load("PCSEL-1310-GaAs100.fsp")    # for PCSEL
-
-        #     # create the structure setup script
-        #     self.addgeometry(l3)
-
-        #     # rectangular layers            
-        #     for i in range(1, self.rectangles+1):
-        #         if i == 1:
-        #             t1 = l3.getnamed("::model::pcsel::rectangle", "z span", i)
-        #             l3.setnamed("::model::pcsel::rectangle", "z span", float(t1 + dt1), i)
-        #         if i == 2:
-        #             n = l3.getnamed("::model::pcsel::rectangle", "index", i)
-        #             l3.setnamed("::model::pcsel::rectangle", "index", float(float(n) + dn1), i)
-        #             t = l3.getnamed("::model::pcsel::rectangle", "z span", i)
-        #             l3.setnamed("::model::pcsel::rectangle", "z span", float(t + dt), i)
-        #         elif i == 3:
-        #             n = l3.getnamed("::model::pcsel::rectangle", "index", i)
-        #             l3.setnamed("::model::pcsel::rectangle", "index", float(float(n) + dn3), i)
-        #             t3 = l3.getnamed("::model::pcsel::rectangle", "z span", i)
-        #             l3.setnamed("::model::pcsel::rectangle", "z span", float(t3 + dt3), i)
-        #         elif i == 4:
-        #             n4 = l3.getnamed("::model::pcsel::rectangle", "index", i)
-        #             l3.setnamed("::model::pcsel::rectangle", "index", float(float(n4) + dn1), i)
-
-        #         x_len = l3.getnamed("::model::pcsel::rectangle", "x span", i)
-        #         l3.setnamed("::model::pcsel::rectangle", "x span", float(x_len + dlen), i)
-        #         y_len = l3.getnamed("::model::pcsel::rectangle", "y span", i)
-        #         l3.setnamed("::model::pcsel::rectangle", "y span", float(y_len + dlen), i)
-                
-        #     #circles
-        #     for i in range(1, self.circles+1):
-        #         #rad = l3.getnamed("::model::pcsel::circle", "radius", i)
-        #         l3.setnamed("::model::pcsel::circle", "radius", float((self.leng+dleng)*(self.a+da)/2.0), i)
-                
-                
-        #     l3.run()
-
-        #     #print(pxNew, radNew, pxNew1, radNew1)
-
-        #     l3.runanalysis()
-
-        #     #Qraw1 = l3.getresult("::model::Q::Qanalysis 3", "Q")
-        #     #Qmax1 = max(Qraw1['Q'])
-
-        #     Qraw5 = l3.getresult("::model::Q::Qanalysis 5", "Q")
-        #     Qmax5 = max(Qraw5['Q'])
-
-        #     #lam = l3.getresult("::model::Q::Qanalysis", "spectrum.lambda")
-        #     lam = l3.getresult("::model::Q::Qanalysis 5", "Q.peak_lam")
-        #     res_wavelength = np.mean(lam['peak_lam'])   #resonance wavelength in nm
-
-        #     powerArray = l3.getresult("::model::Top", "power")
-        #     power = max(np.real(powerArray))
-        #     dipole_power = 3.98265e-14      #dipole source power
-        #     power = power[0]/dipole_power  #output power/injecting power
-
-        #     areaArray = l3.getresult("::model::mode_area", "A")
-        #     area  = max(areaArray)[0]  #in terms of m^2
-
-        #     E2 = l3.getresult("::model::ffp", "farfield.E2")   #get farfield data
-        #     #print(np.shape(E2['E2']))
-        #     #print('E2 is type', type(E2),' with keys', str(E2.keys()) )
-        #     uy = E2['uy']
-        #     uy = np.reshape(uy, 200)
-        #     #print(np.shape(uy))
-        #     #print(uy)
-        #     E = np.squeeze(E2['E2'])
-        #     E = E[100,0:199]
-        #     Emax = np.max(E)
-        #     #print(E[100])
-        #     peaks, _ = find_peaks(E, height = Emax/2)
-        #     widths, width_heights, left_ips, right_ips = peak_widths(E, peaks, rel_height=0.5)
-        #     #fwhm = self.index_to_xdata(uy, widths)/2
-        #     left_ips = self.index_to_xdata(uy, left_ips)
-        #     right_ips = self.index_to_xdata(uy, right_ips)
-        #     #print(fwhm, width_heights, left_ips, right_ips)
-        #     true_fwhm = (right_ips[0] - left_ips[0])/2
-        #     div_angle = np.arcsin(true_fwhm)*2*180/np.pi #divergence angle in deg
-
-        #     l3.switchtolayout()
-        #     l3.select("::model::pcsel")
-        #     l3.delete()
-        #     l3.save()
-        #todo analsys lumerical need money
-        Qmax5, res_wavelength, power, area, div_angle=[0,0,0,0,0]
-        return Qmax5, res_wavelength, power, area, div_angle
 
+        errors, warnings = self.checkdesign(dlen, dt, dt1, dt3, dn1, dn3, dleng, da)
+        if errors:
+            return self.infeasible_result
+
+        if self.backend is not None:
+            with timed(self.timer, 'run'):
+                return self.backend.adjustdesignparams(dlen, dt, dt1, dt3, dn1, dn3, dleng, da)
+
+        if self.sessions is None:
+            #todo analsys lumerical need money
+            Qmax5, res_wavelength, power, area, div_angle=[0,0,0,0,0]
+            return Qmax5, res_wavelength, power, area, div_angle
+
+        params = self.designparams(dlen, dt, dt1, dt3, dn1, dn3, dleng, da)
+
+        spent = {'run': 0., 'analysis': 0.}
+
+        def simulate(session):
+            session.push(params)
+            t0 = time.perf_counter()
+            session.handle.run()
+            t1 = time.perf_counter()
+            session.handle.runanalysis()
+            result = self.analyze(session.handle)
+            spent['run'] += t1 - t0
+            spent['analysis'] += time.perf_counter() - t1
+            return result
+
+        start = time.perf_counter()
+        result = self.sessions.call(simulate)
+        if self.timer is not None:
+            # whatever is not run or analysis (opening sessions, building geometry, pushing parameters) is setup
+            total = time.perf_counter() - start
+            self.timer.add('run', spent['run'])
+            self.timer.add('analysis', spent['analysis'])
+            self.timer.add('setup', total - spent['run'] - spent['analysis'])
+        return result
@@ -0,0 +1,204 @@
+""" pluggable simulation backends for FdtdRlNanobeam.
+    A backend is anything with adjustdesignparams(dlen, dt, dt1, dt3, dn1, dn3, dleng, da) returning
+    (Q, resonance wavelength in nm, power ratio, mode area in m^2, divergence angle in deg),
+    i.e. the same contract as FdtdRlNanobeam itself. NumpyBackend is a fast local model of the
+    PCSEL stack for offline benchmarking and load tests, not a replacement for FDTD.
+"""
+
+import abc
+import math
+import numpy as np
+
+from pcsel_geometry import hole_lattice
+
+
+class Backend(abc.ABC):
+    """base class of the simulation backends, a subclass without adjustdesignparams cannot be instantiated"""
+
+    name = None
+
+    @abc.abstractmethod
+    def adjustdesignparams(self, dlen, dt, dt1, dt3, dn1, dn3, dleng, da):
+        """(Q, lam, power, area, div_angle) of a design change"""
+
+
+class NullBackend(Backend):
+    """what the repo did without a solver licence: every design scores zeros"""
+
+    name = 'none'
+
+    def adjustdesignparams(self, dlen, dt, dt1, dt3, dn1, dn3, dleng, da):
+        return 0, 0, 0, 0, 0
+
+
+def bessel_j1(x, terms=30):
+    """J1 from its power series, accurate for the |x| < 10 needed for hole Fourier coefficients"""
+    x = np.asarray(x, dtype=np.float64)
+    half = x / 2.
+    term = half.copy()
+    total = term.copy()
+    for m in range(1, terms):
+        term = -term * half ** 2 / (m * (m + 1))
+        total = total + term
+    return total
+
+
+class NumpyBackend(Backend):
+    """
+    Mid-fidelity PCSEL model in plain NumPy, milliseconds per design.
+
+    vertical: the fundamental TE mode of the layer stack
+        air | top GaAs (holes, t_1) | cladding (holes, t) | active (t_3) | cladding n_4
+    is found with a transfer matrix dispersion scan (holes enter as an area averaged permittivity),
+    which gives the effective index and the confinement factor of every layer.
+    lateral: coupled-wave estimates for a square lattice of circular holes. The Fourier
+    coefficients of the hole lattice set the in-plane feedback (kappa_3, 2nd order) and the
+    vertical radiation coupling (kappa_1, 1st order); the resonance sits at the 2nd order
+    Gamma-point band edge lambda ~ a * n_eff.
+    outputs: Q from radiation + absorption losses, power as the upward radiated share of the loss,
+    mode area from the lattice-confined envelope, divergence from the emitting aperture.
+
+    n_scan and n_iter trade accuracy for speed (resolution of the dispersion scan and the
+    number of wavelength / effective index self consistency iterations).
+    """
+
+    name = 'numpy'
+
+    # unperturbed design, same as FdtdRlNanobeam.addgeometry
+    len = 2000E-9
+    t = 450E-9
+    t_1 = 100E-9
+    t_3 = 315E-9
+    n_1 = 3.2035
+    n_2 = 3.4038
+    n_3 = 3.415
+    n_4 = 3.2035
+    leng = 0.52
+    a = 400E-9
+    layer = 1
+
+    # loss model
+    alpha_i = 10.       # background loss, 1/m
+    alpha_active = 40.  # absorption of the active layer times its confinement, 1/m
+    radiation_scale = 1.5
+    up_fraction = 0.5   # share of the vertical radiation leaving through the top
+
+    def __init__(self, n_scan=400, n_iter=3):
+        self.n_scan = n_scan
+        self.n_iter = n_iter
+
+    def _transfer(self, neff, k0, eps, d, eps_top, eps_bot):
+        """boundary mismatch E' + gamma_b E at the bottom of the stack for trial effective indices"""
+        neff = np.asarray(neff, dtype=np.float64)
+        g_top = k0 * np.sqrt(np.maximum(neff ** 2 - eps_top, 0.))
+        g_bot = k0 * np.sqrt(np.maximum(neff ** 2 - eps_bot, 0.))
+        E = np.ones_like(neff, dtype=np.complex128)
+        dE = g_top.astype(np.complex128)
+        for eps_j, d_j in zip(eps, d):
+            kz = k0 * np.sqrt((eps_j - neff ** 2).astype(np.complex128))
+            c, s = np.cos(kz * d_j), np.sin(kz * d_j)
+            sinc = np.where(np.abs(kz) > 0, s / np.where(np.abs(kz) > 0, kz, 1.), d_j)
+            E, dE = E * c + dE * sinc, -E * kz * s + dE * c
+        # normalise so the scan does not overflow for strongly evanescent trial modes
+        return np.real(dE + g_bot * E) / (np.abs(E) + np.abs(dE) / k0 + 1e-300)
+
+    def slab_mode(self, k0, eps, d, eps_top, eps_bot):
+        """effective index and per-layer confinement of the fundamental TE mode"""
+        lo = math.sqrt(max(eps_top, eps_bot)) + 1e-9
+        hi = math.sqrt(max(eps)) - 1e-9
+        grid = np.linspace(hi, lo, self.n_scan)
+        f = self._transfer(grid, k0, eps, d, eps_top, eps_bot)
+        sign_change = np.flatnonzero(np.sign(f[:-1]) != np.sign(f[1:]))
+        if len(sign_change) == 0:
+            # no guided mode, treat it as cut off at the cladding light line
+            return lo, np.zeros(len(eps))
+        # highest effective index root = fundamental mode, refine by bisection
+        a_, b_ = grid[sign_change[0]], grid[sign_change[0] + 1]
+        fa = f[sign_change[0]]
+        for _ in range(40):
+            mid = 0.5 * (a_ + b_)
+            fm = self._transfer(mid, k0, eps, d, eps_top, eps_bot)
+            if np.sign(fm) == np.sign(fa):
+                a_, fa = mid, fm
+            else:
+                b_ = mid
+        neff = 0.5 * (a_ + b_)
+
+        # field profile layer by layer for the confinement factors
+        g_top = k0 * math.sqrt(neff ** 2 - eps_top)
+        g_bot = k0 * math.sqrt(max(neff ** 2 - eps_bot, 1e-12))
+        E, dE = 1. + 0j, g_top + 0j
+        power = [1. / (2 * g_top)]   # evanescent tail in air
+        for eps_j, d_j in zip(eps, d):
+            kz = k0 * np.sqrt(complex(eps_j - neff ** 2))
+            z = np.linspace(0., d_j, 64)
+            Ez = np.real(E * np.cos(kz * z) + dE * np.sin(kz * z) / kz)
+            power.append(np.sum(0.5 * (Ez[1:] ** 2 + Ez[:-1] ** 2) * np.diff(z)))
+            E, dE = E * np.cos(kz * d_j) + dE * np.sin(kz * d_j) / kz, -E * kz * np.sin(kz * d_j) + dE * np.cos(kz * d_j)
+        power.append(np.real(E) ** 2 / (2 * g_bot))   # tail in the bottom cladding
+        power = np.array(power)
+        return neff, power[1:-1] / power.sum()
+
+    def adjustdesignparams(self, dlen, dt, dt1, dt3, dn1, dn3, dleng, da):
+        L = self.len + dlen
+        a, r = hole_lattice(self.a, self.leng, dleng, da)
+        fill = min(math.pi * r ** 2 / a ** 2, 0.9)
+        n_top, n_clad, n_act, n_sub = self.n_2, self.n_1 + dn1, self.n_3 + dn3, self.n_4 + dn1
+
+        # holes are etched through the top two layers
+        eps_holes = np.array([n_top ** 2, n_clad ** 2])
+        eps = np.array([(1 - fill) * eps_holes[0] + fill, (1 - fill) * eps_holes[1] + fill, n_act ** 2])
+        d = np.array([self.t_1 + dt1, self.t + dt, self.t_3 + dt3])
+        if np.any(d <= 0) or L <= 0 or a <= 0:
+            return 0, 0, 0, 0, 0
+
+        # Fourier coefficients of the hole lattice, (1,0) and (2,0) orders
+        G = 2 * math.pi / a * np.array([1., 2.])
+        x = G * r
+        xi = fill * (eps_holes[:, None] - 1.) * 2 * bessel_j1(x)[None, :] / x[None, :]
+
+        lam = a * math.sqrt(n_act * n_clad)
+        for _ in range(self.n_iter):
+            k0 = 2 * math.pi / lam
+            neff, conf = self.slab_mode(k0, eps, d, 1., n_sub ** 2)
+            xi_eff = np.abs(conf[:2] @ xi)   # confinement weighted coupling of both hole layers
+            beta = k0 * neff
+            kappa1, kappa3 = k0 ** 2 / (2 * beta) * xi_eff
+            lam = a * neff * (1 + 0.5 * kappa3 / beta)
+
+        alpha_rad = self.radiation_scale * kappa1 ** 2 / k0 * (a / L) ** 2
+        alpha_abs = self.alpha_i + self.alpha_active * conf[2]
+        alpha = alpha_rad + alpha_abs
+        Q = k0 * neff / alpha
+        power = self.up_fraction * alpha_rad / alpha
+
+        # the 2nd order feedback pulls the envelope onto the hole lattice
+        W = (2 * self.layer + 1) * a
+        W_eff = W + max(L - W, 0.) / (1 + kappa3 * L)
+        area = (2 * W_eff / 3.) ** 2
+
+        # emitting aperture between the envelope width and the photon decay length
+        aperture = math.sqrt(W_eff / alpha)
+        div_angle = 2 * math.degrees(math.asin(min(0.44 * lam / aperture, 1.)))
+
+        return Q, lam * 1e9, power, area, div_angle
+
+
+BACKENDS = {
+    'none': NullBackend,
+    'numpy': NumpyBackend,
+}
+
+
+def register_backend(name, cls):
+    """makes a backend class available to FdtdRlNanobeam(backend=name)"""
+    BACKENDS[name] = cls
+
+
+def get_backend(backend, **kwargs):
+    """returns a backend instance from a registered name, or the object itself if it already is one"""
+    if isinstance(backend, str):
+        if backend not in BACKENDS:
+            raise ValueError('unknown backend {!r}, choose from {}'.format(backend, sorted(BACKENDS)))
+        return BACKENDS[backend](**kwargs)
+    return backend
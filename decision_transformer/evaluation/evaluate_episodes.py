@@ -152,3 +152,108 @@ def evaluate_episode_rtg(
             break
 
     return episode_return, episode_length,states,rewards,target_return
+
+
+def evaluate_episodes_vec(
+        vec_env,
+        state_dim,
+        act_dim,
+        model,
+        max_ep_len=1000,
+        scale=1000.,
+        state_mean=0.,
+        state_std=1.,
+        device='cuda',
+        target_return=None,
+        mode='normal',
+        use_rtg=True,
+    ):
+    """
+    Runs one episode in every env of a FdtdVecEnv, so the simulations of all envs at a time step
+    run in parallel. Follows evaluate_episode_rtg (use_rtg=True, for dt) or evaluate_episode
+    (use_rtg=False, for bc) per env and returns a list of
+    (episode_return, episode_length, states, rewards, target_return) tuples.
+    """
+
+    model.eval()
+    model.to(device=device)
+
+    state_mean = torch.from_numpy(state_mean).to(device=device)
+    state_std = torch.from_numpy(state_std).to(device=device)
+
+    obs = vec_env.reset()
+    if mode == 'noise':
+        obs = obs + np.random.normal(0, 0.1, size=obs.shape)
+    n = len(obs)
+
+    states = [torch.from_numpy(obs[i]).reshape(1, state_dim).to(device=device, dtype=torch.float32) for i in range(n)]
+    actions = [torch.zeros((0, act_dim), device=device, dtype=torch.float32) for _ in range(n)]
+    rewards = [torch.zeros(0, device=device, dtype=torch.float32) for _ in range(n)]
+    target_returns = [torch.tensor(target_return, device=device, dtype=torch.float32).reshape(1, 1) for _ in range(n)]
+    timesteps = [torch.tensor(0, device=device, dtype=torch.long).reshape(1, 1) for _ in range(n)]
+    cur_rtg = [None] * n
+    episode_return, episode_length = [0] * n, [0] * n
+
+    active = list(range(n))
+    for t in range(max_ep_len):
+        if not active:
+            break
+
+        env_actions = []
+        for i in active:
+            # add padding
+            actions[i] = torch.cat([actions[i], torch.zeros((1, act_dim), device=device)], dim=0)
+            rewards[i] = torch.cat([rewards[i], torch.zeros(1, device=device)])
+
+            norm_states = (states[i].to(dtype=torch.float32) - state_mean) / state_std
+            if use_rtg:
+                action = model.get_action(
+                    norm_states,
+                    actions[i].to(dtype=torch.float32),
+                    rewards[i].to(dtype=torch.float32),
+                    target_returns[i].to(dtype=torch.float32),
+                    timesteps[i].to(dtype=torch.long),
+                )
+            else:
+                action = model.get_action(
+                    norm_states,
+                    actions[i].to(dtype=torch.float32),
+                    rewards[i].to(dtype=torch.float32),
+                    target_return=target_returns[i][0, 0],
+                )
+            actions[i][-1] = action
+            env_actions.append(np.argmax(action.detach().cpu().numpy()))
+
+        # all solver calls of this time step go out together
+        obs, scores, dones, _ = vec_env.step_envs(active, env_actions)
+
+        for k, i in enumerate(active):
+            reward = scores[k]
+            cur_state = torch.from_numpy(obs[k]).to(device=device).reshape(1, state_dim)
+            states[i] = torch.cat([states[i], cur_state], dim=0)
+            if len(rewards[i]) == 1:
+                rewards[i][-1] = torch.from_numpy(np.array(reward)).to(device=device)
+            else:
+                rewards[i][-1] = torch.from_numpy(np.array(reward)).to(device=device) - cur_rtg[i]
+            cur_rtg[i] = torch.from_numpy(np.array(reward)).to(device=device)
+
+            if use_rtg:
+                if mode != 'delayed':
+                    pred_return = target_returns[i][0, -1] - (reward/scale)
+                else:
+                    pred_return = target_returns[i][0, -1]
+                #especially for fdtd
+                if len(rewards[i]) != 1:
+                    pred_return = pred_return + (rewards[i][-2]/scale)
+                target_returns[i] = torch.cat(
+                    [target_returns[i], pred_return.reshape(1, 1)], dim=1)
+                timesteps[i] = torch.cat(
+                    [timesteps[i],
+                     torch.ones((1, 1), device=device, dtype=torch.long) * (t+1)], dim=1)
+
+            episode_return[i] = reward
+            episode_length[i] += 1
+
+        active = [i for k, i in enumerate(active) if not dones[k]]
+
+    return [(episode_return[i], episode_length[i], states[i], rewards[i], target_returns[i]) for i in range(n)]
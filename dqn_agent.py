@@ -0,0 +1,253 @@
+""" DQN agent for optimizing PCSELs, importable without side effects: no env, writer or training run
+    is created at import. optim_PhC.py is the command line driver; vectorized or distributed
+    collectors use the agent directly and pick actions for all their envs in one forward pass.
+
+        agent = DQNAgent(n_actions=16)
+        actions = agent.act(states)          # [N] actions for [N, 8] states
+        agent.push(state, action, next_state, reward)
+        agent.optimize()
+
+    A BackgroundLearner keeps training from the shared replay memory while the env simulates:
+        learner = BackgroundLearner(agent, utd=0.5, publish_every=20).start()
+        ...  # act / push as above, no optimize() calls
+        learner.stop()
+"""
+
+import copy
+import math
+import threading
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+import torch.nn.functional as F
+
+from replay_memory import TensorReplayMemory, PrioritizedReplayMemory
+
+NUM_STATES = 8
+
+
+# create a class for the DQN's policy MLP
+class Net(nn.Module):
+    def __init__(self, num_actions, num_states=NUM_STATES):
+        super(Net, self).__init__()
+        self.num_states = num_states
+        self.fc1 = nn.Linear(num_states, 80)  # just FC, no CNN
+        self.fc2 = nn.Linear(80, 120)
+        self.fc3 = nn.Linear(120, 80)
+        self.fc4 = nn.Linear(80, num_actions)
+
+    def forward(self, x):
+        x = x.to(self.fc1.weight.device)
+        x = x.view(-1, self.num_states)
+        x = F.relu(self.fc1(x))
+        x = F.relu(self.fc2(x))
+        x = F.relu(self.fc3(x))
+        x = self.fc4(x)
+        return x
+
+
+class DQNAgent(object):
+    """
+    Policy and target networks, optimizer and replay memory of the DQN.
+    act() is epsilon greedy over a batch of states with a single forward pass; epsilon decays
+    exponentially with the number of decisions taken (one per state).
+    """
+
+    def __init__(self, n_actions=16, num_states=NUM_STATES, device=None, batch_size=32, gamma=0.999,
+                 eps_start=0.9, eps_end=0.05, eps_decay=200, lr=0.00025, capacity=1500,
+                 prioritized=False, alpha=0.6, beta=0.4, writer=None):
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        self.n_actions = n_actions
+        self.num_states = num_states
+        self.batch_size = batch_size
+        self.gamma = gamma
+        self.eps_start = eps_start
+        self.eps_end = eps_end
+        self.eps_decay = eps_decay
+        self.writer = writer  # optional SummaryWriter for the losses
+
+        self.policy_net = Net(n_actions, num_states).to(self.device)
+        self.target_net = Net(n_actions, num_states).to(self.device)
+        self.target_net.load_state_dict(self.policy_net.state_dict())
+        self.target_net.eval()
+        self.optimizer = optim.RMSprop(self.policy_net.parameters(), lr=lr, alpha=0.95, momentum=0.9)
+
+        if prioritized:
+            self.memory = PrioritizedReplayMemory(capacity, num_states, self.device, alpha=alpha, beta=beta)
+        else:
+            self.memory = TensorReplayMemory(capacity, num_states, self.device)
+        self.steps_done = 0  # counter for decisions taken
+        self.pushed = 0      # transitions stored so far
+        self.last_q = None   # Q values of the last act() call
+        self.actor_net = None  # published copy of policy_net used by act() while a background learner trains
+        self.lock = threading.Lock()  # guards the replay memory shared with a background learner
+
+    def epsilon(self):
+        """exploration rate of the next decision"""
+        return self.eps_end + (self.eps_start - self.eps_end) * math.exp(-1. * self.steps_done / self.eps_decay)
+
+    def act(self, states):
+        """epsilon greedy actions [N] for states [N, num_states] (a single state gives [1])"""
+        if not torch.is_tensor(states):
+            states = torch.as_tensor(np.asarray(states, dtype=np.float32))
+        states = states.to(self.device, torch.float32).view(-1, self.num_states)
+        n = len(states)
+        # per state thresholds, as if the n decisions had been taken one after the other
+        steps = self.steps_done + torch.arange(n, device=self.device, dtype=torch.float32)
+        eps = self.eps_end + (self.eps_start - self.eps_end) * torch.exp(-steps / self.eps_decay)
+        self.steps_done += n
+        net = self.actor_net if self.actor_net is not None else self.policy_net
+        with torch.no_grad():
+            self.last_q = net(states)
+        greedy = self.last_q.max(1)[1]
+        explore = torch.rand(n, device=self.device) <= eps
+        random_actions = torch.randint(0, self.n_actions, (n,), device=self.device)
+        return torch.where(explore, random_actions, greedy)
+
+    def select_action(self, state):
+        """one action as a [1, 1] long tensor, the shape the replay memory stores"""
+        return self.act(state).view(1, 1)
+
+    def push(self, state, action, next_state, reward):
+        with self.lock:
+            self.pushed += 1
+            return self.memory.push(state, action, next_state, reward)
+
+    def optimize(self):
+        """one gradient step on a replay minibatch, returns the loss (None while the memory is too small)"""
+        with self.lock:
+            if len(self.memory) < self.batch_size:
+                return None
+            # sample a batch of transitions, already stacked into tensors (copies) on the device
+            batch = self.memory.sample(self.batch_size)
+
+        # compute Q(s, a)
+        state_action_values = self.policy_net(batch.state).gather(1, batch.action)
+        # Compute V(s')
+        next_state_values = self.target_net(batch.next_state).max(1)[0].detach()  # V' = max(Q')
+        next_state_values = next_state_values.masked_fill(batch.done, 0.)  # V is zero for final state
+        # compute the expected Q values
+        expected_state_action_values = (next_state_values * self.gamma) + batch.reward  # Q_expected = r + gamma*V'
+
+        # cost function, per transition so prioritized samples can be weighted
+        criterion = nn.SmoothL1Loss(reduction='none')
+        losses = criterion(state_action_values, expected_state_action_values.unsqueeze(1)).squeeze(1)
+        if batch.weights is not None:
+            loss = (batch.weights * losses).mean()  # importance sampling correction
+            td_errors = (expected_state_action_values - state_action_values.squeeze(1)).detach()
+            with self.lock:
+                self.memory.update_priorities(batch.indices, td_errors, batch.generations)
+        else:
+            loss = losses.mean()
+
+        # optimize the MLP model
+        self.optimizer.zero_grad()
+        loss.backward()
+        for param in self.policy_net.parameters():
+            # clamp grad values to between -1 and 1
+            param.grad.data.clamp_(-1, 1)
+        self.optimizer.step()
+        if self.writer is not None:
+            self.writer.add_scalar('training/losses', loss.item(), self.steps_done)
+        return loss.item()
+
+    def update_target(self):
+        """copies all weights and biases of the policy network into the target network"""
+        self.target_net.load_state_dict(self.policy_net.state_dict())
+
+
+class BackgroundLearner(object):
+    """
+    Runs agent.optimize() on a background thread, so gradient steps happen while the env simulates.
+    utd caps the update-to-data ratio (gradient steps per stored transition, by default the 1/20 of
+    the inline loop); the thread waits for new data once it is ahead. utd=None removes the cap, an
+    explicit opt-in: the thread then trains back to back on a buffer that grows one transition per
+    simulation. Both cadences count stored transitions, like the inline loop, whatever utd is: the
+    policy weights are copied into agent.actor_net, which act() uses meanwhile, once publish_every
+    new transitions have come in (and the weights changed), and the target network is synced every
+    target_every transitions (one episode of the inline loop by default, which syncs per episode).
+    A failure of the thread is raised by check().
+    """
+
+    def __init__(self, agent, utd=0.05, publish_every=20, target_every=150, poll=0.05):
+        self.agent = agent
+        self.utd = utd
+        self.publish_every = publish_every
+        self.target_every = target_every
+        self.poll = poll
+        self.updates = 0
+        self.published = 0
+        self.synced = 0
+        self.error = None
+        self._published_at = 0   # agent.pushed at the last publication / target sync
+        self._synced_at = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = None
+
+    def publish(self):
+        """hands the actor a snapshot of the current policy weights"""
+        net = copy.deepcopy(self.agent.policy_net)
+        net.eval()
+        self.agent.actor_net = net  # one reference swap, act() never sees a half-copied network
+        self.published += 1
+        self._published_at = self.agent.pushed
+
+    def start(self):
+        self.publish()
+        self._started = time.time()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _budget(self):
+        if self.utd is None:
+            return True
+        return self.updates < self.utd * self.agent.pushed
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                if not self._budget() or self.agent.optimize() is None:
+                    self._stop.wait(self.poll)   # ahead of the data, or not enough of it yet
+                    continue
+                self.updates += 1
+                if self.agent.pushed - self._published_at >= self.publish_every:
+                    self.publish()
+                if self.target_every and self.agent.pushed - self._synced_at >= self.target_every:
+                    self.agent.update_target()
+                    self.synced += 1
+                    self._synced_at = self.agent.pushed
+        except Exception as e:
+            self.error = e
+
+    def check(self):
+        """re-raises the exception that stopped the learner thread, if any"""
+        if self.error is not None:
+            raise RuntimeError('background learner failed after {} updates'.format(self.updates)) from self.error
+
+    def stop(self):
+        """stops the thread, publishes the final weights and re-raises a learner failure"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.check()
+        self.publish()
+
+    def stats(self):
+        """updates done, weights published and the realized update-to-data ratio"""
+        elapsed = time.time() - self._started if self._started else 0.
+        return {
+            'updates': self.updates,
+            'published': self.published,
+            'target_syncs': self.synced,
+            'transitions': self.agent.pushed,
+            'utd': self.updates / self.agent.pushed if self.agent.pushed else 0.,
+            'updates_per_second': self.updates / elapsed if elapsed else 0.,
+        }
@@ -0,0 +1,111 @@
+""" vectorized far-field post-processing: FWHM divergence of every azimuthal cut of a far-field
+    intensity map, for a single design or a whole batch, in one pass without Python loops.
+"""
+
+from functools import lru_cache
+import numpy as np
+
+
+def index_table(coords):
+    """precomputed (start, slope) table mapping fractional sample indices onto coordinates"""
+    coords = np.asarray(coords, dtype=np.float64).ravel()
+    slope = np.append(np.diff(coords), 0.)
+    return coords, slope
+
+
+def index_to_coord(table, indices):
+    """linear interpolation of fractional indices (any shape) into coordinates, any grid size"""
+    coords, slope = table
+    indices = np.clip(np.asarray(indices, dtype=np.float64), 0, len(coords) - 1)
+    base = np.minimum(np.floor(indices).astype(np.int64), len(coords) - 1)
+    return coords[base] + (indices - base) * slope[base]
+
+
+def fwhm_indices(E, rel_height=0.5):
+    """
+    fractional (left, right) indices where the main peak of each 1D profile in E[..., n] drops to
+    rel_height of its maximum, with linear interpolation between samples (as peak_widths does).
+    Profiles without any signal give nan.
+    """
+    E = np.asarray(E, dtype=np.float64)
+    n = E.shape[-1]
+    idx = np.arange(n)
+    peak = np.argmax(E, axis=-1)[..., None]
+    height = rel_height * np.take_along_axis(E, peak, axis=-1)
+    below = E < height
+
+    # last sample below the threshold left of the peak, first one right of it
+    left = np.max(np.where(below & (idx < peak), idx, -1), axis=-1)
+    right = np.min(np.where(below & (idx > peak), idx, n), axis=-1)
+    height = height[..., 0]
+
+    li = np.clip(left, 0, n - 2)
+    e0 = np.take_along_axis(E, li[..., None], axis=-1)[..., 0]
+    e1 = np.take_along_axis(E, li[..., None] + 1, axis=-1)[..., 0]
+    left_ip = np.where(left < 0, 0., li + (height - e0) / np.where(e1 != e0, e1 - e0, 1.))
+
+    ri = np.clip(right, 1, n - 1)
+    e0 = np.take_along_axis(E, ri[..., None] - 1, axis=-1)[..., 0]
+    e1 = np.take_along_axis(E, ri[..., None], axis=-1)[..., 0]
+    right_ip = np.where(right >= n, n - 1., ri - 1 + (e0 - height) / np.where(e0 != e1, e0 - e1, 1.))
+
+    empty = height[...] <= 0
+    return np.where(empty, np.nan, left_ip), np.where(empty, np.nan, right_ip)
+
+
+def divergence_from_profiles(E, coords):
+    """full divergence angle in degrees of profiles E[..., n] sampled at direction cosines coords"""
+    table = index_table(coords)
+    left_ip, right_ip = fwhm_indices(E)
+    half_width = (index_to_coord(table, right_ip) - index_to_coord(table, left_ip)) / 2
+    half_width = np.where(np.isnan(left_ip), np.nan, half_width)
+    return np.degrees(np.arcsin(np.clip(half_width, 0., 1.))) * 2
+
+
+class FarFieldGrid(object):
+    """
+    Sampling tables for one (ux, uy) far-field grid, built once and reused for every map on it.
+    E2[..., i, j] is the intensity at (ux[i], uy[j]); slices() resamples it bilinearly along
+    n_phi diameters at azimuth phi in [0, 180) degrees, divergence() gives the FWHM divergence
+    of each of them, shape (..., n_phi).
+    """
+
+    def __init__(self, ux, uy, n_phi=36, n_samples=None):
+        ux = np.asarray(ux, dtype=np.float64).ravel()
+        uy = np.asarray(uy, dtype=np.float64).ravel()
+        self.shape = (len(ux), len(uy))
+        if n_samples is None:
+            n_samples = max(self.shape)
+        self.phi = np.arange(n_phi) * np.pi / n_phi
+        s_max = min(np.abs(ux).max(), np.abs(uy).max())
+        self.s = np.linspace(-s_max, s_max, n_samples)
+
+        x = self.s[None, :] * np.cos(self.phi)[:, None]
+        y = self.s[None, :] * np.sin(self.phi)[:, None]
+        fx = np.interp(x, ux, np.arange(len(ux)))
+        fy = np.interp(y, uy, np.arange(len(uy)))
+        self.i0 = np.clip(np.floor(fx).astype(np.int64), 0, len(ux) - 2)
+        self.j0 = np.clip(np.floor(fy).astype(np.int64), 0, len(uy) - 2)
+        self.wx = fx - self.i0
+        self.wy = fy - self.j0
+
+    def slices(self, E2):
+        E2 = np.asarray(E2, dtype=np.float64)
+        i0, j0, wx, wy = self.i0, self.j0, self.wx, self.wy
+        return ((1 - wx) * (1 - wy) * E2[..., i0, j0] + wx * (1 - wy) * E2[..., i0 + 1, j0]
+                + (1 - wx) * wy * E2[..., i0, j0 + 1] + wx * wy * E2[..., i0 + 1, j0 + 1])
+
+    def divergence(self, E2):
+        return divergence_from_profiles(self.slices(E2), self.s)
+
+
+@lru_cache(maxsize=16)
+def _grid(ux, uy, n_phi):
+    return FarFieldGrid(np.frombuffer(ux), np.frombuffer(uy), n_phi)
+
+
+def grid_for(ux, uy, n_phi=36):
+    """FarFieldGrid for these coordinates, cached so repeated analyses skip the table setup"""
+    ux = np.asarray(ux, dtype=np.float64).ravel()
+    uy = np.asarray(uy, dtype=np.float64).ravel()
+    return _grid(ux.tobytes(), uy.tobytes(), n_phi)
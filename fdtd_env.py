@@ -3,7 +3,12 @@ custom gym environment developed for invoking FDTD simulations used in DQN.
 Author: Renjie Li. March 2023 @ NOEL.
 """
 
-import FdtdRlNanobeam
+from FdtdRlNanobeam import FdtdRlNanobeam, FailedResult, check_outcome
+from transition import TransitionKernel
+from reward import score as score_metrics, WEIGHTS
+from instrumentation import StepTimer
+from sim_cache import FULL
+from surrogate import SURROGATE
 import random
 import gym
 from gym import spaces, logger
@@ -11,6 +16,8 @@ from gym import utils
 from gym.utils import seeding
 from collections import namedtuple, deque
 from itertools import count
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import subprocess, time, signal
 import numpy as np
 import sys
@@ -20,6 +27,32 @@ import os
 # sys.path.append(os.path.dirname(__file__))  # Current directory
 
 
+# a design an episode can be (re)started from: state plus its metrics when known
+EnvSnapshot = namedtuple('EnvSnapshot', ('state', 'metrics'))
+
+# policies for moves that leave the design box, see FdtdEnv.__init__
+OUT_OF_BOUNDS = ('terminate', 'reject', 'simulate')
+
+
+# fidelity label of the penalty results given to geometrically degenerate designs
+INFEASIBLE = 'infeasible'
+
+# fidelity label of the fallback results of designs the solver failed on; they are never cached
+FAILED = 'failed'
+
+
+def design_args(state):
+    """FdtdRlNanobeam arguments (SI units) of a state in nm / index units"""
+    netDLen, netDT, netDT1, netDT3, netDN1, netDN3, netDLeng, netDA = state
+    c = 1e-9  # define conversion from m to nm
+    return netDLen*c, netDT*c, netDT1*c, netDT3*c, netDN1, netDN3, netDLeng, netDA*c
+
+
+def simulate_state(FR, state):
+    """runs one design (state in nm / index units) through an FdtdRlNanobeam instance"""
+    return FR.adjustdesignparams(*design_args(state))
+
+
 class FdtdEnv(gym.Env):
     """
     Makes changes to the physical parameters of PCSEL to optimize optical responses.
@@ -75,7 +108,8 @@ class FdtdEnv(gym.Env):
 
     metadata = {'render.modes': ['human']}
 
-    def __init__(self):
+    def __init__(self, cache=None, solver=None, backend=None, quiet=False, timer=None, fidelity=None,
+                 surrogate=None, out_of_bounds='terminate', oob_penalty=0., speculator=None):
         # limits for net geometrical changes (states). Less important variables are commented out.
         self.maxDeltaLen = 1000  # 2000E-9  #width
         self.maxDeltaT = 100    # 450E-9
@@ -96,6 +130,12 @@ class FdtdEnv(gym.Env):
         self.deltaTA = 2.5
         self.deltaN = 0.005 #for n and leng
 
+        # vectorized action decoding and bounds checks (see transition.py)
+        self.kernel = TransitionKernel(
+            (self.maxDeltaLen, self.maxDeltaT, self.maxDeltaT1, self.maxDeltaT3,
+             self.maxDeltaN1, self.maxDeltaN3, self.maxDeltaLeng, self.maxDeltaA),
+            self.deltaLen, self.deltaTA, self.deltaN)
+
         high = np.array(
             [
                 self.maxDeltaLen * 1.5,
@@ -129,119 +169,155 @@ class FdtdEnv(gym.Env):
         self.lam_goal = 1310.0   #or 980 nm
         self.P_goal = 0.3    #output power/injecting power >= 30% 
         self.div_goal = 1.0    # divergence angle <= 1 degree
+
+        # weights of the five score terms: gamma (Q), eps (lambda), beta (area), alpha (power), eta (divergence)
+        self.reward_weights = dict(WEIGHTS)
         
+        # optional persistent result cache (see sim_cache.SimCache), shared across envs and runs
+        self.cache = cache
+
+        # one solver object per env, so its warm FDTD session is reused across steps;
+        # backend='numpy' swaps FDTD for the local model in backends.py
+        self.FR = solver if solver is not None else FdtdRlNanobeam(backend=backend)
+
+        # per-step phase timings (see instrumentation.py); quiet=True silences the per-step prints
+        self.timer = timer if timer is not None else StepTimer()
+        if getattr(self.FR, 'timer', None) is None:
+            self.FR.timer = self.timer
+        self.quiet = quiet
+
+        # optional fidelity.FidelityLadder: cheap simulations first, full fidelity for promising designs only
+        self.fidelity = fidelity
+        if fidelity is not None:
+            for rung in fidelity.solvers:
+                if getattr(rung, 'timer', None) is None:
+                    rung.timer = self.timer
+        self.last_fidelity = FULL   # fidelity of the latest simulate() result
+
+        # optional surrogate.Surrogate: learns from every solver result, answers instead of the
+        # solver once it is confident (those results are labelled 'surrogate' and not cached)
+        self.surrogate = surrogate
+
+        # checkdesign outcomes of every design this env evaluated, whichever way it was then
+        # answered: cache, solver, fidelity ladder, surrogate, speculation or a vec env worker
+        self.feasibility_counts = {}
+
+        # what an out-of-range move does, decided before any simulation:
+        #   'terminate' ends the episode, 'reject' keeps the current design and goes on,
+        #   'simulate' runs the solver on it first (the original behaviour).
+        # the first two score the move as the last simulated score minus oob_penalty
+        if out_of_bounds not in OUT_OF_BOUNDS:
+            raise ValueError('out_of_bounds must be one of {}, got {!r}'.format(OUT_OF_BOUNDS, out_of_bounds))
+        self.out_of_bounds = out_of_bounds
+        self.oob_penalty = oob_penalty
+        self.last_score = 0.
+        self.last_metrics = None
+
+        # optional speculative.SpeculativeScheduler pre-simulating the neighbours of every new state;
+        # action_probs(obs) -> [16] probabilities, when set, ranks them by the policy
+        self.speculator = speculator
+        self.action_probs = None
+        if speculator is not None and speculator.check is None:
+            speculator.check = self.feasible   # degenerate neighbours are not worth a solver run
+
         #other setup
         #self.seed()
         self.viewer = None
         self.state = None
         self.steps_beyond_done = None
 
+        # background simulation for step_async / step_wait
+        self._executor = None
+        self._pending = None
+
     def step(self, action):
+        state = self.propose(action)
+        if self.skips(state):
+            return self.reject(state)
+
+        # perform an action in fdtd and compute Q factor
+        metrics = self.simulate(state)
+
+        return self.commit(state, metrics)
+
+    def step_async(self, action):
+        """starts simulating the outcome of action in the background; collect it with step_wait()"""
+        assert self._pending is None, 'step_async called again before step_wait'
+        state = self.propose(action)
+        future = None
+        if not self.skips(state):
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            future = self._executor.submit(self.simulate, state)
+        self._pending = (state, future)
+
+    def step_wait(self, timeout=None):
+        """blocks until the simulation started by step_async is done, returns (obs, score, done, info)"""
+        assert self._pending is not None, 'step_wait called without step_async'
+        state, future = self._pending
+        if future is None:
+            self._pending = None
+            return self.reject(state)
+        metrics = future.result(timeout)
+        self._pending = None
+        return self.commit(state, metrics)
+
+    async def astep(self, action):
+        """awaitable step, the event loop keeps running while the solver works"""
+        self.step_async(action)
+        state, future = self._pending
+        if future is None:
+            return self.step_wait()
+        metrics = await asyncio.wrap_future(future)
+        self._pending = None
+        return self.commit(state, metrics)
+
+    def propose(self, action):
+        """returns the state reached by taking action from the current state, without simulating it"""
         err_msg = "%r (%s) invalid" % (action, type(action))
         assert self.action_space.contains(action), err_msg
 
-        netDLen, netDT, netDT1, netDT3, netDN1, netDN3, netDLeng, netDA = self.state
-
-        if action == 0:
-            netDLen = netDLen + self.deltaLen
-
-        elif action == 1:
-            netDLen = netDLen - self.deltaLen
-
-        elif action == 2:
-            netDT = netDT + self.deltaTA
-
-        elif action == 3:
-            netDT = netDT - self.deltaTA
-
-        elif action == 4:
-            netDT1 = netDT1 + self.deltaTA
-
-        elif action == 5:
-            netDT1 = netDT1 - self.deltaTA
-
-        elif action == 6:
-            netDT3 = netDT3 + self.deltaTA
-
-        elif action == 7:
-            netDT3 = netDT3 - self.deltaTA
-
-        elif action == 8:
-            netDN1 = netDN1 + self.deltaN
-
-        elif action == 9:
-            netDN1 = netDN1 - self.deltaN
-
-        elif action == 10:
-            netDN3 = netDN3 + self.deltaN
-
-        elif action == 11:
-            netDN3 = netDN3 - self.deltaN
-
-        elif action == 12:
-            netDLeng = netDLeng + self.deltaN
-
-        elif action == 13:
-            netDLeng = netDLeng - self.deltaN
-        
-        elif action == 14:
-            netDA = netDA + self.deltaTA
-
-        elif action == 15:
-            netDA = netDA - self.deltaTA
-
-        # perform an action in fdtd and compute Q factor
-        FR = FdtdRlNanobeam()
-        c = 1e-9  # define conversion from m to nm
-        Q, lam, power, area, div_angle = FR.adjustdesignparams(netDLen*c, netDT*c, netDT1*c, netDT3*c, netDN1, netDN3, netDLeng, netDA*c)
+        return tuple(self.kernel.apply(self.state, action).tolist())
+
+    def skips(self, state):
+        """True when the proposed state is out of range and the out_of_bounds policy spares the solver"""
+        return self.out_of_bounds != 'simulate' and bool(self.kernel.done(state))
+
+    def reject(self, state):
+        """outcome of an out-of-range move without simulating it, returns (obs, score, done, info)"""
+        score = np.float32(self.last_score - self.oob_penalty)
+        done = self.out_of_bounds == 'terminate'
+        if done:
+            self.state = state
+            if self.steps_beyond_done is None:
+                self.steps_beyond_done = 0
+                if not self.quiet:
+                    print('State out of range, done! Restarting a new episode...')
+
+        # oob_penalty marks the step as rejected, so offline relabeling (reward.py) scores it the same way;
+        # the metrics row is that of the last simulated design (NaN before the first), one row per step
+        info = {'out_of_bounds': True, 'fidelity': None, 'oob_penalty': float(self.oob_penalty)}
+        info['metrics'] = self.last_metrics if self.last_metrics is not None else (np.nan,) * 5
+        info['timings'] = self.timer.end_step()
+        return np.array(self.state, dtype=np.float32), score, done, info
+
+    def commit(self, state, metrics):
+        """moves the env to a proposed state given its simulated metrics, returns (obs, score, done, info)"""
+        Q, lam, power, area, div_angle = metrics
 
         # update the state
-        self.state = (netDLen, netDT, netDT1, netDT3, netDN1, netDN3, netDLeng, netDA)
-
-        done = bool(
-            netDLen < -self.maxDeltaLen
-            or netDLen > self.maxDeltaLen
-            or netDT < -self.maxDeltaT
-            or netDT > self.maxDeltaT
-            or netDT1 < -self.maxDeltaT1
-            or netDT1 > self.maxDeltaT1
-            or netDT3 < -self.maxDeltaT3
-            or netDT3 > self.maxDeltaT3
-            or netDN1 < -self.maxDeltaN1
-            or netDN1 > self.maxDeltaN1
-            or netDN3 < -self.maxDeltaN3
-            or netDN3 > self.maxDeltaN3
-            or netDLeng < -self.maxDeltaLeng
-            or netDLeng > self.maxDeltaLeng
-            or netDA < -self.maxDeltaA
-            or netDA > self.maxDeltaA
-        )
+        self.state = state
 
-        gamma = 1
-        eps = 1 
-        beta = 100
-        alpha = 100
-        eta = 20
-        # calculate the score
-        if not done:
-            r1 = gamma * (1 - (self.Q_goal - Q) / self.Q_goal)
-            r2 = eps / (1 - abs(self.lam_goal - lam) / self.lam_goal)
-            r3 = beta * (1 - (self.area_goal - area) / self.area_goal)
-            r4 = alpha * (1 - (self.P_goal- power) / self.P_goal)
-            r5 = eta * (1 + (self.div_goal - div_angle) / self.div_goal)
-            r_total = r1 + r2 + r3 + r4 + r5
-            score = np.float32(r_total)
-        elif self.steps_beyond_done is None:
+        done = bool(self.kernel.done(state))
+
+        # calculate the score (see reward.py)
+        with self.timer.phase('reward'):
+            score = self.score(metrics)
+        if done and self.steps_beyond_done is None:
             # net changes out of limit, game over
             self.steps_beyond_done = 0
-            r1 = gamma * (1 - (self.Q_goal - Q) / self.Q_goal)
-            r2 = eps / (1 - abs(self.lam_goal - lam) / self.lam_goal)
-            r3 = beta * (1 - (self.area_goal - area) / self.area_goal)
-            r4 = alpha * (1 - (self.P_goal- power) / self.P_goal)
-            r5 = eta * (1 + (self.div_goal - div_angle) / self.div_goal)
-            r_total = r1 + r2 + r3 + r4 + r5
-            score = np.float32(r_total)
-            print('State out of range, done! Restarting a new episode...')
+            if not self.quiet:
+                print('State out of range, done! Restarting a new episode...')
 
         # if not done:
         #     r1 = gamma * (50 - (self.Q_goal - Q) * 1e-5)
@@ -263,17 +339,236 @@ class FdtdEnv(gym.Env):
         #     score = np.float32(r_total)
         #     print('State out of range, done! Restarting a new episode...')
 
-        print('\nQ factor: {:.3f}, resonance lambda: {:.2f}, power: {:.4f}, area: {:.4e}, divergence: {:.4f}\n'.format(Q, lam, power,area, div_angle))
+        with self.timer.phase('bookkeeping'):
+            if not self.quiet:
+                print('\nQ factor: {:.3f}, resonance lambda: {:.2f}, power: {:.4f}, area: {:.4e}, divergence: {:.4f}\n'.format(Q, lam, power,area, div_angle))
 
-        print('score: {:.5f}, state: {}\n'.format(score, self.state))
+                print('score: {:.5f}, state: {}\n'.format(score, self.state))
 
-        return np.array(self.state, dtype=np.float32), score, done, {}
+            # raw metrics go out with every step so logged data can be rescored offline (reward.py)
+            info = {'metrics': (float(Q), float(lam), float(power), float(area), float(div_angle))}
+            self.last_score = float(score)
+            self.last_metrics = info['metrics']
+        info['fidelity'] = self.last_fidelity
+        info['timings'] = self.timer.end_step()
+        obs = np.array(self.state, dtype=np.float32)
+        if not done:
+            self.speculate(obs)
+        return obs, score, done, info
+
+    def reward_goals(self):
+        return {'Q_goal': self.Q_goal, 'lam_goal': self.lam_goal, 'area_goal': self.area_goal,
+                'P_goal': self.P_goal, 'div_goal': self.div_goal}
+
+    def score(self, metrics):
+        return score_metrics(metrics, self.reward_goals(), self.reward_weights)
+
+    def speculate(self, obs=None, probs=None):
+        """(re)starts speculative simulation of the current state's neighbours, ranked by probs"""
+        if self.speculator is None:
+            return
+        if probs is None and self.action_probs is not None:
+            probs = self.action_probs(obs if obs is not None else np.array(self.state, dtype=np.float32))
+        self.speculator.speculate(self.state, probs)
+
+    def simulate(self, state):
+        """returns (Q, lam, power, area, div_angle) for a state, from the cache when it has been simulated before"""
+        result = self.lookup(state)
+        if result is not None:
+            return result
+
+        if self.surrogate is not None:
+            with self.timer.phase('bookkeeping'):
+                result = self.surrogate.answer(state)
+            if result is not None:
+                self.last_fidelity = SURROGATE
+                return result
+
+        if self.fidelity is not None:
+            result, fidelity = self.fidelity.evaluate(state, simulate_state, self.score)
+        else:
+            result, fidelity = simulate_state(self.FR, state), FULL
+        self.record(state, result, fidelity)
+        return result
+
+    def lookup(self, state):
+        """ the result of a state that needs no simulation: the penalty result of a degenerate design
+            (cached as such), a speculated one or a cached one. None when the state has to be simulated
+        """
+        # degenerate geometry gets the solver's penalty result straight away; the check is analytic,
+        # so it runs (and is counted) for every design, cached or not
+        if hasattr(self.FR, 'checkdesign'):
+            errors, warnings = self.FR.checkdesign(*design_args(state))
+            key = check_outcome(errors, warnings)
+            self.feasibility_counts[key] = self.feasibility_counts.get(key, 0) + 1
+            if errors:
+                self.last_fidelity = INFEASIBLE
+                result = self.FR.infeasible_result
+                if self.cache is not None:
+                    with self.timer.phase('bookkeeping'):
+                        if state not in self.cache:
+                            self.cache.put(state, result, INFEASIBLE)
+                return result
+
+        if self.speculator is not None:
+            # before the cache, which the speculation has written to as well, so that claiming it
+            # settles the speculation as used; only feasible designs get here, so it is a full simulation
+            result = self.speculator.claim(state)
+            if result is not None:
+                self.last_fidelity = FULL
+                return result
+
+        if self.cache is not None:
+            with self.timer.phase('bookkeeping'):
+                entry = self.cache.get_entry(state)
+            if entry is not None:
+                result, self.last_fidelity = entry
+                return result
+        return None
+
+    def feasible(self, state):
+        """True unless checkdesign rejects the state, nothing is counted"""
+        if not hasattr(self.FR, 'checkdesign'):
+            return True
+        return not self.FR.checkdesign(*design_args(state))[0]
+
+    def record(self, state, result, fidelity):
+        """ keeps a freshly simulated result: cached with its fidelity, and taught to the surrogate.
+            A FailedResult is only labelled FAILED, the design gets another chance in later runs
+        """
+        if isinstance(result, FailedResult):
+            self.last_fidelity = FAILED
+            return
+        self.last_fidelity = fidelity
+        with self.timer.phase('bookkeeping'):
+            if self.cache is not None:
+                self.cache.put(state, result, fidelity)
+            if self.surrogate is not None:
+                self.surrogate.update(state, result)
+
+    def get_metrics(self):
+        """wall time summary of the recorded steps per phase, plus cache counters when caching"""
+        metrics = {'timings': self.timer.summary()}
+        if self.cache is not None:
+            metrics['cache'] = self.cache.stats()
+        if self.fidelity is not None:
+            metrics['fidelity'] = self.fidelity.stats()
+        if self.surrogate is not None:
+            metrics['surrogate'] = self.surrogate.stats()
+        if self.speculator is not None:
+            metrics['speculation'] = self.speculator.stats()
+        if self.feasibility_counts:
+            metrics['feasibility'] = dict(self.feasibility_counts)
+        backend = getattr(self.FR, 'backend', None)
+        if hasattr(backend, 'stats'):
+            # e.g. the watchdog's timeouts, retries and quarantine
+            metrics[backend.name or 'backend'] = backend.stats()
+        return metrics
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def reset(self, seed=None, options=None):
+        """ back to the start design, or branch from any design reached before with
+            options={'state': s} (metrics looked up in the cache, or given as options['metrics'])
+            or options={'snapshot': snapshot()}
+        """
+        options = options or {}
+        if seed is not None:
+            self.np_random, _ = seeding.np_random(seed)
+        if 'snapshot' in options:
+            return self.restore(options['snapshot'])
+        if 'state' in options:
+            state = tuple(float(v) for v in options['state'])
+            metrics = options.get('metrics')
+            if metrics is None and self.cache is not None:
+                entry = self.cache.get_entry(state)
+                if entry is not None:
+                    metrics = entry[0]
+            return self.restore(EnvSnapshot(state, metrics))
 
-    def reset(self):
         # self.state = np.zeros((4,), dtype=np.float32)
         self.state = (self.len, self.t, self.t1, self.t3, self.n1, self.n3, self.leng, self.a)
         self.steps_beyond_done = None
-        return np.array(self.state, dtype=np.float32)
+        self.last_score = 0.
+        self.last_metrics = None
+        obs = np.array(self.state, dtype=np.float32)
+        self.speculate(obs)
+        return obs
+
+    def snapshot(self):
+        """the current design and its metrics, to branch from later with restore() / reset(options=...)"""
+        return EnvSnapshot(self.state, self.last_metrics)
+
+    def restore(self, snapshot):
+        """starts a new episode at a snapshot without simulating anything, returns the observation"""
+        state = tuple(float(v) for v in snapshot.state)
+        if self.kernel.done(state):
+            raise ValueError('cannot start an episode out of range: {}'.format(state))
+        self.state = state
+        self.steps_beyond_done = None
+        if snapshot.metrics is not None:
+            self.last_metrics = tuple(float(v) for v in snapshot.metrics)
+            self.last_score = float(self.score(self.last_metrics))
+        else:
+            self.last_metrics = None
+            self.last_score = 0.
+        obs = np.array(self.state, dtype=np.float32)
+        self.speculate(obs)
+        return obs
+
+    def best_snapshots(self, n=1):
+        """the n best scoring in-range designs of the cache under the current goals and weights"""
+        if self.cache is None:
+            return []
+        entries = [(state, metrics) for state, metrics, fidelity in self.cache.items()
+                   if fidelity != INFEASIBLE and not self.kernel.done(state)]
+        if not entries:
+            return []
+        scores = self.score(np.array([metrics for _, metrics in entries]))
+        scores = np.where(np.isfinite(scores), scores, -np.inf)
+        return [EnvSnapshot(*entries[i]) for i in np.argsort(-scores, kind='stable')[:n]]
+
+
+class FdtdEnv_v1(FdtdEnv):
+    """
+    Continuous-action FdtdEnv: every step moves all 8 design parameters at once, so one solver
+    call covers much more of the design space (used by sac/sac_pcsel.py).
+
+    Actions:
+    Type: Box(8), every component in [-1, 1]
+    component k moves state variable k by action[k] * trust_region[k]. The trust region defaults
+    to trust_steps lattice steps of the discrete env per parameter (deltaLen for the width,
+    deltaTA for thicknesses and pitch, deltaN for indices and radius). snap=True rounds the move
+    to whole lattice steps, so results are shared with the discrete env through the SimCache.
+    snap=False leaves the lattice; the SimCache (and the speculator, which goes through it) keys
+    designs by lattice point, so they are refused then.
+
+    Reward, termination, out-of-range handling, caching etc. are those of FdtdEnv.
+    """
+
+    def __init__(self, trust_region=None, trust_steps=4, snap=True, **kwargs):
+        if not snap and (kwargs.get('cache') is not None or kwargs.get('speculator') is not None):
+            raise ValueError('snap=False designs are off the lattice the SimCache keys on, '
+                             'a cache or speculator would return the results of neighbouring designs')
+        super(FdtdEnv_v1, self).__init__(**kwargs)
+        if trust_region is None:
+            trust_region = trust_steps * self.kernel.steps
+        self.trust_region = np.asarray(trust_region, dtype=np.float64)
+        self.snap = snap
+        self.action_space = spaces.Box(-1., 1., shape=self.trust_region.shape, dtype=np.float32)
+
+    def propose(self, action):
+        action = np.asarray(action, dtype=np.float64)
+        err_msg = "%r (%s) invalid" % (action, type(action))
+        assert action.shape == self.action_space.shape, err_msg
+        # tanh squashed policies can overshoot the box by rounding
+        move = np.clip(action, -1., 1.) * self.trust_region
+        if self.snap:
+            move = np.rint(move / self.kernel.steps) * self.kernel.steps
+        return tuple((np.asarray(self.state, dtype=np.float64) + move).tolist())
 
 
 
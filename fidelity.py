@@ -0,0 +1,169 @@
+""" multi-fidelity evaluation for FdtdEnv: every design is simulated on the cheapest rung of a
+    fidelity ladder first and only promoted to the expensive rungs when it looks promising.
+    Results of a lower rung are mapped onto the top rung with a running bias correction learned
+    from the designs that were simulated on both, so the rewards an agent sees stay on one scale.
+
+        env = FdtdEnv(fidelity=numpy_ladder(rule=TopKPromotion(k=10)))
+"""
+
+import heapq
+import time
+from collections import namedtuple
+import numpy as np
+
+from sim_cache import FULL
+from backends import NumpyBackend
+from FdtdRlNanobeam import FdtdRlNanobeam, FailedResult
+
+# one rung: a label stored with every result it produces, and the FdtdRlNanobeam that runs it
+Fidelity = namedtuple('Fidelity', ('name', 'solver'))
+
+
+FEATURES = ('log_Q', 'lam', 'power', 'log_area', 'div_angle')
+
+
+def to_features(metrics):
+    """(Q, lam, power, area, div_angle) -> space in which the rung-to-rung bias is additive (log Q, log area)"""
+    Q, lam, power, area, div_angle = (float(v) for v in metrics)
+    return np.array([np.log(max(Q, 1e-30)), lam, power, np.log(max(area, 1e-30)), div_angle])
+
+
+def from_features(x):
+    return (float(np.exp(x[0])), float(x[1]), float(x[2]), float(np.exp(x[3])), float(x[4]))
+
+
+class BiasCorrection(object):
+    """ running mean of (higher rung - lower rung) in feature space; turns into an exponential
+        average after `horizon` pairs so it follows the bias as the search moves to other designs
+    """
+
+    def __init__(self, horizon=100):
+        self.horizon = horizon
+        self.count = np.zeros(5)
+        self.mean = np.zeros(5)
+
+    def update(self, low, high):
+        diff = to_features(high) - to_features(low)
+        ok = np.isfinite(diff)   # a failed divergence fit (nan) must not poison the other terms
+        self.count[ok] += 1
+        rate = 1. / np.minimum(self.count[ok], self.horizon)
+        self.mean[ok] += rate * (diff[ok] - self.mean[ok])
+
+    def apply(self, x):
+        return x + self.mean
+
+
+class TopKPromotion(object):
+    """ promotes a design when its predicted (bias corrected) score reaches the k-th best score seen
+        at the top rung; everything is promoted until k designs have been simulated at full fidelity
+    """
+
+    def __init__(self, k=10, margin=0.):
+        self.k = k
+        self.margin = margin
+        self.best = []   # min-heap of the k best top rung scores
+
+    def __call__(self, level, predicted):
+        if len(self.best) < self.k:
+            return True
+        return predicted >= self.best[0] - self.margin
+
+    def record(self, score):
+        if not np.isfinite(score):
+            return
+        if len(self.best) < self.k:
+            heapq.heappush(self.best, score)
+        else:
+            heapq.heappushpop(self.best, score)
+
+
+class FidelityLadder(object):
+    """
+    Rungs cheapest first, the last one is the reference fidelity the rewards are expressed in.
+    evaluate(state, simulate, score_fn) runs the design up the ladder while rule(level, predicted)
+    says so and returns (metrics, fidelity name). Metrics from a lower rung come back bias corrected;
+    the raw pairs of every promotion keep the corrections up to date.
+    """
+
+    def __init__(self, levels, rule=None, horizon=100):
+        self.levels = [level if isinstance(level, Fidelity) else Fidelity(*level) for level in levels]
+        self.rule = rule if rule is not None else TopKPromotion()
+        self.corrections = [BiasCorrection(horizon) for _ in self.levels[:-1]]   # rung i -> i+1
+        self.simulations = np.zeros(len(self.levels), dtype=np.int64)
+        self.finals = np.zeros(len(self.levels), dtype=np.int64)   # designs whose answer came from rung i
+        self.seconds = np.zeros(len(self.levels))
+
+    @property
+    def names(self):
+        return [level.name for level in self.levels]
+
+    @property
+    def solvers(self):
+        return [level.solver for level in self.levels]
+
+    def corrected(self, level, metrics):
+        """metrics of rung `level` mapped onto the top rung"""
+        x = to_features(metrics)
+        for correction in self.corrections[level:]:
+            x = correction.apply(x)
+        return from_features(x)
+
+    def evaluate(self, state, simulate, score_fn):
+        top = len(self.levels) - 1
+        previous = None
+        for level, (name, solver) in enumerate(self.levels):
+            start = time.perf_counter()
+            raw = simulate(solver, state)
+            if isinstance(raw, FailedResult):
+                # nothing to learn from, and no point promoting it: FdtdEnv labels it failed
+                self.seconds[level] += time.perf_counter() - start
+                return raw, name
+            raw = tuple(float(v) for v in raw)
+            self.seconds[level] += time.perf_counter() - start
+            self.simulations[level] += 1
+            if previous is not None:
+                self.corrections[level - 1].update(previous, raw)
+            previous = raw
+
+            if level == top:
+                self.rule.record(float(score_fn(raw)))
+                break
+            metrics = self.corrected(level, raw)
+            if not self.rule(level, float(score_fn(metrics))):
+                self.finals[level] += 1
+                return metrics, name
+        self.finals[top] += 1
+        return raw, self.levels[top].name
+
+    def stats(self):
+        """solver calls, wall time and promotion rates per rung, and the current corrections"""
+        ran = np.maximum(self.simulations, 1)
+        return {
+            'levels': self.names,
+            'simulations': self.simulations.tolist(),
+            'finals': self.finals.tolist(),
+            'solver_seconds': self.seconds.tolist(),
+            'promotion_rate': (self.simulations[1:] / ran[:-1]).tolist(),
+            'bias': [dict(zip(FEATURES, c.mean.tolist())) for c in self.corrections],
+        }
+
+
+def numpy_ladder(rule=None, n_scan=40, n_iter=1):
+    """coarse and full NumpyBackend, a fast stand-in for the FDTD ladder"""
+    return FidelityLadder([
+        Fidelity('coarse', FdtdRlNanobeam(backend=NumpyBackend(n_scan=n_scan, n_iter=n_iter))),
+        Fidelity(FULL, FdtdRlNanobeam(backend='numpy')),
+    ], rule)
+
+
+def lumerical_ladder(rule=None, mesh_accuracy=1, simulation_time=None, sessions=None):
+    """ coarse mesh (and optionally shorter run time) FDTD below the project's own settings. Both rungs
+        share one warm session, switching rung only pushes the changed solver settings
+    """
+    full = FdtdRlNanobeam(sessions=sessions)
+    coarse = FdtdRlNanobeam(sessions=full.sessions)
+    coarse.solver_defaults = full.solver_defaults
+    coarse.solver_settings["mesh accuracy"] = mesh_accuracy
+    if simulation_time is not None:
+        coarse.solver_settings["simulation time"] = simulation_time
+    return FidelityLadder([Fidelity('coarse', coarse), Fidelity(FULL, full)], rule)
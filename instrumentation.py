@@ -0,0 +1,96 @@
+""" per-step wall time instrumentation for FdtdEnv: each step is split into phases, the last
+    `capacity` steps are kept in a ring buffer and summarised as percentiles and log-spaced histograms.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+
+# solver setup (session, parameter push), solver run, result analysis, scoring, everything else
+PHASES = ('setup', 'run', 'analysis', 'reward', 'bookkeeping')
+
+# histogram bin edges in seconds, 1 us .. 10^4 s
+HIST_EDGES = np.logspace(-6, 4, 21)
+
+
+class StepTimer(object):
+    """ accumulates phase times of the step in progress; end_step() files them into the ring buffer
+    """
+
+    def __init__(self, capacity=4096, phases=PHASES):
+        self.phases = tuple(phases)
+        self.capacity = capacity
+        self.buffer = np.zeros((capacity, len(self.phases)))
+        self.steps = 0
+        self._index = {name: i for i, name in enumerate(self.phases)}
+        self._current = np.zeros(len(self.phases))
+        self._lock = threading.Lock()   # simulate() may run on the step_async thread
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self._current[self._index[name]] += seconds
+
+    def end_step(self):
+        """closes the current step and returns its {phase: seconds}"""
+        with self._lock:
+            row = self._current
+            self._current = np.zeros(len(self.phases))
+            self.buffer[self.steps % self.capacity] = row
+            self.steps += 1
+        return dict(zip(self.phases, row.tolist()))
+
+    def history(self):
+        """recorded steps in order, [min(steps, capacity), n_phases]"""
+        n = min(self.steps, self.capacity)
+        if self.steps <= self.capacity:
+            return self.buffer[:n].copy()
+        start = self.steps % self.capacity
+        return np.concatenate([self.buffer[start:], self.buffer[:start]])
+
+    def summary(self):
+        """per phase statistics over the buffered steps, plus the share of wall time each phase takes"""
+        hist = self.history()
+        out = {'steps': self.steps, 'window': len(hist), 'phases': {}}
+        if not len(hist):
+            return out
+        total = hist.sum()
+        for i, name in enumerate(self.phases):
+            t = hist[:, i]
+            counts, _ = np.histogram(t[t > 0], bins=HIST_EDGES)
+            out['phases'][name] = {
+                'mean': float(t.mean()),
+                'p50': float(np.percentile(t, 50)),
+                'p90': float(np.percentile(t, 90)),
+                'p99': float(np.percentile(t, 99)),
+                'max': float(t.max()),
+                'total': float(t.sum()),
+                'share': float(t.sum() / total) if total > 0 else 0.,
+                'histogram': counts.tolist(),
+            }
+        out['histogram_edges'] = HIST_EDGES.tolist()
+        return out
+
+    def reset(self):
+        with self._lock:
+            self.buffer[:] = 0
+            self.steps = 0
+            self._current[:] = 0
+
+
+@contextmanager
+def timed(timer, name):
+    """timer.phase(name), or nothing when there is no timer"""
+    if timer is None:
+        yield
+    else:
+        with timer.phase(name):
+            yield
@@ -0,0 +1,433 @@
+""" design evaluation job queue: trainers submit designs to a SQLite broker and get futures back,
+    worker daemons on any host that sees the broker file pull jobs, simulate them with their own
+    FdtdRlNanobeam (and warm session) and post the results. Solver capacity is pooled across
+    machines instead of being pinned to one trainer.
+
+    worker daemon, one per solver seat:
+        python job_queue.py worker --broker /shared/fdtd_jobs.sqlite
+    trainer side, FDTD calls go through the queue:
+        env = FdtdEnv(backend=QueueBackend('/shared/fdtd_jobs.sqlite'))
+    tests / single box, broker plus worker threads in this process:
+        client = JobClient.loopback(solver_fn=partial(FdtdRlNanobeam, backend='numpy'))
+
+    Workers hold a lease on the job they run and renew it while the solver works; jobs whose lease
+    ran out (dead worker, lost node) go back to the queue, up to max_attempts times.
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from functools import partial
+
+from backends import Backend, register_backend
+from FdtdRlNanobeam import FdtdRlNanobeam, FailedResult
+from sqlite_store import SQLiteStore
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+# error of a done job whose result is a FailedResult (a watchdog fallback), so the trainer gets it marked
+FALLBACK = 'fallback'
+
+logger = logging.getLogger(__name__)
+
+
+class JobFailed(RuntimeError):
+    """raised by a job future when every attempt at the design failed"""
+
+
+class JobBroker(SQLiteStore):
+    """
+    The jobs table of one SQLite file. Every method is a short transaction, so any number of
+    clients and workers (threads, processes, hosts on a shared filesystem) can use it at once.
+    A job's payload is the FdtdRlNanobeam.adjustdesignparams argument list, its result the metrics tuple.
+    """
+
+    def __init__(self, path='fdtd_jobs.sqlite', lease=600., max_attempts=3):
+        super(JobBroker, self).__init__(path)
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+    def _setup(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                     'payload TEXT, status TEXT, result TEXT, error TEXT, worker TEXT, attempts INTEGER DEFAULT 0, '
+                     'submitted REAL, started REAL, finished REAL, lease_until REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)')
+
+    def submit(self, payloads):
+        """queues a list of designs, returns their job ids"""
+        now = time.time()
+
+        def insert(conn):
+            return [conn.execute('INSERT INTO jobs (payload, status, submitted) VALUES (?, ?, ?)',
+                                 (json.dumps([float(v) for v in payload]), QUEUED, now)).lastrowid
+                    for payload in payloads]
+        return self._transaction(insert)
+
+    def claim(self, worker):
+        """hands the oldest queued job to worker, (job id, payload) or None"""
+        now = time.time()
+
+        def take(conn):
+            row = conn.execute('SELECT id, payload FROM jobs WHERE status = ? ORDER BY id LIMIT 1', (QUEUED,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE jobs SET status = ?, worker = ?, attempts = attempts + 1, started = ?, lease_until = ? '
+                         'WHERE id = ?', (RUNNING, worker, now, now + self.lease, row[0]))
+            return row[0], json.loads(row[1])
+        return self._transaction(take)
+
+    def renew(self, job_id, worker):
+        """extends the lease of a running job, False when the job is no longer this worker's"""
+        def extend(conn):
+            return conn.execute('UPDATE jobs SET lease_until = ? WHERE id = ? AND status = ? AND worker = ?',
+                                (time.time() + self.lease, job_id, RUNNING, worker)).rowcount == 1
+        return self._transaction(extend)
+
+    def complete(self, job_id, worker, result):
+        error = FALLBACK if isinstance(result, FailedResult) else None
+
+        def finish(conn):
+            conn.execute('UPDATE jobs SET status = ?, result = ?, error = ?, finished = ?, lease_until = NULL '
+                         'WHERE id = ? AND worker = ?',
+                         (DONE, json.dumps([float(v) for v in result]), error, time.time(), job_id, worker))
+        self._transaction(finish)
+
+    def fail(self, job_id, worker, error):
+        """records a failed attempt; the job is queued again until it has used up max_attempts"""
+        def record(conn):
+            row = conn.execute('SELECT attempts FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            status = FAILED if row is None or row[0] >= self.max_attempts else QUEUED
+            conn.execute('UPDATE jobs SET status = ?, error = ?, finished = ?, lease_until = NULL '
+                         'WHERE id = ? AND worker = ?', (status, str(error), time.time(), job_id, worker))
+        self._transaction(record)
+
+    def requeue_expired(self):
+        """jobs whose worker stopped renewing its lease go back to the queue (or fail), returns how many"""
+        now = time.time()
+
+        def expire(conn):
+            rows = conn.execute('SELECT id, attempts FROM jobs WHERE status = ? AND lease_until < ?',
+                                (RUNNING, now)).fetchall()
+            for job_id, attempts in rows:
+                status = FAILED if attempts >= self.max_attempts else QUEUED
+                conn.execute('UPDATE jobs SET status = ?, error = ?, worker = NULL, lease_until = NULL WHERE id = ?',
+                             (status, 'lease expired', job_id))
+            return len(rows)
+        return self._transaction(expire)
+
+    def results(self, job_ids):
+        """{job id: (status, result tuple or None, error)} of the finished jobs among job_ids; fallback results
+            of failed simulations come back as FailedResult
+        """
+        out = {}
+        job_ids = list(job_ids)
+        with self._lock:
+            conn = self._connect()
+            for start in range(0, len(job_ids), 500):
+                chunk = job_ids[start:start + 500]
+                rows = conn.execute('SELECT id, status, result, error FROM jobs WHERE status IN (?, ?) AND id IN ({})'
+                                    .format(','.join('?' * len(chunk))), [DONE, FAILED] + chunk).fetchall()
+                for job_id, status, result, error in rows:
+                    result = tuple(json.loads(result)) if result else None
+                    if status == DONE and error == FALLBACK:
+                        result = FailedResult(result)
+                    out[job_id] = (status, result, error)
+        return out
+
+    def stats(self):
+        """jobs per status, and the mean queue wait / run time of the finished ones"""
+        with self._lock:
+            conn = self._connect()
+            counts = dict(conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+            wait, run = conn.execute('SELECT AVG(started - submitted), AVG(finished - started) FROM jobs '
+                                     'WHERE status = ?', (DONE,)).fetchone()
+            workers = conn.execute('SELECT COUNT(DISTINCT worker) FROM jobs WHERE status = ?', (RUNNING,)).fetchone()[0]
+        return {
+            'counts': {status: counts.get(status, 0) for status in (QUEUED, RUNNING, DONE, FAILED)},
+            'busy_workers': workers,
+            'mean_wait': wait or 0.,
+            'mean_run': run or 0.,
+        }
+
+    def purge(self, older_than=0.):
+        """drops finished jobs older than older_than seconds"""
+        def drop(conn):
+            return conn.execute('DELETE FROM jobs WHERE status IN (?, ?) AND finished < ?',
+                                (DONE, FAILED, time.time() - older_than)).rowcount
+        return self._transaction(drop)
+
+
+class JobClient(object):
+    """
+    Trainer side of the queue: submit() returns concurrent.futures.Future objects that a single
+    poller thread resolves, checking all outstanding jobs with one query per poll interval.
+    Broker errors (a locked or unreachable file) are logged and retried with backoff; after
+    max_errors failed polls in a row the outstanding futures fail with the last error.
+    """
+
+    def __init__(self, broker, poll=0.2, max_errors=20):
+        self.broker = broker if isinstance(broker, JobBroker) else JobBroker(broker)
+        self.poll = poll
+        self.max_errors = max_errors
+        self.poll_errors = 0
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = False
+        self._poller = None
+        self._workers = []
+
+    def submit(self, payload):
+        return self.submit_many([payload])[0]
+
+    def submit_many(self, payloads):
+        """one future per design, all queued in a single transaction"""
+        job_ids = self.broker.submit(payloads)
+        futures = []
+        with self._lock:
+            for job_id in job_ids:
+                future = Future()
+                future.set_running_or_notify_cancel()
+                future.job_id = job_id
+                self._futures[job_id] = future
+                futures.append(future)
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll, daemon=True)
+                self._poller.start()
+        self._wakeup.set()
+        return futures
+
+    def simulate(self, payload, timeout=None):
+        """blocking round trip for one design"""
+        return self.submit(payload).result(timeout)
+
+    def _poll(self):
+        errors = 0
+        while not self._stop:
+            with self._lock:
+                pending = list(self._futures)
+            wait = self.poll
+            if pending:
+                try:
+                    results = self.broker.results(pending)
+                except Exception as e:
+                    # the poller must outlive a flaky broker file, or every future would hang
+                    errors += 1
+                    self.poll_errors += 1
+                    logger.warning('polling job broker %s failed (%d in a row): %r', self.broker.path, errors, e)
+                    if errors >= self.max_errors:
+                        self._fail_pending(e)
+                        errors = 0
+                    results = {}
+                    wait = min(self.poll * 2 ** errors, 30.)
+                else:
+                    errors = 0
+                for job_id, (status, result, error) in results.items():
+                    with self._lock:
+                        future = self._futures.pop(job_id)
+                    if status == DONE:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(JobFailed('job {} failed: {}'.format(job_id, error)))
+            self._wakeup.wait(wait)
+            self._wakeup.clear()
+
+    def _fail_pending(self, error):
+        with self._lock:
+            futures, self._futures = self._futures, {}
+        for job_id, future in futures.items():
+            future.set_exception(JobFailed('job {}: broker unreachable: {!r}'.format(job_id, error)))
+
+    @classmethod
+    def loopback(cls, solver_fn=FdtdRlNanobeam, num_workers=1, path=None, poll=0.01):
+        """ broker file plus worker threads in this process: the full queue path, no other hosts """
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='fdtd_jobs_', suffix='.sqlite')
+            os.close(fd)
+        client = cls(JobBroker(path), poll=poll)
+        for i in range(num_workers):
+            worker = Worker(JobBroker(path), solver_fn, name='loopback-{}'.format(i), poll=poll)
+            thread = threading.Thread(target=worker.run, daemon=True)
+            thread.start()
+            client._workers.append((worker, thread))
+        return client
+
+    def close(self):
+        self._stop = True
+        self._wakeup.set()
+        for worker, thread in self._workers:
+            worker.stop()
+            thread.join()
+        if self._poller is not None:
+            self._poller.join()
+        self.broker.close()
+
+
+class Worker(object):
+    """
+    Pull-based worker: claims one job at a time, runs it on its own solver object (built lazily by
+    solver_fn, so its warm session lives as long as the worker) and posts the result. A heartbeat
+    thread renews the lease while the solver runs. Broker errors (a locked or unreachable file) are
+    logged and retried with backoff, up to max_backoff seconds apart, as in JobClient; a finished
+    result is posted again until the broker takes it, the daemon itself never gives up.
+    """
+
+    def __init__(self, broker, solver_fn=FdtdRlNanobeam, name=None, poll=1., max_backoff=30.):
+        self.broker = broker if isinstance(broker, JobBroker) else JobBroker(broker)
+        self.solver_fn = solver_fn
+        self.name = name or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.poll = poll
+        self.max_backoff = max_backoff
+        self.solver = None
+        self.done = 0
+        self.failed = 0
+        self.broker_errors = 0
+        self._stop = threading.Event()
+
+    def _backoff(self, errors, what, error):
+        self.broker_errors += 1
+        logger.warning('worker %s: %s on job broker %s failed (%d in a row): %r',
+                       self.name, what, self.broker.path, errors, error)
+        self._stop.wait(min(self.poll * 2 ** errors, self.max_backoff))
+
+    def _post(self, fn, *args):
+        # the solver time is spent already, keep trying rather than let the lease run out and redo the job
+        errors = 0
+        while True:
+            try:
+                return fn(*args)
+            except Exception as e:
+                errors += 1
+                self._backoff(errors, fn.__name__, e)
+                if self._stop.is_set():
+                    raise
+
+    def run_one(self):
+        """claims and runs one job, False when the queue was empty"""
+        self.broker.requeue_expired()
+        job = self.broker.claim(self.name)
+        if job is None:
+            return False
+        job_id, payload = job
+        if self.solver is None:
+            self.solver = self.solver_fn()
+
+        running = threading.Event()
+
+        def heartbeat():
+            while not running.wait(self.broker.lease / 3.):
+                try:
+                    if not self.broker.renew(job_id, self.name):
+                        break
+                except Exception as e:
+                    # a missed renewal is retried on the next beat, the lease outlasts a few of them
+                    logger.warning('worker %s: renewing job %s failed: %r', self.name, job_id, e)
+        beat = threading.Thread(target=heartbeat, daemon=True)
+        beat.start()
+        try:
+            result = self.solver.adjustdesignparams(*payload)
+        except Exception as e:
+            self._post(self.broker.fail, job_id, self.name, repr(e))
+            self.failed += 1
+        else:
+            self._post(self.broker.complete, job_id, self.name, result)
+            self.done += 1
+        finally:
+            running.set()
+            beat.join()
+        return True
+
+    def run(self, max_jobs=None):
+        """serves jobs until stop() (or max_jobs jobs), sleeping poll seconds whenever the queue is empty"""
+        errors = 0
+        while not self._stop.is_set():
+            if max_jobs is not None and self.done + self.failed >= max_jobs:
+                break
+            try:
+                ran = self.run_one()
+            except Exception as e:
+                # claiming (or requeueing) failed, or the solver could not be built; a job claimed
+                # without being run goes back to the queue when its lease runs out
+                errors += 1
+                self._backoff(errors, 'serving a job', e)
+                continue
+            errors = 0
+            if not ran:
+                self._stop.wait(self.poll)
+
+    def stop(self):
+        self._stop.set()
+
+
+class QueueBackend(Backend):
+    """ FdtdRlNanobeam backend that sends every design to the job queue and waits for the result,
+        at most timeout seconds (None waits forever). Holds only the broker path, so it can be
+        shipped to FdtdVecEnv worker processes.
+    """
+
+    name = 'queue'
+
+    def __init__(self, broker='fdtd_jobs.sqlite', poll=0.2, timeout=7200.):
+        self.broker = broker
+        self.poll = poll
+        self.timeout = timeout
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self.broker if isinstance(self.broker, JobClient) else JobClient(self.broker, self.poll)
+        return self._client
+
+    def adjustdesignparams(self, dlen, dt, dt1, dt3, dn1, dn3, dleng, da):
+        return self.client.simulate((dlen, dt, dt1, dt3, dn1, dn3, dleng, da), self.timeout)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_client'] = None
+        return state
+
+
+register_backend('queue', QueueBackend)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='FDTD design evaluation job queue')
+    parser.add_argument('command', choices=['worker', 'stats', 'purge'])
+    parser.add_argument('--broker', type=str, default='fdtd_jobs.sqlite')
+    parser.add_argument('--backend', type=str, default=None, help='FdtdRlNanobeam backend, default: FDTD')
+    parser.add_argument('--poll', type=float, default=1.)
+    parser.add_argument('--lease', type=float, default=600.)
+    parser.add_argument('--max_jobs', type=int, default=None)
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='worker: run the solver under a watchdog with this per-job timeout in seconds')
+    parser.add_argument('--older_than', type=float, default=86400., help='purge: age of finished jobs in seconds')
+    args = parser.parse_args()
+
+    broker = JobBroker(args.broker, lease=args.lease)
+    if args.command == 'worker':
+        solver_fn = partial(FdtdRlNanobeam, backend=args.backend)
+        watchdog = None
+        if args.timeout is not None:
+            from watchdog import WatchdogBackend
+            watchdog = WatchdogBackend(solver_fn, timeout=args.timeout)
+            solver_fn = partial(FdtdRlNanobeam, backend=watchdog)
+        worker = Worker(broker, solver_fn, poll=args.poll)
+        print('worker {} serving {}'.format(worker.name, args.broker))
+        try:
+            worker.run(args.max_jobs)
+        except KeyboardInterrupt:
+            pass
+        print('worker {}: {} jobs done, {} failed'.format(worker.name, worker.done, worker.failed))
+        if watchdog is not None:
+            print('watchdog: {}'.format(worker.solver.backend.stats() if worker.solver else watchdog.stats()))
+    elif args.command == 'stats':
+        print(json.dumps(broker.stats(), indent=2))
+    else:
+        print('purged {} jobs'.format(broker.purge(args.older_than)))
@@ -1,269 +1,273 @@
 """Deep Q learning (DQN) for optimizing PCSELs (using OpenAI Gym).
 #Renjie Li, March 2023, NOEL CUHKSZ.
+
+The agent lives in dqn_agent.py; this script only drives the training run:
+    python optim_PhC.py --episodes 500 --prioritized
+    python optim_PhC.py --learner --utd 0.5   # train in the background while the solver runs
+    python optim_PhC.py --num_envs 4          # step 4 designs at once on a pool of solver workers
+    python optim_PhC.py --backend numpy --cache fdtd_cache.sqlite   # NumPy model, results reused across runs
 """
-import sys
-import gym
+import argparse
 import math
-import random
+from functools import partial
 import numpy as np
-#import matplotlib
-#import matplotlib.pyplot as plt
-from collections import namedtuple, deque
-from itertools import count
+import gym
 import torch
-import torch.nn as nn
-import torch.optim as optim 
-import torch.nn.functional as F
 from torch.utils.tensorboard import SummaryWriter
-#import torchvision.transforms as T
 import logging
 from gym.envs.registration import register
 from datetime import datetime, timezone
+from dqn_agent import DQNAgent, BackgroundLearner, NUM_STATES
+from transition_log import TransitionLog
+from fdtd_env import FdtdEnv
+from sim_cache import SimCache
+from vec_env import FdtdVecEnv
 
 torch.set_printoptions(precision=10)
 
 logger = logging.getLogger(__name__)
 
-# register the env with gym
-register(
-    id='Fdtd_NB-v0',
-    entry_point='envs:FdtdEnv',
-    max_episode_steps=150,
-    reward_threshold=200.0,
-)
-
-writer = SummaryWriter()  # log the training process
-
-# instantiate the fdtd env
-env = gym.make('Fdtd_NB-v0').unwrapped
-
-# if GPU is to be used
-#print(torch.cuda.is_available())
-#print(torch.cuda.get_device_name(0))
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
-# declare transition and experience replay
-Transition = namedtuple('Transition', ('state', 'action', 'next_state', 'reward'))
-
-class ReplayMemory(object):
-    """declare the replay buffer"""
-
-    def __init__(self, capacity):
-        self.memory = deque([], maxlen=capacity)
-
-    def push(self, *args):
-        """Save a transition"""
-        self.memory.append(Transition(*args))
-
-    def sample(self, batch_size):
-        return random.sample(self.memory, batch_size)
-
-    def __len__(self):
-        return len(self.memory)
-
-
-numState = 8
-
-# set up the neural network
-# create a class for the DQN's policy MLP
-class Net(nn.Module):
-    def __init__(self, num_actions):
-        super(Net, self).__init__()
-        self.fc1 = nn.Linear(numState, 80)  # just FC, no CNN
-        self.fc2 = nn.Linear(80, 120)
-        self.fc3 = nn.Linear(120, 80)
-        self.fc4 = nn.Linear(80, num_actions)
-
-    def forward(self, x):
-        x = x.to(device)
-        # print(x.shape)
-        x = x.view(-1, numState)
-        x = F.relu(self.fc1(x))
-        x = F.relu(self.fc2(x))
-        x = F.relu(self.fc3(x))
-        x = self.fc4(x)
-        return x
-
-
-env.reset()
-
-# set up the training
-BATCH_SIZE = 32  #64
-GAMMA = 0.999
-EPS_START = 0.9
-EPS_END = 0.05
-EPS_DECAY = 200
-TARGET_UPDATE = 3
-TRAIN_FREQ = 20
-
-# get number of actions from gym action space
-n_actions = env.action_space.n
-
-policy_net = Net(n_actions).to(device)  # instantiate the policy network
-target_net = Net(n_actions).to(device)
-target_net.load_state_dict(policy_net.state_dict())
-target_net.eval()
-
-optimizer = optim.RMSprop(policy_net.parameters(), lr=0.00025, alpha=0.95, momentum=0.9)  # initialize the optimizer, change learning rate?
-#optimizer = optim.Adam(policy_net.parameters(), lr=0.0001)
-
-memory = ReplayMemory(1500)  # instantiate the replay buffer
-
-steps_done = 0  # counter for steps taken
-
-def select_action(state):
-    """selects an action accordingly to an epsilon greedy policy"""
-    global steps_done
-    sample = random.random()  # generate random number
-    eps_threshold = EPS_END + (EPS_START - EPS_END) * math.exp(-1. * steps_done / EPS_DECAY)  # expotentially decaying eps
-    steps_done += 1
-    if sample > eps_threshold:
-        with torch.no_grad():
-            print(policy_net(state))
-            print(policy_net(state).max(1)[1])
-            return policy_net(state).max(1)[1].view(1, 1)  # Pick action with the largest expected reward (argmax)
+
+def train(args):
+    # register the env with gym
+    register(
+        id='Fdtd_NB-v0',
+        entry_point='fdtd_env:FdtdEnv',
+        max_episode_steps=args.max_steps,
+        reward_threshold=200.0,
+    )
+
+    writer = SummaryWriter()  # log the training process
+
+    # instantiate the fdtd env, optionally on a non-FDTD backend and with a persistent result cache
+    cache = SimCache(args.cache) if args.cache else None
+    if args.num_envs > 1:
+        env = FdtdVecEnv(args.num_envs, num_workers=args.num_workers, cache=cache,
+                         env_fn=partial(FdtdEnv, backend=args.backend))
     else:
-        return torch.tensor([[random.randrange(n_actions)]], device=device, dtype=torch.long)  # pick random action
-
-# define the optimization (RL) process, which computes V, Q and the loss
-def optimize_model():
-
-    if len(memory) < BATCH_SIZE:
-        return
-
-    print('optimizing...')
-
-    transitions = memory.sample(BATCH_SIZE)  # sample transitions from the replay buffer
-    batch = Transition(*zip(*transitions))  # transpose the batch
-
-    # compute a mask of non-final states and concatenate the batch elements
-    non_final_mask = torch.tensor(tuple(map(lambda s: s is not None, batch.next_state)), device=device,
-                                  dtype=torch.bool)
-    non_final_next_states = torch.cat([s for s in batch.next_state if s is not None])
-
-    # state, action, and reward from replay buffer
-    state_batch = torch.cat(batch.state)
-    action_batch = torch.cat(batch.action)
-    reward_batch = torch.cat(batch.reward)
-
-    # compute Q(s, a)
-    state_action_values = policy_net(state_batch).gather(1, action_batch)
-    # Compute V(s')
-    next_state_values = torch.zeros(BATCH_SIZE, device=device)  # V is zero for final state
-    next_state_values[non_final_mask] = target_net(non_final_next_states).max(1)[0].detach()  # V' = max(Q')
-    # compute the expected Q values
-    expected_state_action_values = (next_state_values * GAMMA) + reward_batch  # Q_expected = r + gamma*V'
-
-    # cost function
-    criterion = nn.SmoothL1Loss()
-    loss = criterion(state_action_values, expected_state_action_values.unsqueeze(1))  # L = Q.actual - Q.expected
-
-    # optimize the MLP model
-    optimizer.zero_grad()
-    loss.backward()
-    for param in policy_net.parameters():
-        # clamp grad values to between -1 and 1
-        param.grad.data.clamp_(-1,1)
-    optimizer.step()
-    print(loss.item())
-    writer.add_scalar('training/losses', loss.item(), steps_done)
-
-
-# main training loop
-num_episodes = 500
-max_episode_steps = 150
-tempRew = -1000
-lastScore = 0
-maxScore = []
-for i_episode in range(num_episodes):
-    # Initialize the environment and state
-    
-    utc_dt = datetime.now(timezone.utc)
-    print("\nLocal time {}".format(utc_dt.astimezone().isoformat()))
-
-    print('\nStarting episode No.{}'.format(i_episode+1))
-
-    state = env.reset()
-    state = torch.from_numpy(state)
-    for t in range(max_episode_steps):
-        print('\nStarting time step No.{}'.format(t + 1))
-
-        # Select and perform an action
-        action = select_action(state)
-
-        obs, score, done, _ = env.step(action.item())
-        # record the highest score, corresponding to the highest Q factor
-        if score > tempRew:
-            tempRew = score
-
-        # score = torch.tensor([score], device=device)
-
-        # calculate the reward
-        reward = score - lastScore
-        print('Score: {:.5f}, reward: {:.5f}, State: {}\n'.format(score, reward, obs))
-        #print(score, reward, obs)
-
-        reward = torch.tensor([reward], device=device)
-
-        # Observe new state
-        if not done:
-            next_state = torch.from_numpy(obs)
+        env = gym.make('Fdtd_NB-v0', cache=cache, backend=args.backend).unwrapped
+
+    # get number of actions from gym action space
+    agent = DQNAgent(env.action_space.n, NUM_STATES, batch_size=args.batch_size, gamma=args.gamma, lr=args.lr,
+                     capacity=args.capacity, prioritized=args.prioritized, writer=writer)
+    transition_log = TransitionLog(args.log, NUM_STATES)  # every transition, appended to disk once per episode
+    learner = None
+    if args.learner:
+        # as many updates per transition as the inline loop unless asked otherwise, --utd inf for no cap;
+        # the weights reach the actor and the target as often (in transitions) as in the inline loop
+        utd = args.utd if args.utd is not None else 1. / args.train_freq
+        learner = BackgroundLearner(agent, utd=None if math.isinf(utd) else utd,
+                                    publish_every=args.publish_every or args.train_freq,
+                                    target_every=args.target_every or args.max_steps).start()
+
+    if args.num_envs > 1:
+        try:
+            train_vec(args, env, agent, writer, transition_log, learner, gym.spec('Fdtd_NB-v0').reward_threshold)
+        finally:
+            if cache is not None:
+                print('cache: {}'.format(cache.stats()))
+            env.close()   # closes the cache too
+        if learner is not None:
+            learner.stop()
+        print('Training Complete')
+        return agent
+
+    # main training loop
+    tempRew = -1000
+    maxScore = []
+    for i_episode in range(args.episodes):
+        # Initialize the environment and state
+
+        utc_dt = datetime.now(timezone.utc)
+        print("\nLocal time {}".format(utc_dt.astimezone().isoformat()))
+
+        print('\nStarting episode No.{}'.format(i_episode+1))
+
+        state = env.reset()
+        state = torch.from_numpy(state)
+        # rewards are score changes; the start design's score is 0 unless it was simulated (see reward.py)
+        lastScore = env.last_score
+        for t in range(args.max_steps):
+            print('\nStarting time step No.{}'.format(t + 1))
+
+            # stop right away if the learner died, rather than collect simulations with stale weights
+            if learner is not None:
+                learner.check()
+
+            # Select and perform an action; the simulation runs in the background
+            action = agent.select_action(state)
+            env.step_async(action.item())
+
+            # Perform one step of the optimization (on the policy network) while the solver is busy
+            # don't need to train every step; the background learner, if any, trains on its own
+            if learner is None and agent.steps_done % args.train_freq == 0:
+                print('optimizing...')
+                loss = agent.optimize()
+                if loss is not None:
+                    print(loss)
+
+            obs, score, done, info = env.step_wait()
+            # record the highest score, corresponding to the highest Q factor
+            if score > tempRew:
+                tempRew = score
+
+            # calculate the reward
+            reward = score - lastScore
+            print('Score: {:.5f}, reward: {:.5f}, State: {}\n'.format(score, reward, obs))
+
+            reward = torch.tensor([reward], device=agent.device)
+
+            # Observe new state
+            if not done:
+                next_state = torch.from_numpy(obs)
+            else:
+                next_state = None
+
+            if score >= env.spec.reward_threshold:
+                print('\nSolved! Episode: {}, Steps: {}, Current_state: {}, Current_score: {}\n'.format(
+                    i_episode, t, next_state, score))
+                # break
+
+            # Store the transition in memory
+            agent.push(state, action, next_state, reward)
+            transition_log.append(state, action, obs, reward, done, score, info.get('metrics'),
+                                  info.get('oob_penalty', math.nan))
+
+            lastScore = score
+
+            # Move to the next state
+            state = next_state
+
+            writer.add_scalar('training/scores', score, agent.steps_done)
+            writer.add_scalar('training/rewards', reward, agent.steps_done)
+
+            if done:
+                break
+
+        print('\nlargest score so far: {}'.format(tempRew))
+        maxScore.append(tempRew)
+        writer.add_scalar('training/max_scores', tempRew, i_episode)
+
+        # Update the target network, copying all weights and biases in DQN
+
+        print(maxScore)
+        if learner is None:
+            print('updating target network...')
+            agent.update_target()
         else:
-            next_state = None
+            print('learner: {}'.format(learner.stats()))
 
         if score >= env.spec.reward_threshold:
-            print('\nSolved! Episode: {}, Steps: {}, Current_state: {}, Current_score: {}\n'.format(
-                i_episode, t, next_state, score))
+            print('Solved! Episode: {}, Current_state: {}, Current_score: {}\n'.format(
+                i_episode, next_state, score))
             # break
 
-        # Store the transition in memory
-        memory.push(state, action, next_state, reward)
-
-        lastScore = score
-
-        # Move to the next state
-        state = next_state
-
-        # Perform one step of the optimization (on the policy network)
-        # don't need to train every step
-        if steps_done % TRAIN_FREQ == 0:
-            optimize_model()
-        
-        writer.add_scalar('training/scores', score, steps_done)
-        writer.add_scalar('training/rewards', reward, steps_done)
-
-        if done:
-            break
-
-    print('\nlargest score so far: {}'.format(tempRew))
-    maxScore.append(tempRew)
-    writer.add_scalar('training/max_scores', tempRew, i_episode)
-
-    # Update the target network, copying all weights and biases in DQN
-
-    print('updating target network...')
+        # append this episode's samples to the transition log
+        transition_log.end_episode()
+
+    if learner is not None:
+        learner.stop()
+    if cache is not None:
+        print('cache: {}'.format(cache.stats()))
+        cache.close()
+    print('Training Complete')
+    return agent
+
+
+def train_vec(args, env, agent, writer, transition_log, learner, reward_threshold):
+    """
+    the training loop on a FdtdVecEnv: one batched act() and one batch of simulations per step for
+    all envs, until args.episodes episodes are done. Every env keeps its own last score and its
+    own episode of transitions, appended to the transition log when that episode ends.
+    """
+    n = env.num_envs
+    states = env.reset()
+    last_scores = np.array([e.last_score for e in env.envs])
+    steps = np.zeros(n, dtype=int)
+    pending = [[] for _ in range(n)]
+    tempRew = -1000
+    maxScore = []
+    finished = 0
+    while finished < args.episodes:
+        if learner is not None:
+            learner.check()
+
+        before = agent.steps_done
+        actions = agent.act(states)
+        # as many inline updates as the serial loop would do for the same number of decisions
+        if learner is None:
+            for _ in range(agent.steps_done // args.train_freq - before // args.train_freq):
+                loss = agent.optimize()
+                if loss is not None:
+                    print('optimizing... {}'.format(loss))
+
+        obs, scores, dones, infos = env.step(actions.cpu().numpy())
+        steps += 1
+        for i in range(n):
+            score = float(scores[i])
+            tempRew = max(tempRew, score)
+            reward = torch.tensor([score - last_scores[i]], device=agent.device)
+            # auto-reset envs report their final observation in infos
+            final_obs = infos[i].get('terminal_observation', obs[i])
+            next_state = None if dones[i] else torch.from_numpy(final_obs)
+            state = torch.from_numpy(states[i])
+            action = actions[i].view(1, 1)
+            agent.push(state, action, next_state, reward)
+            pending[i].append((state, action, final_obs, reward, bool(dones[i]), score, infos[i].get('metrics'),
+                               infos[i].get('oob_penalty', math.nan)))
+            last_scores[i] = score
+            writer.add_scalar('training/scores', score, agent.steps_done)
+            writer.add_scalar('training/rewards', reward, agent.steps_done)
+            if score >= reward_threshold:
+                print('\nSolved! Env: {}, Steps: {}, Current_state: {}, Current_score: {}\n'.format(
+                    i, steps[i], final_obs, score))
+
+            if not dones[i] and steps[i] < args.max_steps:
+                continue
+            # episode over (terminated, or truncated at max_steps like the serial loop)
+            if not dones[i]:
+                obs[i] = env.envs[i].reset()
+            last_scores[i] = env.envs[i].last_score
+            steps[i] = 0
+            for transition in pending[i]:
+                transition_log.append(*transition)
+            transition_log.end_episode()
+            pending[i] = []
+            maxScore.append(tempRew)
+            writer.add_scalar('training/max_scores', tempRew, finished)
+            finished += 1
+            print('\nEpisode No.{} done (env {}), largest score so far: {}'.format(finished, i, tempRew))
+            if learner is None:
+                agent.update_target()
+        states = obs
+
+    if learner is not None:
+        print('learner: {}'.format(learner.stats()))
     print(maxScore)
-    target_net.load_state_dict(policy_net.state_dict())
-
-    if score >= env.spec.reward_threshold:
-        print('Solved! Episode: {}, Current_state: {}, Current_score: {}\n'.format(
-            i_episode, next_state, score))
-        # break
-
-    # save all samples to npy file
-    my_array = np.array(memory)
-
-    # Define the filename for the npy file
-    filename = 'dataset.npy'
-
-    # Save the NumPy array to the npy file
-    np.save(filename, my_array)
-
-
-print('Training Complete')
-writer.close()
-
-
-
 
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='DQN optimization of the PCSEL design')
+    parser.add_argument('--episodes', type=int, default=500)
+    parser.add_argument('--max_steps', type=int, default=150)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--gamma', type=float, default=0.999)
+    parser.add_argument('--lr', type=float, default=0.00025)
+    parser.add_argument('--capacity', type=int, default=1500)
+    parser.add_argument('--train_freq', type=int, default=20)
+    parser.add_argument('--prioritized', action='store_true', help='sample the replay buffer by TD error')
+    parser.add_argument('--log', type=str, default='dataset', help='transition log directory')
+    parser.add_argument('--learner', action='store_true', help='train on a background thread instead of inline')
+    parser.add_argument('--utd', type=float, default=None,
+                        help='max gradient steps per transition (learner only), default 1/train_freq, inf for no cap')
+    parser.add_argument('--publish_every', type=int, default=None,
+                        help='transitions between weight publications (learner only), default train_freq')
+    parser.add_argument('--target_every', type=int, default=None,
+                        help='transitions between target network syncs (learner only), default max_steps')
+    parser.add_argument('--num_envs', type=int, default=1, help='designs stepped at once (FdtdVecEnv when > 1)')
+    parser.add_argument('--backend', type=str, default=None,
+                        help='simulation backend registered in backends.py (e.g. numpy), default: FDTD')
+    parser.add_argument('--cache', type=str, default=None, help='SimCache file to reuse simulation results from')
+    parser.add_argument('--num_workers', type=int, default=None,
+                        help='simulation worker processes of the vec env, default num_envs, 0 runs them serially')
+    train(parser.parse_args())
@@ -0,0 +1,129 @@
+""" declarative description of the PCSEL structure and its compilation into a single FDTD script,
+    so the whole geometry is built with one eval() round trip instead of one API call per property.
+"""
+
+from collections import namedtuple
+from functools import lru_cache
+
+GROUP = "::model::pcsel"
+
+# (name, lumerical property type, value); type 0 = number, 2 = length, 5 = material
+UserProp = namedtuple('UserProp', ('name', 'kind', 'value'))
+# one slab of the stack, spanning the whole device laterally
+Rect = namedtuple('Rect', ('z', 'z_span', 'span', 'index', 'alpha'))
+# square lattice of (2*layer+1)^2 circular holes etched through z-z_span/2 .. z+z_span/2
+HoleLattice = namedtuple('HoleLattice', ('layer', 'pitch', 'radius', 'z', 'z_span', 'material'))
+PcselSpec = namedtuple('PcselSpec', ('userprops', 'material', 'rects', 'holes'))
+
+
+def pcsel_spec(len=2000E-9, t=450E-9, t_1=100E-9, t_2=0, t_3=315E-9, t_4=5000E-9,
+               n_1=3.2035, n_2=3.4038, n_3=3.415, n_4=3.2035, leng=0.52, leng2=0.406, a=400E-9, layer=1):
+    """ the PCSEL stack of FdtdRlNanobeam.addgeometry as data; n_2 is GaAs (from https://refractiveindex.info),
+        n_3 the active layer, leng the hole diameter in units of the pitch a
+    """
+    material_air = "etch"
+    material = "<Object defined dielectric>"
+    userprops = (
+        UserProp("t", 2, t),
+        UserProp("len", 2, len),
+        UserProp("t_2", 2, t_2),
+        UserProp("t_3", 2, t_3),
+        UserProp("t_4", 2, t_4),
+        UserProp("n_1", 0, n_1),
+        UserProp("n_2", 0, n_2),
+        UserProp("n_3", 0, n_3),
+        UserProp("n_4", 0, n_4),
+        UserProp("index", 0, 1),
+        UserProp("material_air", 5, material_air),
+        UserProp("material", 5, material),
+        UserProp("layer", 0, layer),
+        UserProp("leng", 0, leng),
+        UserProp("leng2", 0, leng2),
+        UserProp("a", 2, a),
+        UserProp("t_1", 2, t_1),
+    )
+    rects = (
+        Rect(t_1/2+t+t_2+t_3/2, t_1, len, n_2, None),
+        Rect(t/2+t_2+t_3/2, t, len, n_1, 0.7),
+        Rect(0, t_3, len, n_3, 0.5),
+        Rect(-t_3/2-t_4/2, t_4, len, n_4, 0.3),
+    )
+    # triangular holes (leng2) would be an addpoly per site with vertices
+    # [[x-leng2*a/2, y+leng2*a/2], [x+leng2*a/2, y+leng2*a/2], [x+leng2*a/2, y-leng2*a/2]]
+    holes = HoleLattice(layer, a, leng*a/2, t_1/2+t/2+t_2+t_3/2, t_1+t, material_air)
+    return PcselSpec(userprops, material, rects, holes)
+
+
+def hole_lattice(a, leng, dleng=0., da=0.):
+    """ (pitch, radius) of the holes a design change evaluates: they stay on the pitch a the geometry
+        was built with, only their radius follows a + da. Every model of a design uses this
+    """
+    return a, (leng+dleng)*(a+da)/2.0
+
+
+def _value(v):
+    if isinstance(v, str):
+        return '"{}"'.format(v)
+    return repr(float(v)) if isinstance(v, float) else repr(v)
+
+
+def _call(name, *args):
+    if not args:
+        return name + ';'
+    return '{}({});'.format(name, ', '.join(_value(a) for a in args))
+
+
+@lru_cache(maxsize=256)
+def compile_script(spec):
+    """ the FDTD script that builds spec from scratch; cached, since specs are hashable """
+    lines = [
+        _call('switchtolayout'),
+        _call('unselectall'),
+        _call('addstructuregroup'),
+        _call('set', "name", "pcsel"),
+        _call('set', 'x', 0),
+        _call('set', 'y', 0),
+        _call('set', 'z', 0),
+    ]
+    lines += [_call('adduserprop', p.name, p.kind, p.value) for p in spec.userprops]
+    lines.append(_call('set', "construction group", 0))
+
+    for rect in spec.rects:
+        lines += [
+            _call('addrect'),
+            _call('addtogroup', GROUP),
+            _call('set', "x", 0),
+            _call('set', "y", 0),
+            _call('set', "z", rect.z),
+            _call('set', "x span", rect.span),
+            _call('set', "y span", rect.span),
+            _call('set', "z span", rect.z_span),
+            _call('set', "material", spec.material),
+            _call('set', "index", rect.index),
+        ]
+        if rect.alpha is not None:
+            lines.append(_call('set', "alpha", rect.alpha))
+
+    holes = spec.holes
+    for i in range(-holes.layer, holes.layer+1):
+        for j in range(-holes.layer, holes.layer+1):
+            lines += [
+                _call('addcircle'),
+                _call('addtogroup', GROUP),
+                _call('set', 'radius', holes.radius),
+                _call('set', 'x', j*holes.pitch),
+                _call('set', 'y', i*holes.pitch),
+                _call('set', "z", holes.z),
+                _call('set', "z span", holes.z_span),
+                _call('set', "material", holes.material),
+            ]
+
+    lines += [_call('selectall'), _call('runsetup')]
+    return '\n'.join(lines)
+
+
+def setnamed_script(params):
+    """ one script that applies {(object name, property, index): value} with setnamed """
+    lines = [_call('switchtolayout')]
+    lines += [_call('setnamed', name, prop, value, index) for (name, prop, index), value in params.items()]
+    return '\n'.join(lines)
@@ -9,15 +9,11 @@ import numpy as np
 #import matplotlib.pyplot as plt
 from collections import namedtuple, deque
 #from optim_PhC import ReplayMemory
+from transition import ACTION_DELTAS  # per-action state change, shared with FdtdEnv
+from transition_log import TransitionLog
 
 # declare transition and experience replay
 Transition = namedtuple('Transition', ('state', 'action', 'next_state', 'reward'))
-offset={0:np.array([25,0,0,0,0,0,0,0],dtype=float),1:np.array([-25,0,0,0,0,0,0,0],dtype=float),\
-    2:np.array([0,2.5,0,0,0,0,0,0],dtype=float),3:np.array([0,-2.5,0,0,0,0,0,0],dtype=float),4:np.array([0,0,2.5,0,0,0,0,0],dtype=float),\
-    5:np.array([0,0,-2.5,0,0,0,0,0],dtype=float),6:np.array([0,0,0,2.5,0,0,0,0],dtype=float),7:np.array([0,0,0,-2.5,0,0,0,0],dtype=float),\
-    8:np.array([0,0,0,0,0.005,0,0,0],dtype=float),9:np.array([0,0,0,0,-0.005,0,0,0],dtype=float),10:np.array([0,0,0,0,0,0.005,0,0],dtype=float),\
-    11:np.array([0,0,0,0,0,-0.005,0,0],dtype=float),12:np.array([0,0,0,0,0,0,0.005,0],dtype=float),13:np.array([0,0,0,0,0,0,-0.005,0],dtype=float),\
-    14:np.array([0,0,0,0,0,0,0,2.5],dtype=float),15:np.array([0,0,0,0,0,0,0,-2.5],dtype=float)}
 class ReplayMemory(object):
     """declare the replay buffer"""
 
@@ -63,8 +59,7 @@ if __name__=='__main__':
                 w.append(item[3].detach().cpu().numpy()[0])#r
                 if temp is None:
                     v.append(True)
-                    #z.append(x[-1]+offset[y[-1]]) #number
-                    z.append(x[-1]+np.argmax(y[-1]))
+                    z.append(x[-1]+ACTION_DELTAS[np.argmax(y[-1])])
                     trans={'observations':np.array(x),'actions':np.array(y),'rewards':np.array(w),'next_observation':np.array(z)\
                     ,'terminals':np.array(v)}
                     paths.append(trans)
@@ -81,6 +76,23 @@ if __name__=='__main__':
                     v.append(False)
                     z.append(temp)#o',
                 # one_hot = np.eye(16)[y[0]]
+        elif TransitionLog.exists(file_path+file):
+            # transition log written by optim_PhC.py: one path per episode, read memory-mapped
+            for episode in TransitionLog(file_path+file).episodes():
+                one_hot_matrix = np.eye(16)
+                trans={'observations':episode['state'].astype(np.float32),'actions':one_hot_matrix[episode['action']],\
+                'rewards':episode['reward'].astype(np.float32),'next_observation':episode['next_state'].astype(np.float32),\
+                'terminals':episode['done'].copy()}
+                # raw metrics, so reward.py can rescore the path without a SimCache; rejected
+                # out-of-range moves carry their penalty instead (metrics NaN before the first simulation)
+                rejected=np.isfinite(episode['oob_penalty'])
+                if np.isfinite(episode['metrics'][~rejected]).all():
+                    trans['metrics']=episode['metrics'].copy()
+                    trans['oob_penalty']=episode['oob_penalty'].copy()
+                paths.append(trans)
+                print(len(trans['rewards']))
+                if len(trans['rewards'])>max_ep:
+                    max_ep=len(trans['rewards'])
     print("number",len(paths))
     # with open(f'DTstat.pkl', 'wb') as f:
     #     pickle.dump(transition, f)
@@ -0,0 +1,190 @@
+""" replay memories for the DQN in optim_PhC.py: preallocated ring buffers of contiguous tensors,
+    so a minibatch is one vectorized index gather instead of random.sample + zip + torch.cat.
+    PrioritizedReplayMemory samples transitions proportionally to their TD error through a sum-tree,
+    every transition costs a full simulation, so the informative ones are replayed more often.
+"""
+
+from collections import namedtuple
+import numpy as np
+import torch
+
+# the per-transition record of the original deque based ReplayMemory (still used by prepro.py)
+Transition = namedtuple('Transition', ('state', 'action', 'next_state', 'reward'))
+
+# a sampled minibatch: state [B, n], action [B, 1], next_state [B, n] (zeros where done), reward [B],
+# done [B] (True where next_state was None), indices [B] into the buffer, and when sampled by
+# priority the importance sampling weights [B] and the write generation of every sampled slot
+# (both None for uniform sampling)
+Batch = namedtuple('Batch', ('state', 'action', 'next_state', 'reward', 'done', 'indices', 'weights', 'generations'),
+                   defaults=(None, None))
+
+
+class TensorReplayMemory(object):
+    """
+    Ring buffer with the push/sample interface of ReplayMemory. push(state, action, next_state, reward)
+    takes the same arguments (next_state None for a terminal transition); sample(batch_size) returns
+    a Batch of stacked tensors already on `device`. Indices are drawn with replacement, which keeps
+    sampling O(batch_size) whatever the capacity.
+    """
+
+    def __init__(self, capacity, state_dim=8, device='cpu'):
+        self.capacity = capacity
+        self.device = torch.device(device)
+        self.states = torch.zeros((capacity, state_dim), dtype=torch.float32, device=self.device)
+        self.actions = torch.zeros((capacity, 1), dtype=torch.long, device=self.device)
+        self.next_states = torch.zeros((capacity, state_dim), dtype=torch.float32, device=self.device)
+        self.rewards = torch.zeros(capacity, dtype=torch.float32, device=self.device)
+        self.dones = torch.zeros(capacity, dtype=torch.bool, device=self.device)
+        self.position = 0   # next slot to write
+        self.size = 0
+
+    def push(self, state, action, next_state, reward):
+        """Save a transition"""
+        i = self.position
+        self.states[i] = torch.as_tensor(state, dtype=torch.float32).view(-1)
+        self.actions[i] = torch.as_tensor(action, dtype=torch.long).view(-1)
+        if next_state is None:
+            self.next_states[i] = 0
+            self.dones[i] = True
+        else:
+            self.next_states[i] = torch.as_tensor(next_state, dtype=torch.float32).view(-1)
+            self.dones[i] = False
+        self.rewards[i] = torch.as_tensor(reward, dtype=torch.float32).view(-1)[0]
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        return i
+
+    def batch(self, indices):
+        """the stored transitions at indices (a long tensor on self.device)"""
+        return Batch(self.states[indices], self.actions[indices], self.next_states[indices],
+                     self.rewards[indices], self.dones[indices], indices)
+
+    def sample(self, batch_size):
+        indices = torch.randint(0, self.size, (batch_size,), device=self.device)
+        return self.batch(indices)
+
+    def ordered(self):
+        """buffer slots from the oldest to the newest transition"""
+        start = self.position if self.size == self.capacity else 0
+        return (torch.arange(self.size, device=self.device) + start) % self.capacity
+
+    @property
+    def memory(self):
+        """ the content as a list of Transition records shaped like the deque ReplayMemory kept them
+            (state [n], action [1, 1], next_state [n] or None, reward [1]), oldest first
+        """
+        out = []
+        for i in self.ordered().tolist():
+            next_state = None if self.dones[i] else self.next_states[i].cpu()
+            out.append(Transition(self.states[i].cpu(), self.actions[i].view(1, 1).cpu(), next_state,
+                                  self.rewards[i].view(1).cpu()))
+        return out
+
+    def __len__(self):
+        return self.size
+
+
+class SumTree(object):
+    """
+    Array-backed binary sum-tree over `capacity` leaves (padded to a power of two): node i holds
+    the sum of nodes 2i and 2i+1, the root is node 1. Both batched operations walk the tree level by
+    level, vectorized over the batch: O(B log N).
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.leaves = 1 << max(int(np.ceil(np.log2(max(capacity, 1)))), 0)
+        self.depth = int(np.log2(self.leaves))
+        self.tree = np.zeros(2 * self.leaves)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def __getitem__(self, indices):
+        return self.tree[self.leaves + np.asarray(indices)]
+
+    def update(self, indices, priorities):
+        """sets the priorities of leaves indices (a repeated index keeps the last value)"""
+        nodes = self.leaves + np.asarray(indices, dtype=np.int64)
+        self.tree[nodes] = priorities
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            if nodes[0] == 1:
+                break
+            nodes = np.unique(nodes // 2)
+
+    def find(self, values):
+        """leaf index whose cumulative priority interval contains each value in [0, total)"""
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            right = values > self.tree[left]
+            values -= np.where(right, self.tree[left], 0.)
+            nodes = left + right
+        return nodes - self.leaves
+
+
+class PrioritizedReplayMemory(TensorReplayMemory):
+    """
+    Proportional prioritized replay: transition i is sampled with probability p_i^alpha / sum p^alpha,
+    p_i = |TD error| + eps, new transitions enter with the largest priority seen so far.
+    Batches carry importance sampling weights (N P(i))^-beta normalized by the batch maximum;
+    beta anneals from beta to 1 over beta_steps calls to sample(). Feed the TD errors of a batch
+    back with update_priorities(batch.indices, td_errors, batch.generations); slots that were
+    overwritten by push() in between keep the priority of their new transition.
+    """
+
+    def __init__(self, capacity, state_dim=8, device='cpu', alpha=0.6, beta=0.4, beta_steps=10000, eps=1e-3):
+        super(PrioritizedReplayMemory, self).__init__(capacity, state_dim, device)
+        self.tree = SumTree(capacity)
+        self.alpha = alpha
+        self.beta0 = beta
+        self.beta_steps = beta_steps
+        self.eps = eps
+        self.max_priority = 1.
+        self.sampled = 0
+        self.generation = np.zeros(capacity, dtype=np.int64)   # writes per slot
+        self.rng = np.random.default_rng()
+
+    @property
+    def beta(self):
+        return self.beta0 + (1. - self.beta0) * min(1., self.sampled / self.beta_steps)
+
+    def push(self, state, action, next_state, reward):
+        i = super(PrioritizedReplayMemory, self).push(state, action, next_state, reward)
+        self.generation[i] += 1
+        self.tree.update([i], self.max_priority ** self.alpha)
+        return i
+
+    def sample(self, batch_size):
+        # stratified: one draw from each of batch_size equal slices of the total priority
+        total = self.tree.total
+        values = (np.arange(batch_size) + self.rng.random(batch_size)) * (total / batch_size)
+        indices = np.minimum(self.tree.find(np.minimum(values, np.nextafter(total, 0))), self.size - 1)
+        probs = self.tree[indices] / total
+        weights = (self.size * probs) ** -self.beta
+        weights /= weights.max()
+        self.sampled += 1
+        batch = self.batch(torch.as_tensor(indices, device=self.device))
+        return batch._replace(weights=torch.as_tensor(weights, dtype=torch.float32, device=self.device),
+                              generations=self.generation[indices].copy())
+
+    def update_priorities(self, indices, td_errors, generations=None):
+        """new priorities for a whole batch at once; with the batch's generations, slots rewritten
+        since it was sampled are left alone"""
+        if torch.is_tensor(indices):
+            indices = indices.cpu().numpy()
+        if torch.is_tensor(td_errors):
+            td_errors = td_errors.detach().cpu().numpy()
+        indices = np.asarray(indices, dtype=np.int64)
+        priorities = np.abs(np.asarray(td_errors, dtype=np.float64)).reshape(-1) + self.eps
+        if generations is not None:
+            current = self.generation[indices] == generations
+            indices, priorities = indices[current], priorities[current]
+            if not len(indices):
+                return
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.tree.update(indices, priorities ** self.alpha)
@@ -0,0 +1,199 @@
+""" multi-objective PCSEL score and offline reward relabeling.
+    The score of a design only depends on its five simulated metrics (Q, lam, power, area, div_angle),
+    so logged trajectories that keep those metrics can be rescored for new goals or weights without
+    touching the solver:
+
+        python reward.py test_onehot.pkl relabeled_onehot.pkl --beta 50 --Q_goal 1e7
+"""
+
+import argparse
+import pickle
+import numpy as np
+
+GOALS = {
+    'Q_goal': 5.0e+6,
+    'lam_goal': 1310.0,    #or 980 nm
+    'area_goal': 3.6e-13,  #area >= 3.6e-13 m^2
+    'P_goal': 0.3,         #output power/injecting power >= 30%
+    'div_goal': 1.0,       # divergence angle <= 1 degree
+}
+
+WEIGHTS = {
+    'gamma': 1,    # Q factor
+    'eps': 1,      # resonance wavelength
+    'beta': 100,   # mode area
+    'alpha': 100,  # output power
+    'eta': 20,     # divergence
+}
+
+
+def score(metrics, goals=None, weights=None):
+    """ score of metrics [..., 5] = (Q, lam, power, area, div_angle), vectorized over leading axes
+    """
+    goals = dict(GOALS, **(goals or {}))
+    weights = dict(WEIGHTS, **(weights or {}))
+    metrics = np.asarray(metrics, dtype=np.float64)
+    Q, lam, power, area, div_angle = np.moveaxis(metrics, -1, 0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r1 = weights['gamma'] * (1 - (goals['Q_goal'] - Q) / goals['Q_goal'])
+        r2 = weights['eps'] / (1 - np.abs(goals['lam_goal'] - lam) / goals['lam_goal'])
+        r3 = weights['beta'] * (1 - (goals['area_goal'] - area) / goals['area_goal'])
+        r4 = weights['alpha'] * (1 - (goals['P_goal'] - power) / goals['P_goal'])
+        r5 = weights['eta'] * (1 + (goals['div_goal'] - div_angle) / goals['div_goal'])
+    return (r1 + r2 + r3 + r4 + r5).astype(np.float32)
+
+
+def episode_starts(lengths):
+    """boolean mask over the concatenated transitions marking the first step of every episode"""
+    starts = np.zeros(int(np.sum(lengths)), dtype=bool)
+    starts[np.cumsum(lengths)[:-1]] = True
+    if len(starts):
+        starts[0] = True
+    return starts
+
+
+def penalize_out_of_bounds(scores, starts, start_scores, penalties):
+    """ scores of the out-of-range moves an env rejected without simulating (penalties not NaN):
+        the score of the last simulated design of the episode (its start design's for none yet)
+        minus the penalty, as FdtdEnv.reject scores them
+    """
+    scores = np.array(scores, dtype=np.float32)
+    penalties = np.asarray(penalties, dtype=np.float64)
+    oob = np.isfinite(penalties)
+    if not oob.any():
+        return scores
+    rows = np.arange(len(scores))
+    # latest simulated row so far and first row of the current episode, for every row
+    last = np.maximum.accumulate(np.where(oob, -1, rows))
+    first = np.maximum.accumulate(np.where(starts, rows, 0))
+    start_scores = np.broadcast_to(np.asarray(start_scores, dtype=np.float32), (int(starts.sum()),))
+    base = np.where(last >= first, scores[np.maximum(last, 0)], start_scores[np.cumsum(starts) - 1])
+    scores[oob] = base[oob] - penalties[oob]
+    return scores
+
+
+def rewards_from_scores(scores, starts, start_scores=0.):
+    """ the agents are rewarded with the change of score; the first step of an episode is measured
+        against the score of the design the episode started from, start_scores (one per episode),
+        0 for a plain reset whose start design was never simulated, as FdtdEnv.last_score after reset()
+    """
+    scores = np.asarray(scores, dtype=np.float32)
+    rewards = np.empty_like(scores)
+    rewards[0:1] = scores[0:1]
+    rewards[1:] = np.diff(scores)
+    rewards[starts] = scores[starts] - np.asarray(start_scores, dtype=np.float32)
+    return rewards
+
+
+def returns_to_go(rewards, starts, gamma=1.):
+    """ reward-to-go of every transition, restarted at every episode boundary
+    """
+    rewards = np.asarray(rewards, dtype=np.float64)
+    if gamma == 1.:
+        # reverse cumulative sum, minus whatever belongs to the later episodes
+        tail = np.cumsum(rewards[::-1])[::-1]
+        ends = np.append(np.flatnonzero(starts)[1:], len(rewards))
+        episode_of = np.cumsum(starts) - 1
+        after = np.append(tail, 0.)[ends]
+        return tail - after[episode_of]
+    rtg = np.zeros_like(rewards)
+    bounds = np.append(np.flatnonzero(starts), len(rewards))
+    for s, e in zip(bounds[:-1], bounds[1:]):
+        acc = 0.
+        for t in range(e - 1, s - 1, -1):
+            acc = rewards[t] + gamma * acc
+            rtg[t] = acc
+    return rtg
+
+
+def path_metrics(path, cache=None):
+    """ raw metrics of every transition of a path; older datasets without them fall back to a SimCache
+        lookup of the reached states, which never runs the solver
+    """
+    if 'metrics' in path:
+        return np.asarray(path['metrics'], dtype=np.float64)
+    if cache is None:
+        raise KeyError('path has no metrics and no SimCache was given to look them up')
+    metrics = []
+    oob = np.isfinite(path_penalties(path))
+    for state, rejected in zip(path['next_observation'], oob):
+        if rejected:
+            # never simulated, scored from the penalty (see penalize_out_of_bounds)
+            metrics.append((np.nan,) * 5)
+            continue
+        result = cache.get(state)
+        if result is None:
+            raise KeyError('state {} is neither in the path metrics nor in the cache'.format(state))
+        metrics.append(result)
+    return np.asarray(metrics, dtype=np.float64)
+
+
+def path_penalties(path):
+    """per step oob_penalty of a path, NaN for the steps that were simulated (and for older datasets)"""
+    if 'oob_penalty' in path:
+        return np.asarray(path['oob_penalty'], dtype=np.float64)
+    return np.full(len(path['rewards']), np.nan)
+
+
+def relabel_paths(paths, goals=None, weights=None, cache=None, gamma=1.):
+    """ rescored copies of paths (the dicts used by my_experiment.py) in one vectorized pass;
+        adds 'metrics', 'scores' and 'rtg' and replaces 'rewards'. A path that branched from a
+        simulated design keeps that design's metrics as 'start_metrics'. Steps carrying an
+        'oob_penalty' were rejected out-of-range moves and keep being scored that way
+    """
+    metrics = [path_metrics(path, cache) for path in paths]
+    lengths = np.array([len(m) for m in metrics])
+    if not len(paths):
+        return []
+    all_metrics = np.concatenate(metrics, axis=0)
+    starts = episode_starts(lengths)
+
+    scores = score(all_metrics, goals, weights)
+    start_scores = np.array([score(path['start_metrics'], goals, weights) if path.get('start_metrics') is not None
+                             else 0. for path in paths], dtype=np.float32)
+    scores = penalize_out_of_bounds(scores, starts, start_scores, np.concatenate([path_penalties(p) for p in paths]))
+    rewards = rewards_from_scores(scores, starts, start_scores)
+    rtg = returns_to_go(rewards, starts, gamma)
+
+    relabeled = []
+    splits = np.cumsum(lengths)[:-1]
+    for path, m, s, r, g in zip(paths, metrics, np.split(scores, splits), np.split(rewards, splits), np.split(rtg, splits)):
+        new_path = dict(path)
+        new_path['metrics'] = m
+        new_path['scores'] = s
+        new_path['rewards'] = r
+        new_path['rtg'] = g
+        relabeled.append(new_path)
+    return relabeled
+
+
+def relabel_file(src, dst, goals=None, weights=None, cache=None, gamma=1.):
+    with open(src, 'rb') as f:
+        paths = pickle.load(f)
+    paths = relabel_paths(paths, goals, weights, cache, gamma)
+    with open(dst, 'wb') as f:
+        pickle.dump(paths, f)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='rescore a trajectory .pkl with new goals / weights, no simulation')
+    parser.add_argument('src', type=str)
+    parser.add_argument('dst', type=str)
+    parser.add_argument('--cache', type=str, default=None, help='SimCache file for paths without stored metrics')
+    parser.add_argument('--discount', type=float, default=1.)
+    for name, value in list(GOALS.items()) + list(WEIGHTS.items()):
+        parser.add_argument('--' + name, type=float, default=value)
+    args = parser.parse_args()
+
+    cache = None
+    if args.cache is not None:
+        from sim_cache import SimCache
+        cache = SimCache(args.cache)
+    paths = relabel_file(args.src, args.dst,
+                         goals={k: getattr(args, k) for k in GOALS},
+                         weights={k: getattr(args, k) for k in WEIGHTS},
+                         cache=cache, gamma=args.discount)
+    print('relabeled {} trajectories, {} transitions -> {}'.format(
+        len(paths), sum(len(p['rewards']) for p in paths), args.dst))
@@ -15,10 +15,14 @@ class trajsaver:
         self.action_buf=[]
         self.reward_buf=[]
         self.done_buf=[]
+        self.metrics_buf=[]
+        self.oob_buf=[]
         self.output_buf=[]
         self.address=address
-    def store(self,o, a, r, o2, d) -> None:
+    def store(self,o, a, r, o2, d, metrics=None, oob_penalty=np.nan) -> None:
         self.reward_buf.append(r)
+        self.metrics_buf.append(metrics)
+        self.oob_buf.append(oob_penalty)
         self.obs_buf.append(o)
         self.obs2_buf.append(o2)
         self.action_buf.append(a)
@@ -31,12 +35,19 @@ class trajsaver:
             "terminals":self.done_buf,
             "actions":self.action_buf
         }
+        # raw simulation metrics (FdtdEnv info) so reward.py can rescore without the solver
+        if all(m is not None for m in self.metrics_buf):
+            trajs["metrics"]=self.metrics_buf
+            # penalties of the rejected out-of-range moves, NaN for simulated steps
+            trajs["oob_penalty"]=self.oob_buf
         self.output_buf.append(trajs)
         self.obs_buf=[]
         self.obs2_buf=[]
         self.action_buf=[]
         self.reward_buf=[]
         self.done_buf=[]
+        self.metrics_buf=[]
+        self.oob_buf=[]
     def dump(self,identity) -> None:
         with open(self.address+identity,"wb") as f :
             pickle.dump(self.output_buf,file=f)
@@ -79,7 +90,7 @@ def sac(env_fn, actor_critic=core.MLPActorCritic, ac_kwargs=dict(), seed=0,
         steps_per_epoch=4000, epochs=100, replay_size=int(1e6), gamma=0.99, 
         polyak=0.995, lr=1e-3, alpha=0.2, batch_size=100, start_steps=10000, 
         update_after=1000, update_every=50, num_test_episodes=10, max_ep_len=1000, 
-        logger_kwargs=dict(), save_freq=1,save_address=None):
+        logger_kwargs=dict(), save_freq=1,save_address=None, vec_env_fn=None):
     """
     Soft Actor-Critic (SAC)
 
@@ -175,6 +186,12 @@ def sac(env_fn, actor_critic=core.MLPActorCritic, ac_kwargs=dict(), seed=0,
         save_freq (int): How often (in terms of gap between epochs) to save
             the current policy and value function.
 
+        vec_env_fn : Optional function creating a vectorized env (e.g. a
+            ``FdtdVecEnv`` of ``FdtdEnv_v1`` copies) to collect experience
+            with; its envs are stepped together and their simulations run as
+            one batch. ``env_fn`` then only provides the spaces and the time
+            limit.
+
     """
     first_after=False
     traj_saver=trajsaver(address=save_address)
@@ -311,9 +328,98 @@ def sac(env_fn, actor_critic=core.MLPActorCritic, ac_kwargs=dict(), seed=0,
                 ep_len += 1
             logger.store(TestEpRet=ep_ret, TestEpLen=ep_len)
 
+    def maybe_update(t):
+        if t >= update_after and t % update_every == 0:
+            for j in range(update_every):
+                batch = replay_buffer.sample_batch(batch_size)
+                update(data=batch)
+
+    def end_epoch(t):
+        epoch = (t+1) // steps_per_epoch
+        traj_saver.dump(f"steps={epoch}.pkl")
+        # Save model
+        if (epoch % save_freq == 0) or (epoch == epochs):
+            logger.save_state({'env': env}, None)
+
+        # Test the performance of the deterministic version of the agent.
+        #test_agent()
+        
+        #for fdtd test cost time too...
+        
+        # Log info about epoch
+        logger.log_tabular('Epoch', epoch)
+        logger.log_tabular('EpRet', with_min_and_max=True)
+        #logger.log_tabular('TestEpRet', with_min_and_max=True)
+        logger.log_tabular('EpLen', average_only=True)
+        #logger.log_tabular('TestEpLen', average_only=True)
+        logger.log_tabular('TotalEnvInteracts', t)
+        # logger.log_tabular('Q1Vals', with_min_and_max=True)
+        # logger.log_tabular('Q2Vals', with_min_and_max=True)
+        # logger.log_tabular('LogPi', with_min_and_max=True)
+        # logger.log_tabular('LossPi', average_only=True)
+        # logger.log_tabular('LossQ', average_only=True)
+        logger.log_tabular('Time', time.time()-start_time)
+        logger.dump_tabular()
+
+    def collect_vec(venv):
+        # same bookkeeping as the loop below, for venv.num_envs envs stepped together: actions for all
+        # of them in one forward pass, one batch of simulations, every env with its own episode
+        nonlocal first_after
+        n = venv.num_envs
+        o = venv.reset()
+        ep_ret, ep_len = np.zeros(n), np.zeros(n, dtype=int)
+        pending = [[] for _ in range(n)]
+        t = 0
+        while t < total_steps:
+            if t > start_steps:
+                a = get_action(o)
+            else:
+                a = np.stack([venv.action_space.sample() for _ in range(n)])
+            o2, r, d, infos = venv.step(a)
+            for i in range(n):
+                ep_ret[i] += r[i]
+                ep_len[i] += 1
+                # finished envs were reset by the vec env, their last observation is in infos
+                final = infos[i].get('terminal_observation', o2[i])
+                di = False if ep_len[i]==horizon else bool(d[i])
+                replay_buffer.store(o[i], a[i], r[i], final, di)
+                pending[i].append((o[i], a[i], r[i], final, di, infos[i].get('metrics'),
+                                   infos[i].get('oob_penalty', np.nan)))
+
+                if d[i] or (ep_len[i] == horizon):
+                    logger.store(EpRet=ep_ret[i], EpLen=ep_len[i])
+                    for transition in pending[i]:
+                        traj_saver.store(*transition)
+                    traj_saver.save_traj()
+                    pending[i] = []
+                    if not d[i]:
+                        o2[i] = venv.envs[i].reset()
+                    ep_ret[i], ep_len[i] = 0, 0
+                    if (not first_after) and t>start_steps:
+                        traj_saver.dump("random.pkl")
+                        first_after=True
+
+                maybe_update(t)
+                if (t+1) % steps_per_epoch == 0:
+                    end_epoch(t)
+                t += 1
+            o = o2
+
+    # Envs with step_async/step_wait (FdtdEnv) simulate in the background, so the
+    # gradient updates of a step can run while the solver is busy
+    async_env = hasattr(env.unwrapped, 'step_async')
+    # stepping env.unwrapped skips the TimeLimit wrapper, so the loop enforces the
+    # registered max_episode_steps itself, as a horizon like max_ep_len
+    time_limit = getattr(env.spec, 'max_episode_steps', None) if env.spec is not None else None
+    horizon = min(max_ep_len, time_limit) if time_limit else max_ep_len
+
     # Prepare for interaction with environment
     total_steps = steps_per_epoch * epochs
     start_time = time.time()
+    if vec_env_fn is not None:
+        collect_vec(vec_env_fn())
+        return
+
     o, ep_ret, ep_len = env.reset(), 0, 0
 
     # Main loop: collect experience in env and update/log each epoch
@@ -328,24 +434,29 @@ def sac(env_fn, actor_critic=core.MLPActorCritic, ac_kwargs=dict(), seed=0,
             a = env.action_space.sample()
 
         # Step the env
-        o2, r, d, _ = env.step(a)
+        if async_env:
+            env.unwrapped.step_async(a)
+            maybe_update(t)
+            o2, r, d, info = env.unwrapped.step_wait()
+        else:
+            o2, r, d, info = env.step(a)
         ep_ret += r
         ep_len += 1
 
         # Ignore the "done" signal if it comes from hitting the time
         # horizon (that is, when it's an artificial terminal signal
         # that isn't based on the agent's state)
-        d = False if ep_len==max_ep_len else d
+        d = False if ep_len==horizon else d
 
         # Store experience to replay buffer
         replay_buffer.store(o, a, r, o2, d)
-        traj_saver.store(o, a, r, o2, d)
+        traj_saver.store(o, a, r, o2, d, info.get('metrics'), info.get('oob_penalty', np.nan))
         # Super critical, easy to overlook step: make sure to update 
         # most recent observation!
         o = o2
 
         # End of trajectory handling
-        if d or (ep_len == max_ep_len):
+        if d or (ep_len == horizon):
             logger.store(EpRet=ep_ret, EpLen=ep_len)
             traj_saver.save_traj()
             o, ep_ret, ep_len = env.reset(), 0, 0
@@ -357,38 +468,12 @@ def sac(env_fn, actor_critic=core.MLPActorCritic, ac_kwargs=dict(), seed=0,
             #add result storeage
 
         # Update handling
-        if t >= update_after and t % update_every == 0:
-            for j in range(update_every):
-                batch = replay_buffer.sample_batch(batch_size)
-                update(data=batch)
+        if not async_env:
+            maybe_update(t)
 
         # End of epoch handling
         if (t+1) % steps_per_epoch == 0:
-            epoch = (t+1) // steps_per_epoch
-            traj_saver.dump(f"steps={epoch}.pkl")
-            # Save model
-            if (epoch % save_freq == 0) or (epoch == epochs):
-                logger.save_state({'env': env}, None)
-
-            # Test the performance of the deterministic version of the agent.
-            #test_agent()
-            
-            #for fdtd test cost time too...
-            
-            # Log info about epoch
-            logger.log_tabular('Epoch', epoch)
-            logger.log_tabular('EpRet', with_min_and_max=True)
-            #logger.log_tabular('TestEpRet', with_min_and_max=True)
-            logger.log_tabular('EpLen', average_only=True)
-            #logger.log_tabular('TestEpLen', average_only=True)
-            logger.log_tabular('TotalEnvInteracts', t)
-            # logger.log_tabular('Q1Vals', with_min_and_max=True)
-            # logger.log_tabular('Q2Vals', with_min_and_max=True)
-            # logger.log_tabular('LogPi', with_min_and_max=True)
-            # logger.log_tabular('LossPi', average_only=True)
-            # logger.log_tabular('LossQ', average_only=True)
-            logger.log_tabular('Time', time.time()-start_time)
-            logger.dump_tabular()
+            end_epoch(t)
 
 if __name__ == '__main__':
     import argparse
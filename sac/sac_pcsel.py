@@ -6,9 +6,11 @@ import torch
 import gym
 from functools import partial
 import os 
+from vec_env import FdtdVecEnv
+from fdtd_env import FdtdEnv_v1
 register(
     id='Fdtd_NB-v1',
-    entry_point='envs:FdtdEnv_v1',
+    entry_point='fdtd_env:FdtdEnv_v1',
     max_episode_steps=250,
     reward_threshold=250.0,
 )
@@ -31,4 +33,7 @@ def sac(env_fn, actor_critic=core.MLPActorCritic, ac_kwargs=dict(), seed=0,
 save_add='/home/ondemand/220019012/RLcode/sacres/sac2/'
 assert not os.path.exists(save_add)
 os.makedirs(save_add)
-Agent=sac.sac(lambda : gym.make('Fdtd_NB-v1'),save_address=save_add,start_steps=500,max_ep_len=250)
\ No newline at end of file
+# designs simulated at once; more than one collects with a FdtdVecEnv, one solver worker per env
+num_envs=1
+vec_env_fn=partial(FdtdVecEnv,num_envs,env_fn=FdtdEnv_v1) if num_envs>1 else None
+Agent=sac.sac(lambda : gym.make('Fdtd_NB-v1'),save_address=save_add,start_steps=500,max_ep_len=250,vec_env_fn=vec_env_fn)
\ No newline at end of file
@@ -0,0 +1,250 @@
+""" solver licence seat broker: trainers sharing a limited number of FDTD seats ask the broker for
+    a seat before opening a session instead of racing for the licence server. A local SQLite file
+    stands in for the seat server; every trainer process on the machine (or on a shared filesystem)
+    uses the same file.
+
+    Waiting requests are served by priority first (interactive evaluation above sweeps), then by
+    fair share (the trainer with the least recent seat time, decaying with a half-life), then FIFO.
+    Seats are leases renewed by their holder, so a crashed trainer frees its seats after `lease`
+    seconds. Usage is recorded per trainer.
+
+    FDTD_SEAT_BROKER=/shared/seats.sqlite FDTD_TRAINER=sweep FDTD_PRIORITY=0 python optim_PhC.py
+    python seat_broker.py status --broker /shared/seats.sqlite
+    python seat_broker.py set --broker /shared/seats.sqlite --seats 4
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+from sqlite_store import SQLiteStore
+
+WAITING, GRANTED, RELEASED, EXPIRED = 'waiting', 'granted', 'released', 'expired'
+
+
+class SeatTimeout(RuntimeError):
+    """no seat was granted within the requested timeout"""
+
+
+class Seat(object):
+    """ a granted seat; renewed in the background until release(). A seat whose lease ran out
+        before it could be renewed (e.g. the holder stalled) is `lost` and must not be used further
+    """
+
+    def __init__(self, broker, seat_id, trainer):
+        self.broker = broker
+        self.id = seat_id
+        self.trainer = trainer
+        self.granted = time.time()
+        self.lost = False
+        self._released = threading.Event()
+        self._heartbeat = threading.Thread(target=self._renew, daemon=True)
+        self._heartbeat.start()
+
+    def _renew(self):
+        while not self._released.wait(self.broker.lease / 3.):
+            if not self.broker.renew(self.id):
+                self.lost = True
+                break
+
+    def contended(self):
+        """True when a waiting trainer would be granted this seat before its holder, see SeatBroker.outranked"""
+        return self.broker.outranked(self.id)
+
+    def release(self):
+        if not self._released.is_set():
+            self._released.set()
+            self.broker.release(self.id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class SeatBroker(SQLiteStore):
+    """
+    Grants at most `seats` concurrent seats across all processes using the same file.
+    seats=None keeps the limit already stored in the file (1 for a new file).
+    """
+
+    synchronous = None   # seat grants are committed with SQLite's default durability
+
+    def __init__(self, path='fdtd_seats.sqlite', seats=None, lease=120., poll=0.5, half_life=3600.):
+        super(SeatBroker, self).__init__(path)
+        self.lease = lease
+        self.poll = poll
+        self.half_life = half_life
+        if seats is not None:
+            self.set_seats(seats)
+
+    def _setup(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS seats (id INTEGER PRIMARY KEY AUTOINCREMENT, trainer TEXT, '
+                     'priority INTEGER, host TEXT, status TEXT, requested REAL, granted REAL, released REAL, '
+                     'lease_until REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS seats_status ON seats (status)')
+        conn.execute('CREATE TABLE IF NOT EXISTS usage (trainer TEXT PRIMARY KEY, seconds REAL, decayed REAL, '
+                     'grants INTEGER, updated REAL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value REAL)')
+        conn.execute("INSERT OR IGNORE INTO config VALUES ('seats', 1)")
+
+    def set_seats(self, seats):
+        self._transaction(lambda conn: conn.execute("UPDATE config SET value = ? WHERE key = 'seats'", (seats,)))
+
+    def seats(self):
+        with self._lock:
+            return int(self._connect().execute("SELECT value FROM config WHERE key = 'seats'").fetchone()[0])
+
+    def _charge(self, conn, trainer, seconds, now):
+        # decayed usage is what fair share compares, seconds the plain total
+        row = conn.execute('SELECT decayed, updated FROM usage WHERE trainer = ?', (trainer,)).fetchone()
+        decayed = seconds
+        if row is not None:
+            decayed += row[0] * 0.5 ** ((now - row[1]) / self.half_life)
+        conn.execute('INSERT INTO usage (trainer, seconds, decayed, grants, updated) VALUES (?, ?, ?, 0, ?) '
+                     'ON CONFLICT(trainer) DO UPDATE SET seconds = seconds + ?, decayed = ?, updated = ?',
+                     (trainer, seconds, decayed, now, seconds, decayed, now))
+
+    def _expire(self, conn, now):
+        # holders and waiters that stopped renewing are gone
+        rows = conn.execute('SELECT id, trainer, granted FROM seats WHERE status = ? AND lease_until < ?',
+                            (GRANTED, now)).fetchall()
+        for seat_id, trainer, granted in rows:
+            conn.execute('UPDATE seats SET status = ?, released = ? WHERE id = ?', (EXPIRED, now, seat_id))
+            self._charge(conn, trainer, now - granted, now)
+        conn.execute('UPDATE seats SET status = ? WHERE status = ? AND lease_until < ?', (EXPIRED, WAITING, now))
+
+    def _shares(self, conn, now):
+        """decayed seat time of every trainer, seats held right now included"""
+        share = {trainer: decayed * 0.5 ** ((now - updated) / self.half_life)
+                 for trainer, decayed, updated in conn.execute('SELECT trainer, decayed, updated FROM usage')}
+        for trainer, granted in conn.execute('SELECT trainer, granted FROM seats WHERE status = ?', (GRANTED,)):
+            share[trainer] = share.get(trainer, 0.) + now - granted
+        return share
+
+    def _try_grant(self, request_id, now):
+        def grant(conn):
+            self._expire(conn, now)
+            conn.execute('UPDATE seats SET lease_until = ? WHERE id = ?', (now + self.lease, request_id))
+            seats = conn.execute("SELECT value FROM config WHERE key = 'seats'").fetchone()[0]
+            active = conn.execute('SELECT COUNT(*) FROM seats WHERE status = ?', (GRANTED,)).fetchone()[0]
+            free = int(seats) - active
+            if free <= 0:
+                return False
+            # priority, then fair share (least decayed usage now), then first come first served
+            share = self._shares(conn, now)
+            waiting = conn.execute('SELECT id, trainer, priority, requested FROM seats WHERE status = ?',
+                                   (WAITING,)).fetchall()
+            waiting.sort(key=lambda row: (-row[2], share.get(row[1], 0.), row[3]))
+            if request_id not in [row[0] for row in waiting[:free]]:
+                return False
+            conn.execute('UPDATE seats SET status = ?, granted = ? WHERE id = ?', (GRANTED, now, request_id))
+            trainer = conn.execute('SELECT trainer FROM seats WHERE id = ?', (request_id,)).fetchone()[0]
+            conn.execute('INSERT INTO usage (trainer, seconds, decayed, grants, updated) VALUES (?, 0, 0, 1, ?) '
+                         'ON CONFLICT(trainer) DO UPDATE SET grants = grants + 1', (trainer, now))
+            return True
+        return self._transaction(grant)
+
+    def acquire(self, trainer, priority=0, timeout=None):
+        """blocks until a seat is granted to trainer (or timeout seconds have passed)"""
+        start = time.time()
+        host = '{}:{}'.format(socket.gethostname(), os.getpid())
+        request_id = self._transaction(lambda conn: conn.execute(
+            'INSERT INTO seats (trainer, priority, host, status, requested, lease_until) VALUES (?, ?, ?, ?, ?, ?)',
+            (trainer, priority, host, WAITING, start, start + self.lease)).lastrowid)
+        while True:
+            now = time.time()
+            if self._try_grant(request_id, now):
+                return Seat(self, request_id, trainer)
+            if timeout is not None and now - start >= timeout:
+                self._transaction(lambda conn: conn.execute('DELETE FROM seats WHERE id = ? AND status = ?',
+                                                            (request_id, WAITING)))
+                raise SeatTimeout('no seat for {} after {:.0f} s'.format(trainer, now - start))
+            time.sleep(self.poll)
+
+    def renew(self, seat_id):
+        return self._transaction(lambda conn: conn.execute(
+            'UPDATE seats SET lease_until = ? WHERE id = ? AND status = ?',
+            (time.time() + self.lease, seat_id, GRANTED)).rowcount == 1)
+
+    def release(self, seat_id):
+        now = time.time()
+
+        def free(conn):
+            row = conn.execute('SELECT trainer, granted FROM seats WHERE id = ? AND status = ?',
+                               (seat_id, GRANTED)).fetchone()
+            if row is None:
+                return
+            conn.execute('UPDATE seats SET status = ?, released = ? WHERE id = ?', (RELEASED, now, seat_id))
+            self._charge(conn, row[0], now - row[1], now)
+        self._transaction(free)
+
+    def outranked(self, seat_id):
+        """ True when another trainer is waiting that the grant order would serve before the holder of
+            seat_id: a higher priority, or the same priority and a smaller fair share
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            holder = conn.execute('SELECT trainer, priority FROM seats WHERE id = ?', (seat_id,)).fetchone()
+            if holder is None:
+                return False
+            waiting = conn.execute('SELECT trainer, priority FROM seats WHERE status = ? AND lease_until >= ? '
+                                   'AND trainer IS NOT ? AND priority >= ?',
+                                   (WAITING, now, holder[0], holder[1])).fetchall()
+            if not waiting:
+                return False
+            share = self._shares(conn, now)
+        mine = share.get(holder[0], 0.)
+        return any(priority > holder[1] or share.get(trainer, 0.) < mine for trainer, priority in waiting)
+
+    def stats(self):
+        """seat limit, current grants and waiters, and the recorded usage of every trainer"""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            seats = conn.execute("SELECT value FROM config WHERE key = 'seats'").fetchone()[0]
+            live = conn.execute('SELECT trainer, status, COUNT(*) FROM seats WHERE status IN (?, ?) AND lease_until >= ? '
+                                'GROUP BY trainer, status', (GRANTED, WAITING, now)).fetchall()
+            usage = conn.execute('SELECT trainer, seconds, decayed, grants, updated FROM usage').fetchall()
+        trainers = {}
+        for trainer, seconds, decayed, grants, updated in usage:
+            trainers[trainer] = {'seconds': seconds, 'grants': grants, GRANTED: 0, WAITING: 0,
+                                 'share': decayed * 0.5 ** ((now - updated) / self.half_life)}
+        for trainer, status, count in live:
+            trainers.setdefault(trainer, {'seconds': 0., 'grants': 0, GRANTED: 0, WAITING: 0, 'share': 0.})
+            trainers[trainer][status] = count
+        return {
+            'seats': int(seats),
+            GRANTED: sum(t[GRANTED] for t in trainers.values()),
+            WAITING: sum(t[WAITING] for t in trainers.values()),
+            'trainers': trainers,
+        }
+
+
+def default_trainer():
+    return os.environ.get('FDTD_TRAINER') or os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0] or 'python'
+
+
+def from_environment():
+    """(broker, trainer, priority) configured by FDTD_SEAT_BROKER / FDTD_TRAINER / FDTD_PRIORITY, or None"""
+    path = os.environ.get('FDTD_SEAT_BROKER')
+    if not path:
+        return None
+    return SeatBroker(path), default_trainer(), int(os.environ.get('FDTD_PRIORITY', 0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='FDTD licence seat broker')
+    parser.add_argument('command', choices=['status', 'set'])
+    parser.add_argument('--broker', type=str, default='fdtd_seats.sqlite')
+    parser.add_argument('--seats', type=int, default=None)
+    args = parser.parse_args()
+
+    broker = SeatBroker(args.broker, seats=args.seats if args.command == 'set' else None)
+    print(json.dumps(broker.stats(), indent=2))
@@ -0,0 +1,121 @@
+""" disk-backed memoization of FDTD simulation results, keyed by the quantized design state.
+    One SQLite file can be shared by several processes and training runs.
+"""
+
+import time
+import numpy as np
+
+from sqlite_store import SQLiteStore
+
+# size of one lattice step for each of the 8 state variables
+# (netDLen, netDT, netDT1, netDT3, netDN1, netDN3, netDLeng, netDA), same units as FdtdEnv.state
+DEFAULT_RESOLUTION = (25., 2.5, 2.5, 2.5, 0.005, 0.005, 0.005, 2.5)
+
+METRICS = ('Q', 'lam', 'power', 'area', 'div_angle')
+
+# fidelity label of results that came straight from the full solver (see fidelity.py)
+FULL = 'full'
+
+
+class SimCache(SQLiteStore):
+    """ persistent (state -> (Q, lam, power, area, div_angle)) cache with LRU eviction.
+
+        States are snapped to the action lattice before lookup so that floating point drift
+        accumulated over many +/- steps still maps to the same entry.
+    """
+
+    def __init__(self, path='fdtd_cache.sqlite', max_entries=100000, resolution=DEFAULT_RESOLUTION):
+        super(SimCache, self).__init__(path)
+        self.max_entries = max_entries
+        self.resolution = np.asarray(resolution, dtype=np.float64)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _setup(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, '
+                     'q REAL, lam REAL, power REAL, area REAL, div REAL, '
+                     'hits INTEGER DEFAULT 0, created REAL, last_used REAL, fidelity TEXT DEFAULT \'full\')')
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(results)')]
+        if 'fidelity' not in columns:
+            # caches written before results carried their fidelity only hold full solver results
+            conn.execute("ALTER TABLE results ADD COLUMN fidelity TEXT DEFAULT 'full'")
+        conn.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+
+    def key(self, state):
+        """map a state onto its integer lattice coordinates"""
+        idx = np.rint(np.asarray(state, dtype=np.float64) / self.resolution).astype(np.int64)
+        return ','.join(str(i) for i in idx)
+
+    def get(self, state):
+        """return the cached metrics tuple for state, or None on a miss"""
+        entry = self.get_entry(state)
+        return None if entry is None else entry[0]
+
+    def get_entry(self, state):
+        """return (metrics tuple, fidelity) for state, or None on a miss"""
+        key = self.key(state)
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute('SELECT q, lam, power, area, div, fidelity FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute('UPDATE results SET hits = hits + 1, last_used = ? WHERE key = ?', (time.time(), key))
+            self.hits += 1
+        return tuple(row[:5]), row[5]
+
+    def put(self, state, result, fidelity=FULL):
+        """store the metrics tuple (Q, lam, power, area, div_angle) for state, and the fidelity that produced it"""
+        key = self.key(state)
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute('INSERT OR REPLACE INTO results (key, q, lam, power, area, div, hits, created, last_used, fidelity) '
+                         'VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?, ?)',
+                         (key,) + tuple(float(v) for v in result) + (now, now, fidelity))
+            self._evict(conn)
+
+    def _evict(self, conn):
+        # drop the least recently used entries once the table outgrows max_entries
+        if self.max_entries is None:
+            return
+        size = conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        excess = size - self.max_entries
+        if excess > 0:
+            conn.execute('DELETE FROM results WHERE key IN '
+                         '(SELECT key FROM results ORDER BY last_used ASC LIMIT ?)', (excess,))
+            self.evictions += excess
+
+    def items(self):
+        """all entries as (state, metrics tuple, fidelity), states rebuilt from their lattice keys"""
+        with self._lock:
+            rows = self._connect().execute('SELECT key, q, lam, power, area, div, fidelity FROM results').fetchall()
+        for row in rows:
+            state = np.array([int(i) for i in row[0].split(',')]) * self.resolution
+            yield tuple(state.tolist()), tuple(row[1:6]), row[6]
+
+    def __contains__(self, state):
+        key = self.key(state)
+        with self._lock:
+            row = self._connect().execute('SELECT 1 FROM results WHERE key = ?', (key,)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._connect().execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def stats(self):
+        """hit/miss counters of this process plus the current size of the shared cache"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.,
+            'evictions': self.evictions,
+            'size': len(self),
+        }
+
+    def clear(self):
+        with self._lock:
+            self._connect().execute('DELETE FROM results')
@@ -0,0 +1,302 @@
+""" keeps FDTD solver sessions warm between steps: the project is loaded and the PCSEL geometry is
+    built once per session, later designs only push the parameters that changed (setnamed deltas).
+    FakeSession is a local stand-in for lumapi.FDTD so the whole path runs without the real solver.
+"""
+
+import ast
+import queue
+import threading
+from collections import Counter
+import numpy as np
+
+from pcsel_geometry import setnamed_script
+import seat_broker as seat_broker_module
+
+try:
+    import lumapi as lp
+except ImportError:
+    # sys.path.append("C:\\Program Files\\Lumerical\\v202\\api\\python\\") to pick up the real solver
+    lp = None
+
+
+def lumerical_session():
+    """opens a real (hidden) FDTD session"""
+    if lp is None:
+        raise RuntimeError('lumapi is not available, cannot open an FDTD session')
+    return lp.FDTD(hide=True)
+
+
+class FakeSession(object):
+    """
+    Minimal in-process imitation of the lumapi.FDTD calls used by FdtdRlNanobeam.
+    Object properties set through set/setnamed are stored, run() derives smooth synthetic
+    results from them, and every API call is counted in self.calls. eval() understands the
+    plain `name(args);` scripts produced by pcsel_geometry; round_trips counts the calls that
+    would have crossed the process boundary to the solver.
+    Setting fail_after=n makes the session die on its n-th call, to exercise reconnects.
+    """
+
+    def __init__(self, fail_after=None):
+        self.calls = Counter()
+        self.round_trips = 0
+        self.fail_after = fail_after
+        self.alive = True
+        self._in_eval = False
+        self.objects = {}   # (name, index) -> {property: value}
+        self._current = None
+        self._results = None
+
+    def _call(self, name):
+        if not self.alive:
+            raise RuntimeError('FDTD session is closed')
+        self.calls[name] += 1
+        if not self._in_eval:
+            self.round_trips += 1
+        if self.fail_after is not None and sum(self.calls.values()) >= self.fail_after:
+            self.alive = False
+            raise RuntimeError('FDTD session died')
+
+    def _add(self, kind):
+        index = sum(1 for (name, _) in self.objects if name == kind) + 1
+        self._current = (kind, index)
+        self.objects[self._current] = {}
+
+    def eval(self, script):
+        self._call('eval')
+        self._in_eval = True
+        try:
+            for statement in script.split(';'):
+                statement = statement.strip()
+                if not statement:
+                    continue
+                name, _, args = statement.partition('(')
+                args = ast.literal_eval('(' + args.rstrip(')') + ',)') if args.rstrip(')') else ()
+                getattr(self, name.strip())(*args)
+        finally:
+            self._in_eval = False
+
+    # structure editing
+    def load(self, path):
+        self._call('load')
+        self.objects[('FDTD', 1)] = {'mesh accuracy': 2, 'simulation time': 1000e-15}
+
+    def switchtolayout(self):
+        self._call('switchtolayout')
+
+    def unselectall(self):
+        self._call('unselectall')
+
+    def selectall(self):
+        self._call('selectall')
+
+    def select(self, name):
+        self._call('select')
+
+    def delete(self):
+        self._call('delete')
+
+    def save(self, *args):
+        self._call('save')
+
+    def addstructuregroup(self):
+        self._call('addstructuregroup')
+        self._add('group')
+
+    def adduserprop(self, name, kind, value):
+        self._call('adduserprop')
+        self.objects[self._current][name] = value
+
+    def addrect(self):
+        self._call('addrect')
+        self._add('rectangle')
+
+    def addcircle(self):
+        self._call('addcircle')
+        self._add('circle')
+
+    def addtogroup(self, group):
+        self._call('addtogroup')
+
+    def set(self, prop, value):
+        self._call('set')
+        self.objects[self._current][prop] = value
+
+    def runsetup(self):
+        self._call('runsetup')
+
+    def getnamed(self, name, prop, index=1):
+        self._call('getnamed')
+        return self.objects[(name.split('::')[-1], index)][prop]
+
+    def setnamed(self, name, prop, value, index=1):
+        self._call('setnamed')
+        self.objects[(name.split('::')[-1], index)][prop] = value
+
+    # simulation and results
+    def run(self):
+        self._call('run')
+        rect = [self.objects[('rectangle', i)] for i in range(1, 5)]
+        radius = self.objects[('circle', 1)]['radius']
+        width = rect[0]['x span']
+        # coarser meshes shift the resonance and underestimate Q a little, as the real solver does
+        coarse = 2 - self.objects[('FDTD', 1)]['mesh accuracy']
+        # smooth, made-up responses with plausible magnitudes
+        fill = radius / 200e-9
+        lam = 1310. * (1 + 0.4 * (rect[1]['index'] - 3.2035) + 0.3 * (rect[2]['index'] - 3.415)
+                       + 2e5 * (rect[1]['z span'] - 450e-9) + 1e5 * (rect[2]['z span'] - 315e-9)) + 1.5 * coarse
+        Q = 1e5 * np.exp(-((fill - 0.52) / 0.2) ** 2) * (1 + 1e6 * (rect[0]['z span'] - 100e-9)) * (1 - 0.1 * coarse)
+        power = 0.3 * np.exp(-((fill - 0.5) / 0.3) ** 2)
+        area = (width / 3.) ** 2
+        sigma = 0.01 * 2000e-9 / width   # far-field width in direction cosines
+        u = np.linspace(-1, 1, 200)
+        E2 = np.exp(-(u[:, None] ** 2 + u[None, :] ** 2) / (2 * sigma ** 2))
+        self._results = {
+            ('::model::Q::Qanalysis 5', 'Q'): {'Q': np.array([Q * 0.9, Q])},
+            ('::model::Q::Qanalysis 5', 'Q.peak_lam'): {'peak_lam': np.array([lam, lam])},
+            ('::model::Top', 'power'): np.array([[power * 3.98265e-14]]),
+            ('::model::mode_area', 'A'): np.array([[area]]),
+            ('::model::ffp', 'farfield.E2'): {'E2': E2[:, :, None], 'ux': u, 'uy': u},
+        }
+
+    def runanalysis(self):
+        self._call('runanalysis')
+
+    def getresult(self, name, result):
+        self._call('getresult')
+        return self._results[(name, result)]
+
+    def close(self):
+        self.alive = False
+
+
+class WarmSession(object):
+    """a solver session plus the parameter values it currently holds"""
+
+    def __init__(self, handle, seat=None):
+        self.handle = handle
+        self.seat = seat   # licence seat held by this session (see seat_broker.py)
+        self.pushed = {}
+
+    def push(self, params):
+        """setnamed only the (name, property, index) entries whose value differs from what the session holds"""
+        changed = {k: v for k, v in params.items() if self.pushed.get(k) != v}
+        if changed:
+            # all deltas go out as one script, a single round trip
+            self.handle.eval(setnamed_script(changed))
+            self.pushed.update(changed)
+        return len(changed)
+
+    def close(self):
+        try:
+            self.handle.close()
+        except Exception:
+            pass
+        if self.seat is not None:
+            self.seat.release()
+
+
+class SessionManager(object):
+    """
+    Pool of up to `size` warm sessions. `setup(handle)` is called once on every freshly opened
+    session (load the project, build the geometry). A session that raises while in use is
+    discarded and call() reopens a new one, up to max_reconnects times per call.
+    With a seat_broker every session holds a licence seat granted to (trainer, priority). A session
+    is closed instead of kept warm when a waiting trainer outranks this one for its seat (higher
+    priority or smaller fair share), and when its seat was lost.
+    Without one, FDTD_SEAT_BROKER / FDTD_TRAINER / FDTD_PRIORITY in the environment configure it.
+    """
+
+    def __init__(self, setup, session_factory=lumerical_session, size=1, max_reconnects=2,
+                 seat_broker=None, trainer=None, priority=None):
+        self.setup = setup
+        self.session_factory = session_factory
+        self.size = size
+        self.max_reconnects = max_reconnects
+        configured = seat_broker_module.from_environment() if seat_broker is None else None
+        if configured is not None:
+            seat_broker, env_trainer, env_priority = configured
+            trainer = trainer if trainer is not None else env_trainer
+            priority = priority if priority is not None else env_priority
+        self.seat_broker = seat_broker
+        self.trainer = trainer if trainer is not None else seat_broker_module.default_trainer()
+        self.priority = priority if priority is not None else 0
+        self.opened = 0
+        self.reconnects = 0
+        self._idle = queue.LifoQueue()
+        self._live = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if session.seat is not None and session.seat.lost:
+                self.discard(session)   # the seat expired while the session sat idle
+                continue
+            return session
+        with self._lock:
+            can_open = self._live < self.size
+            if can_open:
+                self._live += 1
+        if not can_open:
+            session = self._idle.get()
+            if session.seat is not None and session.seat.lost:
+                self.discard(session)
+                return self.acquire()
+            return session
+        seat = session = None
+        try:
+            if self.seat_broker is not None:
+                seat = self.seat_broker.acquire(self.trainer, self.priority)
+            session = WarmSession(self.session_factory(), seat)
+            self.setup(session.handle)
+        except Exception:
+            if session is not None:
+                session.close()   # the half set up handle and its seat
+            elif seat is not None:
+                seat.release()
+            with self._lock:
+                self._live -= 1
+            raise
+        self.opened += 1
+        return session
+
+    def release(self, session):
+        if session.seat is not None and (session.seat.lost or session.seat.contended()):
+            # the session runs without a seat, or somebody else needs it more than we need a warm session
+            self.discard(session)
+            return
+        self._idle.put(session)
+
+    def discard(self, session):
+        session.close()
+        with self._lock:
+            self._live -= 1
+
+    def call(self, fn):
+        """runs fn(session) on a warm session, reconnecting if the session dies (also while it is set up)"""
+        for attempt in range(self.max_reconnects + 1):
+            session = None
+            try:
+                # acquire() opens and sets up new sessions; it releases them itself when that fails
+                session = self.acquire()
+                result = fn(session)
+            except Exception:
+                if session is not None:
+                    self.discard(session)
+                if attempt == self.max_reconnects:
+                    raise
+                self.reconnects += 1
+                continue
+            self.release(session)
+            return result
+
+    def close(self):
+        while True:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(session)
@@ -0,0 +1,168 @@
+""" speculative pre-simulation: while the agent decides (or learns), spare solver workers simulate
+    the neighbours of the current design it is most likely to move to next. Finished speculations
+    go into the SimCache and are handed to FdtdEnv.simulate directly; a speculation still running
+    when the env needs it is waited for instead of being started again.
+
+        spec = SpeculativeScheduler(env.kernel, cache, num_workers=2)
+        env = FdtdEnv(cache=cache, speculator=spec)
+        env.action_probs = lambda obs: policy_probabilities(obs)   # optional ranking
+"""
+
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+
+from FdtdRlNanobeam import FdtdRlNanobeam, FailedResult
+from sim_cache import FULL
+from vec_env import _init_worker, _worker_simulate
+
+
+class SpeculativeScheduler(object):
+    """
+    Keeps up to `depth` neighbour simulations in flight on its own worker pool (each worker holds
+    its own warm solver session, built by solver_fn, which must be picklable).
+
+    speculate(state, probs) re-targets the pool at the neighbours of state, best ranked first;
+    queued speculations that are no longer wanted are cancelled, finished ones nobody claimed are
+    counted as unused. claim(state) returns the speculated result for state (waiting for it if it is
+    still running) or None.
+
+    check(state) -> bool, when set, leaves out designs that would not be simulated anyway (FdtdEnv
+    sets it to its feasibility check), so every speculated result is a full fidelity simulation.
+    """
+
+    def __init__(self, kernel, cache=None, solver_fn=FdtdRlNanobeam, num_workers=1, depth=None, executor=None,
+                 check=None):
+        self.kernel = kernel
+        self.cache = cache
+        self.check = check
+        self.depth = depth if depth is not None else num_workers
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(solver_fn,))
+        self.executor = executor
+        self._inflight = {}   # key -> (state, future, event)
+        self._ready = {}      # key -> result, finished and not claimed yet
+        self._lock = threading.RLock()   # done callbacks may run inline, under the lock
+        self.submitted = 0
+        self.cancelled = 0
+        self.completed = 0
+        self.failed = 0
+        self.used = 0
+        self.waited = 0
+        self.unused = 0
+        self.wait_seconds = 0.
+
+    def _key(self, state):
+        if self.cache is not None:
+            return self.cache.key(state)
+        return tuple(np.round(np.asarray(state, dtype=np.float64), 6).tolist())
+
+    def candidates(self, state, probs=None):
+        """in-range (and feasible) neighbours of state, most probable first; actions with zero probability are left out"""
+        neighbors = self.kernel.neighbors(state)
+        if probs is None:
+            order = np.arange(len(neighbors))
+        else:
+            probs = np.asarray(probs, dtype=np.float64)
+            order = [a for a in np.argsort(-probs, kind='stable') if probs[a] > 0]
+        inside = ~self.kernel.done(neighbors)
+        wanted = [tuple(neighbors[a].tolist()) for a in order if inside[a]]
+        if self.check is not None:
+            wanted = [s for s in wanted if self.check(s)]
+        return wanted
+
+    def speculate(self, state, probs=None):
+        """points the idle solver capacity at the likely successors of state"""
+        wanted = self.candidates(state, probs)
+        keys = [self._key(s) for s in wanted]
+        top = set(keys[:self.depth])
+        with self._lock:
+            for key in list(self._inflight):
+                # only queued jobs can be cancelled, running ones finish and are counted when unused
+                if key not in top and self._inflight[key][1].cancel():
+                    self.cancelled += 1
+            for key in list(self._ready):
+                if key not in top:
+                    del self._ready[key]
+                    self.unused += 1
+
+            free = self.depth - len(self._inflight)
+            for s, key in zip(wanted, keys):
+                if free <= 0:
+                    break
+                if key in self._inflight or key in self._ready:
+                    continue
+                if self.cache is not None and s in self.cache:
+                    continue
+                future = self.executor.submit(_worker_simulate, s)
+                self._inflight[key] = (s, future, threading.Event())
+                self.submitted += 1
+                free -= 1
+                future.add_done_callback(partial(self._finished, key))
+
+    def _finished(self, key, future):
+        with self._lock:
+            state, _, event = self._inflight.pop(key)
+            try:
+                if future.cancelled():
+                    return
+                try:
+                    result, _ = future.result()
+                except Exception:
+                    self.failed += 1
+                    return
+                if isinstance(result, FailedResult):
+                    # a watchdog fallback, the env simulates the design itself if it gets there
+                    self.failed += 1
+                    return
+                result = tuple(float(v) for v in result)
+                self.completed += 1
+                self._ready[key] = result
+            finally:
+                event.set()
+        if self.cache is not None:
+            self.cache.put(state, result, FULL)
+
+    def claim(self, state):
+        """speculated result for state, None when it was never speculated (or failed)"""
+        key = self._key(state)
+        with self._lock:
+            if key in self._ready:
+                self.used += 1
+                return self._ready.pop(key)
+            entry = self._inflight.get(key)
+        if entry is None:
+            return None
+        start = time.perf_counter()
+        entry[2].wait()
+        with self._lock:
+            result = self._ready.pop(key, None)
+            if result is not None:
+                self.used += 1
+                self.waited += 1
+                self.wait_seconds += time.perf_counter() - start
+        return result
+
+    def stats(self):
+        """how much speculation was started, thrown away and actually used"""
+        settled = self.used + self.unused
+        return {
+            'submitted': self.submitted,
+            'in_flight': len(self._inflight),
+            'completed': self.completed,
+            'cancelled': self.cancelled,
+            'failed': self.failed,
+            'used': self.used,
+            'used_while_running': self.waited,
+            'unused': self.unused,
+            'hit_rate': self.used / settled if settled else 0.,
+            'wait_seconds': self.wait_seconds,
+        }
+
+    def close(self):
+        with self._lock:
+            for _, future, _ in list(self._inflight.values()):
+                future.cancel()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,68 @@
+""" shared plumbing of the SQLite files behind sim_cache.py, job_queue.py and seat_broker.py: one
+    connection per process, short BEGIN IMMEDIATE transactions, and pickling without the connection
+    so the objects can be shipped to worker processes.
+"""
+
+import os
+import sqlite3
+import threading
+
+
+class SQLiteStore(object):
+    """
+    Base class of the objects that keep their state in one SQLite file at self.path, shared by any
+    number of threads, processes and hosts. Subclasses create their tables in _setup(conn).
+    """
+
+    synchronous = 'NORMAL'   # PRAGMA synchronous of the connections, None keeps SQLite's default
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _setup(self, conn):
+        """creates (or migrates) the tables on a new connection"""
+
+    def _connect(self):
+        # sqlite connections must not cross a fork, so reopen in every new process
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            if self.synchronous is not None:
+                conn.execute('PRAGMA synchronous={}'.format(self.synchronous))
+            self._setup(conn)
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def _transaction(self, fn):
+        with self._lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = fn(conn)
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            return result
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+    def __getstate__(self):
+        # each process that receives a copy reopens its own connection
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_pid'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
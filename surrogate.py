@@ -0,0 +1,145 @@
+""" online surrogate of the PCSEL solver: learns state -> (Q, lam, power, area, div_angle) from every
+    simulation as it arrives and answers for the solver when it is confident enough.
+
+    Each ensemble member is a Bayesian linear regression on random Fourier features (an approximate
+    GP with an RBF kernel) that only keeps its sufficient statistics, so an update costs one rank-k
+    accumulation whatever the amount of data seen so far. The members differ in their feature draws
+    and length scales; the predictive spread combines their own posterior variance with their
+    disagreement. Targets are regressed in fidelity.to_features space (log Q, lam, power, log area, div).
+
+        env = FdtdEnv(surrogate=Surrogate(threshold=0.05))
+"""
+
+import numpy as np
+
+from transition import MAX_DELTAS
+from fidelity import FEATURES, to_features, from_features
+
+# fidelity label of the results answered by the surrogate instead of the solver
+SURROGATE = 'surrogate'
+
+
+class RandomFeatureRegressor(object):
+    """ multi-output Bayesian ridge regression on n_features random Fourier features """
+
+    def __init__(self, n_inputs, n_outputs, n_features=256, lengthscale=0.5, ridge=1e-3, rng=None):
+        rng = rng if rng is not None else np.random.default_rng()
+        self.W = rng.normal(size=(n_inputs, n_features)) / lengthscale
+        self.b = rng.uniform(0, 2 * np.pi, n_features)
+        self.ridge = ridge
+        self.n = 0
+        self.A = np.zeros((n_features, n_features))   # sum phi phi^T
+        self.B = np.zeros((n_features, n_outputs))    # sum phi y^T
+        self.phi_sum = np.zeros(n_features)
+        self.y_sum = np.zeros(n_outputs)
+        self.yy_sum = np.zeros(n_outputs)
+        self._solved = None
+
+    def features(self, X):
+        return np.sqrt(2. / len(self.b)) * np.cos(np.asarray(X, dtype=np.float64) @ self.W + self.b)
+
+    def update(self, X, Y):
+        phi = self.features(X)
+        Y = np.asarray(Y, dtype=np.float64)
+        self.A += phi.T @ phi
+        self.B += phi.T @ Y
+        self.phi_sum += phi.sum(axis=0)
+        self.y_sum += Y.sum(axis=0)
+        self.yy_sum += (Y ** 2).sum(axis=0)
+        self.n += len(Y)
+        self._solved = None
+
+    def _solve(self):
+        # targets are centred on their running mean; the noise level comes out of the same statistics
+        if self._solved is None:
+            mean_y = self.y_sum / self.n
+            Bc = self.B - np.outer(self.phi_sum, mean_y)
+            L = np.linalg.cholesky(self.A + self.ridge * np.eye(len(self.A)))
+            w = np.linalg.solve(L.T, np.linalg.solve(L, Bc))
+            sse = self.yy_sum - self.n * mean_y ** 2 - 2 * (w * Bc).sum(axis=0) + (w * (self.A @ w)).sum(axis=0)
+            noise = np.maximum(sse, 0.) / self.n + 1e-12
+            self._solved = (mean_y, w, L, noise)
+        return self._solved
+
+    def predict(self, X):
+        """predictive mean and variance, [N, n_outputs] each"""
+        mean_y, w, L, noise = self._solve()
+        phi = self.features(X)
+        quad = (np.linalg.solve(L, phi.T) ** 2).sum(axis=0)
+        return mean_y + phi @ w, noise[None, :] * (1. + quad[:, None])
+
+
+class Surrogate(object):
+    """
+    Ensemble of RandomFeatureRegressors over states scaled by the action limits.
+    answer(state) returns the predicted metrics tuple when at least min_samples simulations have
+    been seen and the predictive std of every output, relative to the spread of that output in the
+    data, is below threshold; otherwise None and the caller runs the solver (and update()s).
+    """
+
+    def __init__(self, threshold=0.05, min_samples=50, n_members=4, n_features=256,
+                 lengthscales=(0.25, 0.5, 1., 2.), ridge=1e-3, scale=MAX_DELTAS, seed=0):
+        rng = np.random.default_rng(seed)
+        self.threshold = threshold
+        self.min_samples = min_samples
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.members = [RandomFeatureRegressor(len(self.scale), len(FEATURES), n_features,
+                                               lengthscales[i % len(lengthscales)], ridge, rng)
+                        for i in range(n_members)]
+        self.samples = 0
+        self.rejected = 0   # non-finite results that were not learned from
+        self.queries = 0
+        self.answered = 0
+        self.uncertainty_sum = 0.
+
+    def update(self, state, metrics):
+        y = to_features(metrics)
+        if not np.all(np.isfinite(y)):
+            self.rejected += 1
+            return
+        x = np.asarray(state, dtype=np.float64)[None, :] / self.scale
+        for member in self.members:
+            member.update(x, y[None, :])
+        self.samples += 1
+
+    def predict(self, states):
+        """mean and std in feature space, [N, 5] each"""
+        X = np.atleast_2d(np.asarray(states, dtype=np.float64)) / self.scale
+        means, variances = zip(*(member.predict(X) for member in self.members))
+        means = np.stack(means)
+        std = np.sqrt(np.mean(variances, axis=0) + means.var(axis=0))
+        return means.mean(axis=0), std
+
+    def target_spread(self):
+        first = self.members[0]
+        mean = first.y_sum / first.n
+        spread = np.sqrt(np.maximum(first.yy_sum / first.n - mean ** 2, 0.))
+        return np.where(spread > 0, spread, 1.)
+
+    def uncertainty(self, states):
+        """largest relative predictive std over the five outputs, [N]"""
+        _, std = self.predict(states)
+        return (std / self.target_spread()).max(axis=-1)
+
+    def answer(self, state):
+        self.queries += 1
+        if self.samples < self.min_samples:
+            return None
+        mean, std = self.predict(state)
+        uncertainty = float((std[0] / self.target_spread()).max())
+        if not uncertainty <= self.threshold:
+            return None
+        self.answered += 1
+        self.uncertainty_sum += uncertainty
+        return from_features(mean[0])
+
+    def stats(self):
+        """training set size and how many solver calls the surrogate has saved"""
+        return {
+            'samples': self.samples,
+            'rejected': self.rejected,
+            'queries': self.queries,
+            'solver_calls_avoided': self.answered,
+            'answer_rate': self.answered / self.queries if self.queries else 0.,
+            'mean_uncertainty': self.uncertainty_sum / self.answered if self.answered else 0.,
+        }
@@ -0,0 +1,67 @@
+""" array-native PCSEL design transitions shared by FdtdEnv, FdtdVecEnv and the offline dataset tools.
+    State (8): netDLen, netDT, netDT1, netDT3, netDN1, netDN3, netDLeng, netDA (nm / index units).
+    Action (16): 2*k increases state variable k by one step, 2*k+1 decreases it.
+"""
+
+import numpy as np
+
+# one step per state variable: deltaLen for the width, deltaTA for thicknesses and pitch, deltaN for indices and radius
+DELTA_LEN = 25
+DELTA_TA = 2.5
+DELTA_N = 0.005
+
+# limits for net geometrical changes, same order as the state
+MAX_DELTAS = (1000, 100, 50, 100, 0.15, 0.15, 0.3, 100)
+
+
+def step_sizes(deltaLen=DELTA_LEN, deltaTA=DELTA_TA, deltaN=DELTA_N):
+    return np.array([deltaLen, deltaTA, deltaTA, deltaTA, deltaN, deltaN, deltaN, deltaTA], dtype=np.float64)
+
+
+def action_deltas(deltaLen=DELTA_LEN, deltaTA=DELTA_TA, deltaN=DELTA_N):
+    """(16, 8) matrix, row a is the state change caused by action a"""
+    steps = step_sizes(deltaLen, deltaTA, deltaN)
+    deltas = np.zeros((2 * len(steps), len(steps)))
+    deltas[0::2] = np.diag(steps)
+    deltas[1::2] = -np.diag(steps)
+    return deltas
+
+
+ACTION_DELTAS = action_deltas()
+
+
+class TransitionKernel(object):
+    """applies arrays of discrete actions to arrays of states and checks them against the limits"""
+
+    def __init__(self, max_deltas=MAX_DELTAS, deltaLen=DELTA_LEN, deltaTA=DELTA_TA, deltaN=DELTA_N):
+        self.deltas = action_deltas(deltaLen, deltaTA, deltaN)
+        self.steps = step_sizes(deltaLen, deltaTA, deltaN)
+        self.high = np.asarray(max_deltas, dtype=np.float64)
+        self.low = -self.high
+        self.n_actions = len(self.deltas)
+
+    def apply(self, states, actions):
+        """next states for states [..., 8] and integer actions [...]"""
+        actions = np.asarray(actions)
+        if np.any((actions < 0) | (actions >= self.n_actions)):
+            raise ValueError('actions must be in [0, {}), got {}'.format(self.n_actions, actions))
+        return np.asarray(states, dtype=np.float64) + self.deltas[actions]
+
+    def out_of_range(self, states):
+        """per-variable flags [..., 8], True where a state variable is beyond its limit"""
+        states = np.asarray(states, dtype=np.float64)
+        return (states < self.low) | (states > self.high)
+
+    def done(self, states):
+        """episode termination [...]: any state variable out of range"""
+        return self.out_of_range(states).any(axis=-1)
+
+    def step(self, states, actions):
+        """(next_states, done, out_of_range) for a batch in one call"""
+        next_states = self.apply(states, actions)
+        out = self.out_of_range(next_states)
+        return next_states, out.any(axis=-1), out
+
+    def neighbors(self, state):
+        """all 16 states reachable from one state, [16, 8]"""
+        return np.asarray(state, dtype=np.float64)[None, :] + self.deltas
@@ -0,0 +1,159 @@
+""" append-only on-disk log of DQN transitions, replacing the per-episode np.save of the whole replay
+    memory. Every flush writes only the new transitions, as one chunk: a .npy file of fixed-dtype
+    records that can be memory-mapped without unpickling anything. index.csv lists the finished chunks;
+    a chunk is written to a temporary name and renamed before it is indexed, so a crash loses at most
+    the episode in progress and never corrupts earlier ones. Every transition keeps the five raw
+    metrics of its step, so the data can be rescored offline (reward.py).
+
+        log = TransitionLog('dataset')
+        log.append(state, action, next_state, reward, done, score, info['metrics'], info.get('oob_penalty', np.nan))
+        log.end_episode()              # writes the episode's chunk
+        for episode in TransitionLog('dataset').episodes():
+            episode['state'], episode['action'], episode['reward'], ...
+"""
+
+import csv
+import os
+import numpy as np
+
+INDEX = 'index.csv'
+INDEX_FIELDS = ('file', 'rows', 'first_episode', 'last_episode')
+
+
+def record_dtype(state_dim=8):
+    """ one transition: next_state is the observation after the step, also for terminal steps;
+        metrics are (Q, lam, power, area, div_angle) of next_state, NaN when unknown; oob_penalty is
+        the penalty of an out-of-range move the env rejected without simulating, NaN for the others
+    """
+    return np.dtype([
+        ('episode', np.int64),
+        ('step', np.int32),
+        ('state', np.float64, (state_dim,)),
+        ('action', np.int64),
+        ('next_state', np.float64, (state_dim,)),
+        ('reward', np.float64),
+        ('score', np.float64),
+        ('done', np.bool_),
+        ('metrics', np.float64, (5,)),
+        ('oob_penalty', np.float64),
+    ])
+
+
+def _value(x):
+    # tensors, arrays and plain numbers alike
+    if hasattr(x, 'detach'):
+        x = x.detach().cpu().numpy()
+    return np.asarray(x, dtype=np.float64)
+
+
+class TransitionLog(object):
+    """
+    Directory of chunk_NNNNNN.npy files plus index.csv. Opening an existing log appends to it,
+    numbering new episodes after the last indexed one.
+    """
+
+    def __init__(self, path, state_dim=8):
+        self.path = path
+        self.dtype = record_dtype(state_dim)
+        os.makedirs(path, exist_ok=True)
+        self._pending = []
+        index = self.index()
+        self.episode = index[-1]['last_episode'] + 1 if index else 0
+        self.step = 0
+        self._next_chunk = len(index)
+
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(os.path.join(path, INDEX))
+
+    def index(self):
+        """the finished chunks, oldest first"""
+        name = os.path.join(self.path, INDEX)
+        if not os.path.isfile(name):
+            return []
+        with open(name, newline='') as f:
+            return [{'file': row['file'], 'rows': int(row['rows']), 'first_episode': int(row['first_episode']),
+                     'last_episode': int(row['last_episode'])} for row in csv.DictReader(f)]
+
+    def append(self, state, action, next_state, reward, done=False, score=np.nan, metrics=None, oob_penalty=np.nan):
+        """buffers one transition of the current episode (next_state None counts as done)"""
+        if next_state is None:
+            next_state, done = np.full(self.dtype['state'].shape, np.nan), True
+        if metrics is None:
+            metrics = np.full(5, np.nan)
+        self._pending.append((self.episode, self.step, _value(state).reshape(-1), int(_value(action).reshape(-1)[0]),
+                              _value(next_state).reshape(-1), float(_value(reward).reshape(-1)[0]),
+                              float(_value(score).reshape(-1)[0]), bool(done), _value(metrics).reshape(-1),
+                              float(oob_penalty)))
+        self.step += 1
+
+    def end_episode(self):
+        """closes the current episode and writes it out"""
+        self.flush()
+        self.episode += 1
+        self.step = 0
+
+    def flush(self):
+        """writes the buffered transitions as a new chunk"""
+        if not self._pending:
+            return
+        records = np.array(self._pending, dtype=self.dtype)
+        name = 'chunk_{:06d}.npy'.format(self._next_chunk)
+        tmp = os.path.join(self.path, name + '.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, records)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, name))
+
+        index = os.path.join(self.path, INDEX)
+        new = not os.path.isfile(index)
+        with open(index, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(INDEX_FIELDS)
+            writer.writerow((name, len(records), int(records['episode'][0]), int(records['episode'][-1])))
+            f.flush()
+            os.fsync(f.fileno())
+        self._next_chunk += 1
+        self._pending = []
+
+    def chunks(self, mmap_mode='r'):
+        """the indexed chunks as (memory-mapped) record arrays; chunks of older logs are brought up to date"""
+        return [self._upgrade(np.load(os.path.join(self.path, entry['file']), mmap_mode=mmap_mode))
+                for entry in self.index()]
+
+    def _upgrade(self, chunk):
+        # chunks written before a field existed get it filled with NaN (a copy, not memory-mapped)
+        if chunk.dtype.names == self.dtype.names:
+            return chunk
+        records = np.zeros(len(chunk), dtype=self.dtype)
+        for name in self.dtype.names:
+            if name in chunk.dtype.names:
+                records[name] = chunk[name]
+            else:
+                records[name] = np.nan
+        return records
+
+    def read(self):
+        """all logged transitions in one record array"""
+        chunks = self.chunks()
+        if not chunks:
+            return np.zeros(0, dtype=self.dtype)
+        return np.concatenate(chunks)
+
+    def episodes(self):
+        """record arrays of one episode each, in order (an episode may span several chunks)"""
+        current = []
+        for chunk in self.chunks():
+            starts = np.flatnonzero(np.diff(chunk['episode'])) + 1
+            for part in np.split(chunk, starts):
+                if current and current[-1]['episode'][0] != part['episode'][0]:
+                    yield np.concatenate(current)
+                    current = []
+                current.append(part)
+        if current:
+            yield np.concatenate(current)
+
+    def __len__(self):
+        return sum(entry['rows'] for entry in self.index()) + len(self._pending)
@@ -0,0 +1,193 @@
+""" batched FdtdEnv: steps N independent PCSEL designs at once and fans the N solver calls
+    out to a pool of simulation worker processes (one worker per core / solver seat).
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+
+from fdtd_env import FdtdEnv, simulate_state
+from FdtdRlNanobeam import FdtdRlNanobeam
+from instrumentation import StepTimer
+from sim_cache import FULL
+from surrogate import SURROGATE
+
+_worker_solver = None
+
+
+def _init_worker(solver_fn):
+    # every worker process keeps its own solver object (and warm session) for its whole lifetime
+    global _worker_solver
+    _worker_solver = solver_fn()
+    _worker_solver.timer = StepTimer(capacity=1)
+
+
+def _worker_simulate(state):
+    # phase timings travel back with the result so they land in the env's own timer
+    result = simulate_state(_worker_solver, state)
+    return result, _worker_solver.timer.end_step()
+
+
+def solver_factory(solver):
+    """picklable function building a FdtdRlNanobeam configured like solver (same backend), for worker processes"""
+    if type(solver) is not FdtdRlNanobeam:
+        raise ValueError('cannot rebuild a {} in the workers, pass solver_fn'.format(type(solver).__name__))
+    if solver.backend is None:
+        return FdtdRlNanobeam
+    return partial(FdtdRlNanobeam, backend=solver.backend)
+
+
+class FdtdVecEnv(object):
+    """
+    Holds num_envs FdtdEnv copies in the trainer process (state bookkeeping and scoring are cheap)
+    and sends only the expensive simulations to the worker pool.
+
+    step(actions) takes one discrete action per env and returns stacked
+    (obs [N, 8], scores [N], dones [N], infos). Envs that finish are reset automatically and
+    their final observation is kept in infos[i]['terminal_observation'], as gym's vector envs do.
+    step_envs(indices, actions) steps only a subset of the envs and never resets them, which is
+    what the episode evaluators need.
+
+    num_workers=0 runs the simulations serially in this process. solver_fn builds the
+    FdtdRlNanobeam used by each worker and must be picklable (a class or module level function);
+    by default the workers get a solver with the same backend as the envs' own.
+    cache, when given, replaces the envs' caches; otherwise they keep whatever env_fn set up.
+
+    Every state goes through its env's lookup() first (cache, infeasible designs), then its
+    surrogate, and fresh results through its record(), as in FdtdEnv.simulate. The workers only
+    run full fidelity simulations, so envs with a fidelity ladder or a speculator are refused.
+    """
+
+    def __init__(self, num_envs, num_workers=None, cache=None, env_fn=None, solver_fn=None):
+        self.num_envs = num_envs
+        self.cache = cache
+        if env_fn is None:
+            env_fn = FdtdEnv
+        self.envs = [env_fn() for _ in range(num_envs)]
+        for env in self.envs:
+            if cache is not None:
+                if getattr(env, 'snap', True) is False:
+                    raise ValueError('continuous envs with snap=False cannot share a lattice keyed SimCache')
+                env.cache = cache
+            if getattr(env, 'fidelity', None) is not None or getattr(env, 'speculator', None) is not None:
+                raise ValueError('FdtdVecEnv runs full fidelity simulations on its own workers, '
+                                 'envs with a fidelity ladder or a speculator are not supported')
+
+        if solver_fn is None:
+            solver_fn = solver_factory(self.envs[0].FR)
+        self.kernel = self.envs[0].kernel
+        self.single_observation_space = self.envs[0].observation_space
+        self.single_action_space = self.envs[0].action_space
+        # the scripts only read .n / .shape from these, so expose the per-env spaces too
+        self.observation_space = self.single_observation_space
+        self.action_space = self.single_action_space
+
+        if num_workers is None:
+            num_workers = num_envs
+        self.num_workers = num_workers
+        if num_workers > 0:
+            self.pool = ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker,
+                                            initargs=(solver_fn,))
+        else:
+            self.pool = None
+            self._solver = solver_fn()
+            self._solver.timer = StepTimer(capacity=1)
+
+        # wall time of each batched step: 'run' is the wait for the whole batch of simulations
+        self.timer = StepTimer()
+
+    def reset(self):
+        return np.stack([env.reset() for env in self.envs])
+
+    def simulate(self, states, timings=None, fidelities=None, envs=None):
+        """simulates a list of states in parallel, skipping those their env (envs[i] for states[i],
+        the first env when not given) or its surrogate can answer without the solver; the solver
+        phase timings of state i are stored in timings[i] and the fidelity of its result in
+        fidelities[i] when lists are given"""
+        results = [None] * len(states)
+        if timings is None:
+            timings = [None] * len(states)
+        if fidelities is None:
+            fidelities = [None] * len(states)
+        if envs is None:
+            envs = [self.envs[0]] * len(states)
+        pending = {}
+        for i, (state, env) in enumerate(zip(states, envs)):
+            results[i] = env.lookup(state)
+            if results[i] is not None:
+                fidelities[i] = env.last_fidelity
+                continue
+            if env.surrogate is not None:
+                results[i] = env.surrogate.answer(state)
+                if results[i] is not None:
+                    fidelities[i] = SURROGATE
+                    continue
+            if self.pool is not None:
+                pending[i] = self.pool.submit(_worker_simulate, state)
+            else:
+                results[i] = simulate_state(self._solver, state)
+                timings[i] = self._solver.timer.end_step()
+                env.record(state, results[i], FULL)
+                fidelities[i] = FULL
+
+        for i, future in pending.items():
+            results[i], timings[i] = future.result()
+            envs[i].record(states[i], results[i], FULL)
+            fidelities[i] = FULL
+        return results
+
+    def step_envs(self, indices, actions):
+        """steps envs[indices] with the matching actions; no automatic reset"""
+        if hasattr(self.single_action_space, 'n'):
+            # one vectorized transition for all the stepped envs
+            current = np.array([self.envs[i].state for i in indices], dtype=np.float64)
+            states = [tuple(s) for s in self.kernel.apply(current, np.asarray(actions, dtype=np.int64)).tolist()]
+        else:
+            # continuous actions (FdtdEnv_v1) carry per-env trust regions
+            states = [self.envs[i].propose(a) for i, a in zip(indices, actions)]
+        # out-of-range moves are settled by each env's out_of_bounds policy and never reach the workers
+        skipped = [self.envs[i].skips(state) for i, state in zip(indices, states)]
+        sim_states = [state for state, skip in zip(states, skipped) if not skip]
+        sim_envs = [self.envs[i] for i, skip in zip(indices, skipped) if not skip]
+        timings = [None] * len(sim_states)
+        fidelities = [None] * len(sim_states)
+        with self.timer.phase('run'):
+            results = iter(zip(self.simulate(sim_states, timings, fidelities, sim_envs), timings, fidelities))
+
+        obs, scores, dones, infos = [], [], [], []
+        for i, state, skip in zip(indices, states, skipped):
+            if skip:
+                o, score, done, info = self.envs[i].reject(state)
+            else:
+                metrics, timing, fidelity = next(results)
+                for phase, seconds in (timing or {}).items():
+                    self.envs[i].timer.add(phase, seconds)
+                self.envs[i].last_fidelity = fidelity
+                o, score, done, info = self.envs[i].commit(state, metrics)
+            obs.append(o)
+            scores.append(score)
+            dones.append(done)
+            infos.append(info)
+        self.timer.end_step()
+        return np.stack(obs), np.array(scores, dtype=np.float32), np.array(dones, dtype=bool), infos
+
+    def step(self, actions):
+        obs, scores, dones, infos = self.step_envs(range(self.num_envs), actions)
+        for i in np.flatnonzero(dones):
+            infos[i] = dict(infos[i], terminal_observation=obs[i])
+            obs[i] = self.envs[i].reset()
+        return obs, scores, dones, infos
+
+    def get_metrics(self):
+        """batch wall times plus the per-env phase summaries"""
+        return {'batch': self.timer.summary(), 'envs': [env.get_metrics() for env in self.envs]}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+        if self.cache is not None:
+            self.cache.close()
+
+    def __len__(self):
+        return self.num_envs
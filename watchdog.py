@@ -0,0 +1,206 @@
+""" watchdog for solver calls: the solver (and its FDTD session) lives in a supervised child
+    process, so a wedged or crashed simulation can be killed and restarted instead of blocking the
+    whole training run. The child leads its own process group, so killing it also kills the FDTD
+    engine it spawned, which would otherwise keep running and hold its licence seat. Every call gets
+    a timeout, failed attempts are retried with exponential backoff on a fresh session, and designs
+    that keep failing are quarantined: they get a penalty result without touching the solver again.
+
+        FR = FdtdRlNanobeam(backend=WatchdogBackend(FdtdRlNanobeam, timeout=1800))
+        env = FdtdEnv(solver=FR)
+        FR.backend.stats()   # timeouts, crashes, restarts, retries, quarantine (also in env.get_metrics())
+"""
+
+import multiprocessing
+import os
+import signal
+import time
+from collections import Counter
+
+from backends import Backend, register_backend
+from FdtdRlNanobeam import FdtdRlNanobeam, FailedResult, INFEASIBLE_RESULT
+
+
+class SolverFailed(RuntimeError):
+    """raised when a design failed every attempt and no fallback result is configured"""
+
+
+def _serve(conn, solver_fn):
+    # child process: one solver object for the whole life of the process, in a process group of its
+    # own that the engines started by its sessions join
+    if hasattr(os, 'setsid'):
+        os.setsid()
+    solver = solver_fn()
+    try:
+        while True:
+            try:
+                args = conn.recv()
+            except EOFError:
+                break
+            if args is None:
+                break
+            try:
+                conn.send(('ok', tuple(float(v) for v in solver.adjustdesignparams(*args))))
+            except Exception as e:
+                conn.send(('error', repr(e)))
+    finally:
+        if getattr(solver, 'sessions', None) is not None:
+            solver.sessions.close()
+
+
+class WatchdogBackend(Backend):
+    """
+    Runs solver_fn().adjustdesignparams in a child process with a per-call timeout.
+    A timeout, a crash or an exception kills the child (and with it the session); the next attempt
+    starts a fresh one after backoff * 2**(attempt-1) seconds (at most max_backoff), up to
+    `retries` retries. A design that failed quarantine_after attempts in total (over all calls,
+    default retries + 1, i.e. one call that used up all its retries) is quarantined.
+    Designs that fail for good return `fallback` as a FailedResult, which FdtdEnv labels 'failed' and
+    keeps out of the cache and the surrogate, or raise SolverFailed when fallback is None.
+    """
+
+    name = 'watchdog'
+
+    def __init__(self, solver_fn=FdtdRlNanobeam, timeout=3600., retries=2, backoff=5., max_backoff=300.,
+                 quarantine_after=None, fallback=INFEASIBLE_RESULT, context=None):
+        if quarantine_after is None:
+            quarantine_after = retries + 1
+        if quarantine_after <= retries:
+            raise ValueError('quarantine_after={} would cut the {} retries short, it must exceed retries'.format(
+                quarantine_after, retries))
+        self.solver_fn = solver_fn
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.quarantine_after = quarantine_after
+        self.fallback = fallback
+        self.context = context
+        self.failures = Counter()   # failed attempts per design
+        self.quarantine = set()
+        self.counts = Counter()
+        self.last_error = None
+        self._process = None
+        self._conn = None
+
+    @staticmethod
+    def _key(args):
+        return tuple('%.10g' % float(v) for v in args)
+
+    def _start(self):
+        ctx = multiprocessing.get_context(self.context)
+        self._conn, child = ctx.Pipe()
+        self._process = ctx.Process(target=_serve, args=(child, self.solver_fn), daemon=True)
+        self._process.start()
+        child.close()
+        self.counts['starts'] += 1
+
+    def _signal_group(self, sig):
+        # the child's whole process group: the solver process and the engines it started
+        if hasattr(os, 'killpg'):
+            try:
+                os.killpg(self._process.pid, sig)
+                return
+            except (ProcessLookupError, PermissionError):
+                pass
+        if sig == signal.SIGTERM:
+            self._process.terminate()
+        elif self._process.is_alive():
+            self._process.kill()
+
+    def _kill(self):
+        if self._process is None:
+            return
+        try:
+            self._conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self._process.join(1.)
+        if self._process.is_alive():
+            self._signal_group(signal.SIGTERM)
+            self._process.join(5.)
+        if self._process.is_alive():
+            self._signal_group(getattr(signal, 'SIGKILL', signal.SIGTERM))
+            self._process.join()
+        elif hasattr(os, 'killpg'):
+            # a child that exited (or crashed) can leave engine processes behind in its group
+            try:
+                os.killpg(self._process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+        self._conn.close()
+        self._process = None
+        self._conn = None
+
+    def _attempt(self, args):
+        """one try on the child process, (status, result or error message)"""
+        if self._process is None or not self._process.is_alive():
+            if self._process is not None:
+                self.counts['crashes'] += 1
+                self._kill()
+            self._start()
+        try:
+            self._conn.send(tuple(float(v) for v in args))
+            if not self._conn.poll(self.timeout):
+                self.counts['timeouts'] += 1
+                return 'timeout', 'no result after {} s'.format(self.timeout)
+            status, value = self._conn.recv()
+        except (EOFError, OSError):
+            self.counts['crashes'] += 1
+            return 'crash', 'solver process died (exit code {})'.format(self._process.exitcode)
+        if status == 'error':
+            self.counts['errors'] += 1
+        return status, value
+
+    def adjustdesignparams(self, dlen, dt, dt1, dt3, dn1, dn3, dleng, da):
+        args = (dlen, dt, dt1, dt3, dn1, dn3, dleng, da)
+        key = self._key(args)
+        if key in self.quarantine:
+            self.counts['quarantine_hits'] += 1
+            return self._give_up(key)
+        self.counts['calls'] += 1
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.counts['retries'] += 1
+                time.sleep(min(self.backoff * 2 ** (attempt - 1), self.max_backoff))
+            status, value = self._attempt(args)
+            if status == 'ok':
+                return value
+
+            # whatever went wrong, the session is suspect: kill it, the next attempt gets a fresh one
+            self.last_error = value
+            self._kill()
+            self.counts['restarts'] += 1
+            self.failures[key] += 1
+            if self.failures[key] >= self.quarantine_after:
+                self.quarantine.add(key)
+                self.counts['quarantined'] += 1
+                break
+        return self._give_up(key)
+
+    def _give_up(self, key):
+        if self.fallback is None:
+            raise SolverFailed('design {} failed: {}'.format(key, self.last_error))
+        self.counts['fallbacks'] += 1
+        return FailedResult(self.fallback)
+
+    def stats(self):
+        """event counters (calls, timeouts, crashes, errors, retries, restarts, quarantined, ...)"""
+        out = {name: self.counts[name] for name in ('calls', 'starts', 'timeouts', 'crashes', 'errors', 'retries',
+                                                    'restarts', 'quarantined', 'quarantine_hits', 'fallbacks')}
+        out['quarantine_size'] = len(self.quarantine)
+        out['last_error'] = self.last_error
+        return out
+
+    def close(self):
+        self._kill()
+
+    def __getstate__(self):
+        # the child process stays with its owner, a copy starts its own on first use
+        state = self.__dict__.copy()
+        state['_process'] = None
+        state['_conn'] = None
+        return state
+
+
+register_backend('watchdog', WatchdogBackend)